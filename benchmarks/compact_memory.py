@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Compare the memory used by documents of a regular model to that used by
+the same documents in a closed (slotted) model.  Documents are built the way
+pymongo builds them, by creating an empty instance and setting each key.
+
+    python benchmarks/compact_memory.py [number of documents]"""
+
+import sys
+import os
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from micromongo import Model, Field
+
+spec = {
+    'user_id': Field(type=int, required=True),
+    'score': Field(type=float, default=0.0),
+    'rank': Field(type=int),
+    'label': Field(type=basestring),
+}
+
+class OpenScore(Model):
+    collection = 'bench.open_score'
+    spec = spec
+
+class ClosedScore(Model):
+    collection = 'bench.closed_score'
+    closed = True
+    spec = spec
+
+def load(cls, n):
+    docs = []
+    for i in xrange(n):
+        doc = cls()
+        for key, value in (('_id', i), ('user_id', i), ('score', i * 0.5),
+                           ('rank', i % 100), ('label', 'user')):
+            doc[key] = value
+        docs.append(doc)
+    return docs
+
+def overhead(doc):
+    """Bytes used by a document's object and containers, not its values."""
+    size = sys.getsizeof(doc)
+    if isinstance(doc, ClosedScore):
+        if doc._overflow is not None:
+            size += sys.getsizeof(doc._overflow)
+    else:
+        size += sys.getsizeof(doc.__dict__)
+    return size
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    results = {}
+    for cls in (OpenScore, ClosedScore):
+        docs = load(cls, n)
+        results[cls.__name__] = sum(overhead(d) for d in docs) / float(n)
+        del docs
+    for name, size in sorted(results.items()):
+        print '%-12s %7.1f bytes/document' % (name, size)
+    print 'saved %.1f%%' % (100 * (1 - results['ClosedScore'] / results['OpenScore']))
+
+if __name__ == '__main__':
+    main()
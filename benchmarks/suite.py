@@ -0,0 +1,342 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Benchmarks of micromongo's hot paths, run against the in-memory backend
+so that they measure micromongo rather than a server or the network.
+
+    python benchmarks/suite.py [-o results.json] [-c baseline.json] [-t 0.1]
+
+Results are printed, and saved as JSON with ``-o``.  With ``-c``, they are
+compared to the results of an earlier run, and any benchmark that got worse
+by more than the threshold (10% by default) is flagged as a regression, in
+which case the exit status is 1.  Each timing is the best of several runs,
+so re-running on a quiet machine gives reproducible numbers."""
+
+import sys
+import os
+import gc
+import json
+import time
+import shutil
+import platform
+import tempfile
+import optparse
+from timeit import default_timer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pymongo
+import micromongo
+from micromongo import connect, Model, Field, Ref
+from micromongo import columnar
+from micromongo.models import AccountingMeta, CompactStruct
+from micromongo.cache import QueryCache
+from micromongo.utils import OpenStruct
+
+benchmarks = []
+
+def benchmark(unit, higher_is_better=True):
+    """Register a benchmark function returning a value in ``unit``."""
+    def decorator(function):
+        benchmarks.append((function.__name__, unit, higher_is_better, function))
+        return function
+    return decorator
+
+def rate(function, count, repeat=5):
+    """Return the best rate, in calls per second, of ``function``, which does
+    ``count`` operations per call."""
+    best = None
+    gc.disable()
+    try:
+        for i in range(repeat):
+            start = default_timer()
+            function()
+            elapsed = default_timer() - start
+            best = elapsed if best is None else min(best, elapsed)
+    finally:
+        gc.enable()
+    return count / max(best, 1e-9)
+
+def fields(size):
+    return dict(('field%d' % i, i) for i in range(size))
+
+def spec_for(size):
+    return dict(('field%d' % i, Field(type=int, required=True)) for i in range(size))
+
+class SmallSpec(Model):
+    collection = 'bench.small_spec'
+    spec = spec_for(3)
+
+class LargeSpec(Model):
+    collection = 'bench.large_spec'
+    spec = spec_for(30)
+
+class Document(Model):
+    collection = 'bench.document'
+
+class ClosedDocument(Model):
+    collection = 'bench.closed_document'
+    closed = True
+    spec = spec_for(10)
+
+class DiffedDocument(Model):
+    collection = 'bench.diffed_document'
+    diff_in_place = True
+
+class Author(Model):
+    collection = 'bench.author'
+
+class Post(Model):
+    collection = 'bench.post'
+    spec = {'author': Ref('bench.author')}
+
+def load_documents(n=5000):
+    col = micromongo.current().bench.document
+    col.drop()
+    col.insert([dict(fields(10), n=i) for i in xrange(n)])
+    return n
+
+@benchmark('documents/s')
+def find_cached():
+    n = load_documents()
+    return rate(lambda: list(Document.find()), n)
+
+@benchmark('documents/s')
+def find_streamed():
+    n = load_documents()
+    return rate(lambda: list(Document.find().stream()), n)
+
+@benchmark('routes/s')
+def route():
+    route = AccountingMeta.route
+    def run():
+        for i in xrange(100000):
+            route('bench.document')
+    return rate(run, 100000)
+
+if columnar.numpy is not None:
+    @benchmark('documents/s')
+    def find_to_arrays():
+        n = load_documents()
+        return rate(lambda: Document.find().to_arrays(), n)
+
+@benchmark('lookups/s')
+def find_one_by_id():
+    load_documents(100)
+    ids = [d['_id'] for d in micromongo.current().bench.document.find()]
+    return rate(lambda: [Document.find_one({'_id': _id}) for _id in ids * 20], len(ids) * 20)
+
+@benchmark('lookups/s')
+def snapshot_get():
+    load_documents(1000)
+    ids = [d['_id'] for d in micromongo.current().bench.document.find()]
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, 'document.snap')
+        Document.snapshot(path)
+        with Document.open_snapshot(path) as snapshot:
+            return rate(lambda: [snapshot.get(_id) for _id in ids], len(ids))
+    finally:
+        shutil.rmtree(directory)
+
+@benchmark('queries/s')
+def find_query_cache_hit():
+    load_documents(100)
+    connection = micromongo.current()
+    connection.query_cache = QueryCache()
+    query = lambda: list(Document.find({'n': {'$lt': 20}}, cache_ttl=60))
+    try:
+        return rate(lambda: [query() for i in xrange(1000)], 1000)
+    finally:
+        connection.query_cache = None
+
+@benchmark('pages/s')
+def find_populate_page():
+    db = micromongo.current().bench
+    db.author.drop()
+    db.post.drop()
+    db.author.insert([{'_id': i, 'name': 'author %d' % i} for i in xrange(50)])
+    db.post.insert([{'_id': i, 'author': i % 50} for i in xrange(50)])
+    return rate(lambda: [list(Post.find().populate('author')) for i in xrange(100)], 100)
+
+@benchmark('handles/s')
+def collection_handle():
+    def run():
+        for i in xrange(100000):
+            Document._collection()
+    return rate(run, 100000)
+
+@benchmark('cursors/s')
+def cursor_setup():
+    def run():
+        for i in xrange(20000):
+            Document.find({'n': i})
+    return rate(run, 20000)
+
+@benchmark('classes/s')
+def declare_models(n=2000):
+    """Declare ``n`` models the way generated code does, with collections
+    named after the module and class, then forget them."""
+    spec = spec_for(5)
+    def run():
+        for i in xrange(n):
+            AccountingMeta('GeneratedModel%d' % i, (Model,),
+                           {'__module__': 'bench.generated_models', 'spec': spec})
+    try:
+        return rate(run, n)
+    finally:
+        for key in [k for k in AccountingMeta.collection_map if k.startswith('generated_models.')]:
+            del AccountingMeta.collection_map[key]
+
+@benchmark('documents/s')
+def new_small_spec():
+    return rate(lambda: [SmallSpec.new() for i in xrange(10000)], 10000)
+
+@benchmark('documents/s')
+def new_large_spec():
+    return rate(lambda: [LargeSpec.new() for i in xrange(10000)], 10000)
+
+@benchmark('documents/s')
+def validate_small_spec():
+    doc = SmallSpec(fields(3))
+    return rate(lambda: [doc.validate() for i in xrange(10000)], 10000)
+
+@benchmark('documents/s')
+def validate_large_spec():
+    doc = LargeSpec(fields(30))
+    return rate(lambda: [doc.validate() for i in xrange(10000)], 10000)
+
+@benchmark('documents/s')
+def save_small_spec():
+    micromongo.current().bench.small_spec.drop()
+    return rate(lambda: [SmallSpec(fields(3)).save() for i in xrange(2000)], 2000)
+
+@benchmark('documents/s')
+def save_large_spec():
+    micromongo.current().bench.large_spec.drop()
+    return rate(lambda: [LargeSpec(fields(30)).save() for i in xrange(2000)], 2000)
+
+@benchmark('accesses/s')
+def openstruct_getattr():
+    doc = OpenStruct(fields(10))
+    def run():
+        for i in xrange(100000):
+            doc.field5
+    return rate(run, 100000)
+
+@benchmark('accesses/s')
+def openstruct_getitem():
+    doc = OpenStruct(fields(10))
+    def run():
+        for i in xrange(100000):
+            doc['field5']
+    return rate(run, 100000)
+
+def deep_size(value):
+    """Bytes used by ``value`` and the lists and dicts in it."""
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(deep_size(k) + deep_size(v) for k, v in value.iteritems())
+    elif isinstance(value, list):
+        size += sum(deep_size(v) for v in value)
+    return size
+
+def document_size(doc):
+    """Bytes used by a document's object and containers, not its values,
+    plus the state kept to track its changes."""
+    size = sys.getsizeof(doc)
+    if isinstance(doc, CompactStruct):
+        # asking for the __dict__ of these would allocate one
+        if doc._overflow is not None:
+            size += sys.getsizeof(doc._overflow)
+    else:
+        size += sys.getsizeof(doc.__dict__)
+    if doc._dirty is not None:
+        size += sys.getsizeof(doc._dirty)
+    if doc._originals is not None:
+        size += deep_size(doc._originals)
+    return size
+
+@benchmark('bytes/document', higher_is_better=False)
+def memory_per_document():
+    load_documents(1000)
+    docs = list(Document.find())
+    return sum(document_size(d) for d in docs) / float(len(docs))
+
+@benchmark('bytes/document', higher_is_better=False)
+def memory_per_closed_document():
+    col = micromongo.current().bench.closed_document
+    col.drop()
+    col.insert([fields(10) for i in xrange(1000)])
+    docs = list(ClosedDocument.find())
+    return sum(document_size(d) for d in docs) / float(len(docs))
+
+@benchmark('bytes/document', higher_is_better=False)
+def memory_per_diffed_document():
+    col = micromongo.current().bench.diffed_document
+    col.drop()
+    col.insert([dict(fields(10), values=range(50)) for i in xrange(1000)])
+    docs = list(DiffedDocument.find())
+    return sum(document_size(d) for d in docs) / float(len(docs))
+
+def run(names=None):
+    connect('mem://benchmarks')
+    results = {}
+    for name, unit, higher_is_better, function in benchmarks:
+        if names and name not in names:
+            continue
+        results[name] = {'value': function(), 'unit': unit,
+                         'higher_is_better': higher_is_better}
+    micromongo.current().drop_database('bench')
+    return {
+        'meta': {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'pymongo': pymongo.version,
+            'micromongo': '.'.join(map(str, micromongo.VERSION)),
+        },
+        'results': results,
+    }
+
+def compare(results, baseline, threshold):
+    """Return a list of ``(name, change)`` for benchmarks that are worse than
+    in ``baseline`` by more than ``threshold``;  ``change`` is the fraction
+    by which they got worse."""
+    regressions = []
+    for name, result in sorted(results['results'].items()):
+        old = baseline['results'].get(name)
+        if not old or not old['value']:
+            continue
+        change = (result['value'] - old['value']) / float(old['value'])
+        if result['higher_is_better']:
+            change = -change
+        if change > threshold:
+            regressions.append((name, change))
+    return regressions
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options] [benchmark ...]')
+    parser.add_option('-o', '--output', help='save results as json to this file')
+    parser.add_option('-c', '--compare', help='compare to results saved with -o')
+    parser.add_option('-t', '--threshold', type='float', default=0.1,
+                      help='fraction worse than the baseline to flag (default 0.1)')
+    options, names = parser.parse_args()
+
+    results = run(names)
+    for name, result in sorted(results['results'].items()):
+        print '%-28s %14.1f %s' % (name, result['value'], result['unit'])
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if options.compare:
+        with open(options.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, options.threshold)
+        for name, change in regressions:
+            print 'REGRESSION: %s is %.1f%% worse' % (name, change * 100)
+        if regressions:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -4,10 +4,10 @@
 """micromongo __init__.py"""
 
 from models import *
-from spec import Field
+from spec import Field, Ref
 
 VERSION = (0, 1, 4)
 
-__all__ = ['connect', 'clean_connection', 'Model', 'Field', 'VERSION']
+__all__ = ['current', 'connect', 'clean_connection', 'request', 'sync_indexes', 'Model', 'LazyModel', 'Field', 'Ref', 'VERSION']
 
 
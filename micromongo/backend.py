@@ -13,6 +13,11 @@ that takes a collection's full name and returns a new object of the appropriate
 class to be used as a cursor's "as_class"."""
 
 import os
+import re
+import time
+import threading
+from collections import deque
+from contextlib import contextmanager
 from pprint import pprint
 
 import pymongo
@@ -22,10 +27,82 @@ from pymongo.database import Database as PymongoDatabase
 from pymongo.collection import Collection as PymongoCollection
 from pymongo.cursor import Cursor as PymongoCursor
 from pymongo.son_manipulator import SONManipulator
+from pymongo.errors import InvalidOperation, OperationFailure
+from bson.son import SON
+
+try:
+    from pymongo.pool import Pool as PymongoPool, NO_REQUEST, NO_SOCKET_YET
+except ImportError:
+    PymongoPool = None
+
+try:
+    from pymongo.mongo_replica_set_client import MongoReplicaSetClient
+except ImportError:
+    MongoReplicaSetClient = None
+
+from micromongo import futures, monitoring, columnar
+from micromongo.cache import CachedQuery
+from micromongo.utils import hashable
 
 def default_class_router(collection_full_name):
     return dict()
 
+def routed_class(connection, full_name):
+    """Return the class a connection's router gives for ``full_name``;  the
+    default router returns an instance rather than a class."""
+    as_class = connection.class_router(full_name)
+    return as_class if isinstance(as_class, type) else type(as_class)
+
+def wrap_document(as_class, document):
+    """Wrap a document that was decoded as a dict (eg. by a command) in
+    ``as_class``, the way a cursor would have."""
+    if as_class is dict or as_class is type(document):
+        return document
+    wrapped = as_class()
+    for key, value in document.iteritems():
+        wrapped[key] = value
+    loaded = getattr(wrapped, '_loaded', None)
+    if loaded is not None:
+        loaded()
+    return wrapped
+
+def wrap_nested(as_class, document):
+    """Copy the dict ``document`` into ``as_class``, along with the dicts
+    in it, the way pymongo's decoder wraps the results of a cursor."""
+    wrapped = as_class()
+    for key, value in document.iteritems():
+        if isinstance(value, _containers):
+            value = _wrap_value(as_class, value)
+        wrapped[key] = value
+    return wrapped
+
+_containers = (dict, list)
+
+def _wrap_value(as_class, value):
+    if isinstance(value, dict):
+        return wrap_nested(as_class, value)
+    return [_wrap_value(as_class, v) if isinstance(v, _containers) else v for v in value]
+
+def invalidating(method):
+    """Wrap a collection's write ``method`` so that it invalidates the
+    collection's queries in the connection's query cache."""
+    def write(self, *args, **kwargs):
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            query_cache = self.database.connection.query_cache
+            if query_cache is not None:
+                query_cache.invalidate(self.full_name)
+    write.__name__ = method.__name__
+    write.__doc__ = method.__doc__
+    return write
+
+# the write methods of pymongo's collections, old and new
+write_methods = ('insert', 'save', 'update', 'remove', 'find_and_modify',
+    'insert_one', 'insert_many', 'replace_one', 'update_one',
+    'update_many', 'delete_one', 'delete_many', 'find_one_and_delete',
+    'find_one_and_replace', 'find_one_and_update', 'bulk_write')
+
 def from_env():
     """Get host/port settings from the environment."""
     if 'MICROMONGO_URI' in os.environ:
@@ -49,26 +126,144 @@ class ModelSONManipulator(SONManipulator):
     the SON going into mongodb."""
     def transform_incoming(self, son, collection):
         from models import Model
+        # lists are only copied if something in them has to be converted,
+        # so large lists of plain values are passed along untouched
         def unmodel(value):
             if isinstance(value, Model):
                 value = dict(value)
-            elif isinstance(value, list):
-                return [unmodel(x) for x in value]
-            else:
+                for k,v in value.items():
+                    if isinstance(v, (Model, list)):
+                        value[k] = unmodel(v)
                 return value
-            for k,v in value.items():
+            converted = None
+            for i,v in enumerate(value):
                 if isinstance(v, (Model, list)):
-                    value[k] = unmodel(v)
-            return value
+                    new = unmodel(v)
+                    if new is not v:
+                        if converted is None:
+                            converted = list(value)
+                        converted[i] = new
+            return value if converted is None else converted
         for k,v in son.items():
             if isinstance(v, (Model, list)):
                 son[k] = unmodel(v)
         return son
 
-class Connection(PymongoConnection):
+pymongo_version = tuple(map(int, re.findall(r'\d+', pymongo.version)[:2]))
+
+class PoolStats(object):
+    """Counters for the sockets checked out of and into a connection's pools.
+    ``in_use`` is the number of sockets currently checked out, ``peak`` the
+    most that have been checked out at once, and ``wait_time`` the total time
+    in seconds spent waiting for (or opening) sockets."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.checkouts = 0
+        self.checkins = 0
+        self.opened = 0
+        self.peak = 0
+        self.wait_time = 0.0
+
+    def checkout(self, waited):
+        with self.lock:
+            self.checkouts += 1
+            self.wait_time += waited
+            self.peak = max(self.peak, self.checkouts - self.checkins)
+
+    def checkin(self):
+        with self.lock:
+            self.checkins += 1
+
+    def open(self):
+        with self.lock:
+            self.opened += 1
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'checkouts': self.checkouts,
+                'checkins': self.checkins,
+                'in_use': self.checkouts - self.checkins,
+                'peak': self.peak,
+                'opened': self.opened,
+                'wait_time': self.wait_time,
+            }
+
+if PymongoPool is not None:
+    class CountingPool(PymongoPool):
+        """A pymongo Pool which keeps its connection's ``PoolStats``."""
+        stats = None
+
+        def connect(self, *args, **kwargs):
+            sock_info = PymongoPool.connect(self, *args, **kwargs)
+            self.stats.open()
+            return sock_info
+
+        def get_socket(self, *args, **kwargs):
+            start = time.time()
+            sock_info = PymongoPool.get_socket(self, *args, **kwargs)
+            self.stats.checkout(time.time() - start)
+            return sock_info
+
+        def maybe_return_socket(self, sock_info):
+            if sock_info not in (NO_REQUEST, NO_SOCKET_YET):
+                self.stats.checkin()
+            PymongoPool.maybe_return_socket(self, sock_info)
+
+# pymongo only takes a pool class since 2.4
+count_sockets = PymongoPool is not None and pymongo_version >= (2, 4)
+
+class ConnectionMixin(object):
+    """The behavior micromongo adds to pymongo's connection classes:  it
+    sets the class router used by its cursors.  The size of its socket pool
+    and how long to wait for a free socket are set with pymongo's
+    ``max_pool_size`` and ``waitQueueTimeoutMS`` options.  Socket checkouts
+    are counted, see ``pool_stats``."""
     def __init__(self, *args, **kwargs):
         self.class_router = kwargs.pop('class_router', default_class_router)
-        super(Connection, self).__init__(*args, **kwargs)
+        self.cursor_cache = kwargs.pop('cursor_cache', True)
+        self.identity_map = kwargs.pop('identity_map', None)
+        self.query_cache = kwargs.pop('query_cache', None)
+        self.socket_stats = PoolStats()
+        if count_sockets:
+            class ConnectionPool(CountingPool):
+                stats = self.socket_stats
+            kwargs['_pool_class'] = ConnectionPool
+        super(ConnectionMixin, self).__init__(*args, **kwargs)
+
+    def pool_stats(self):
+        """Return the socket checkout counters of this connection, along with
+        its ``max_pool_size``.  If the installed pymongo is too old to count
+        socket checkouts, the counters are always 0."""
+        stats = self.socket_stats.snapshot()
+        # our __getattr__ would return a Database for missing attributes
+        stats['max_size'] = getattr(type(self), 'max_pool_size', None) \
+            and self.max_pool_size
+        return stats
+
+    @contextmanager
+    def request(self):
+        """Pin a socket to the current thread for the duration of a block, so
+        that every query made in it (including those through Models) uses the
+        same socket, which is released back to the pool when it exits::
+
+            with micromongo.current().request():
+                user = User.find_one({'name': name})
+                user.visits += 1
+                user.save()
+        """
+        self.start_request()
+        try:
+            yield self
+        finally:
+            self.end_request()
+
+    def drop_database(self, name_or_database):
+        try:
+            return super(ConnectionMixin, self).drop_database(name_or_database)
+        finally:
+            if self.query_cache is not None:
+                self.query_cache.clear()
 
     def __getattr__(self, name):
         db = Database(self, name)
@@ -76,25 +271,232 @@ class Connection(PymongoConnection):
             db.add_son_manipulator(ModelSONManipulator())
         return db
 
+class Connection(ConnectionMixin, PymongoConnection):
+    """A pymongo Connection to a single server (or a mongos), with the
+    additions of ``ConnectionMixin``.  It sends every query to the server it
+    is connected to, so the read preferences of queries only route reads to
+    secondaries when that server is a mongos."""
+
+if MongoReplicaSetClient is not None:
+    class ReplicaSetConnection(ConnectionMixin, MongoReplicaSetClient):
+        """A pymongo MongoReplicaSetClient, with the additions of
+        ``ConnectionMixin``.  It monitors the members of the replica set and
+        sends each query to the primary or a secondary according to its read
+        preference."""
+else:
+    ReplicaSetConnection = None
+
 class Database(PymongoDatabase):
     def __getattr__(self, name):
         return Collection(self, name)
 
+    def drop_collection(self, name_or_collection):
+        name = getattr(name_or_collection, 'name', name_or_collection)
+        try:
+            return PymongoDatabase.drop_collection(self, name_or_collection)
+        finally:
+            query_cache = self.connection.query_cache
+            if query_cache is not None:
+                query_cache.invalidate('%s.%s' % (self.name, name))
+
 class Collection(PymongoCollection):
+    """A pymongo Collection whose ``find`` returns micromongo's cursors.
+    ``find`` and ``find_one`` take a ``cache_ttl`` keyword, which caches
+    their results for that many seconds if the connection has a query cache;
+    see ``micromongo.cache.QueryCache``.  Writes through the collection
+    invalidate its cached queries."""
     def find(self, *args, **kwargs):
-        return Cursor(self, *args, **kwargs)
+        ttl = kwargs.pop('cache_ttl', None)
+        cursor = Cursor(self, *args, **kwargs)
+        if ttl:
+            cursor._use_query_cache(self.database.connection.query_cache, ttl)
+        return cursor
 
-class Cursor(PymongoCursor):
-    def __init__(self, *args, **kwargs):
-        super(Cursor, self).__init__(*args, **kwargs)
-        collection = self.__collection
-        connection = collection.database.connection
-        self.as_class = connection.class_router(collection.full_name)
-        self.__as_class = connection.class_router(collection.full_name)
+    def aggregate(self, pipeline, as_class=dict, cache=None, **kwargs):
+        """Run an aggregation ``pipeline`` on the server, returning an
+        ``AggregateCursor`` over its results.  Unlike pymongo's ``aggregate``,
+        results are streamed back with a server side cursor when the server
+        supports it.  ``as_class`` is the class results are wrapped in, or
+        the full name of a collection whose routed class is used."""
+        if isinstance(as_class, basestring):
+            as_class = routed_class(self.database.connection, as_class)
+        run = lambda pipeline: self._aggregate(pipeline, **kwargs)
+        return AggregateCursor(self, pipeline, run, as_class, cache)
+
+    def _aggregate(self, pipeline, **kwargs):
+        if pymongo_version >= (2, 6):
+            try:
+                return PymongoCollection.aggregate(self, pipeline, cursor={}, **kwargs)
+            except OperationFailure:
+                # servers before 2.6 can't return aggregation cursors
+                pass
+        return PymongoCollection.aggregate(self, pipeline, **kwargs)['result']
+
+for name in write_methods:
+    if hasattr(PymongoCollection, name):
+        setattr(Collection, name, invalidating(getattr(PymongoCollection, name).im_func))
+
+class CursorMixin(object):
+    """The behavior shared by micromongo's cursors:  ``order_by``, and
+    caching of results so that a cursor can be iterated over more than once.
+    The ``cache`` keyword to a cursor controls the caching:  ``True`` caches
+    every result, ``False`` streams results without retaining them, and an
+    integer ``N`` caches only the first ``N`` results.  If it is not given,
+    the connection's ``cursor_cache`` setting is used.
+
+    Cursors using this call ``_setup_cache`` when they are created, and
+    implement ``_next_result``, which returns the next result of the query
+    or raises StopIteration, ``_tailable``, and ``_description``, which
+    returns the collection name, spec and sort reported to
+    ``micromongo.monitoring`` listeners.  If there are listeners when the
+    cursor is created or rewound, the time spent getting its results is
+    kept in ``_timer``, to which cursors add the time spent on the server."""
+    # the number of results read ahead to populate references in at once
+    populate_batch_size = 100
+    _populate = None
+
+    def _setup_cache(self, cache, connection):
+        if cache is None:
+            cache = getattr(connection, 'cursor_cache', True)
         # cache the iteration so we can iterate over results from these
         # cursors more than once;  we only do this if it is not "tailable"
-        self.__itercache = []
-        self.__fullcache = False
+        self._cachelimit = None if cache is True else int(cache)
+        self._query_cache = None
+        self._reset_cache()
+
+    def _reset_cache(self):
+        self._itercache = []
+        self._fullcache = False
+        self._exhausted = False
+        self._overflowed = False
+        self._cached_query = None
+        self._populated = None
+        self._timer = monitoring.CursorTimer() if monitoring.listeners else None
+
+    def _publish(self):
+        if self._timer is not None:
+            self._timer.finish(*self._description())
+
+    def _use_query_cache(self, query_cache, ttl):
+        """Serve this cursor's results from ``query_cache`` if they are in
+        it, and otherwise cache them there for ``ttl`` seconds.  Cursors
+        which support this implement ``_cache_key``, which returns their
+        collection's full name, a hashable key of their query and their
+        limit."""
+        self._query_cache = query_cache
+        self._cache_ttl = ttl
+
+    def _next_cached(self):
+        query = self._cached_query
+        if query is None:
+            collection, key, limit = self._cache_key()
+            query = self._cached_query = CachedQuery(self._query_cache,
+                self._cache_ttl, collection, key, limit)
+        if query.hit is not None:
+            as_class = self.as_class
+            if not isinstance(as_class, type):
+                as_class = type(as_class)
+            # hits are wrapped like the documents of misses, which copies them
+            document = wrap_nested(as_class, query.next_hit())
+            loaded = getattr(document, '_loaded', None)
+            if loaded is not None:
+                loaded()
+            return document
+        try:
+            document = self._next_result()
+        except StopIteration:
+            query.finish()
+            raise
+        query.add(document)
+        return document
+
+    def populate(self, *keys):
+        """Replace the ids in the ``Ref`` fields at ``keys`` of this cursor's
+        results with the documents they refer to.  Results are read ahead
+        ``populate_batch_size`` at a time, and the references of each batch
+        are resolved with one query per collection referred to;  see
+        ``Model.populate``."""
+        as_class = self.as_class
+        if not isinstance(as_class, type):
+            as_class = type(as_class)
+        if not hasattr(as_class, '_ref_fields'):
+            raise ValueError("can't populate %s documents, which aren't models"
+                             % as_class.__name__)
+        as_class._ref_fields(keys)
+        self._populate = (as_class, keys)
+        return self
+
+    def _next_populated(self):
+        populated = self._populated
+        if not populated:
+            next_result = self._next_result if self._query_cache is None else self._next_cached
+            documents = []
+            try:
+                while len(documents) < self.populate_batch_size:
+                    documents.append(next_result())
+            except StopIteration:
+                if not documents:
+                    raise
+            model, keys = self._populate
+            populated = self._populated = deque(model.populate(documents, *keys))
+        return populated.popleft()
+
+    def stream(self):
+        """Stream the results of this cursor without caching them.  Streamed
+        cursors can only be iterated over once."""
+        self._cachelimit = 0
+        return self
+
+    def fetch(self, count=100):
+        """Return a list of up to ``count`` results from this cursor.  An empty
+        list is returned once the cursor is exhausted."""
+        results = []
+        while len(results) < count:
+            try:
+                results.append(self.next())
+            except StopIteration:
+                break
+        return results
+
+    def afetch(self, count=100):
+        """A non-blocking ``fetch``, which returns a future for the list of
+        results.  Only one fetch should be in flight per cursor at a time.
+        See ``micromongo.futures``."""
+        return futures.submit(self.fetch, count)
+
+    def to_arrays(self, columns=None, dtypes=None, chunk_size=None):
+        """Export the remaining results of this cursor as numpy arrays, one
+        per column, without making models or caching them.  See
+        ``micromongo.columnar.to_arrays``."""
+        return columnar.to_arrays(self, columns, dtypes, chunk_size)
+
+    def to_dataframe(self, columns=None, dtypes=None, chunk_size=None):
+        """Export the remaining results of this cursor as a pandas DataFrame.
+        See ``micromongo.columnar.to_dataframe``."""
+        return columnar.to_dataframe(self, columns, dtypes, chunk_size)
+
+    def _set_document_class(self, as_class):
+        self.as_class = as_class
+
+    def _raw_documents(self):
+        """Iterate over the remaining results as plain dicts, bypassing the
+        cache.  Like a streamed cursor, the cursor can't be iterated over
+        again afterwards."""
+        self._set_document_class(dict)
+        self._cachelimit = 0
+        self._overflowed = True
+        self._itercache = []
+        timer = self._timer
+        while True:
+            try:
+                document = self._next_result()
+            except StopIteration:
+                self._exhausted = True
+                self._publish()
+                return
+            if timer is not None:
+                timer.returned += 1
+            yield document
 
     def order_by(self, *fields):
         """An alternate to ``sort`` which allows you to specify a list
@@ -108,20 +510,183 @@ class Cursor(PymongoCursor):
         return self.sort(doc)
 
     def __iter__(self):
-        if self.__fullcache and not self.__tailable:
-            return iter(self.__itercache)
+        if self._tailable():
+            return self
+        if self._fullcache:
+            return iter(self._itercache)
+        if self._exhausted and self._overflowed:
+            raise InvalidOperation("cursor results past the first %d were not "
+                "cached;  rewind the cursor or re-run the query to iterate "
+                "over it again" % self._cachelimit)
         return self
 
     def next(self):
         """A `next` that caches the returned results.  Together with the
         slightly different `__iter__`, these cursors can be iterated over
-        more than once."""
-        if self.__tailable:
-            return PymongoCursor.next(self)
+        more than once.  Cursors with a bounded cache stop caching (and drop
+        what they have cached) once they return more results than their
+        limit, and raise ``InvalidOperation`` if iterated over again."""
+        if self._tailable():
+            return self._next_result()
+        timer = self._timer
+        if timer is not None:
+            start = time.time()
         try:
-            ret = PymongoCursor.next(self)
+            if self._populate is not None:
+                ret = self._next_populated()
+            elif self._query_cache is None:
+                ret = self._next_result()
+            else:
+                ret = self._next_cached()
         except StopIteration:
-            self.__fullcache = True
+            self._exhausted = True
+            self._fullcache = not self._overflowed
+            if timer is not None:
+                timer.total += time.time() - start
+                self._publish()
             raise
-        self.__itercache.append(ret)
+        if timer is not None:
+            timer.total += time.time() - start
+            timer.returned += 1
+        if self._overflowed:
+            return ret
+        limit = self._cachelimit
+        if limit is None or len(self._itercache) < limit:
+            self._itercache.append(ret)
+        else:
+            self._overflowed = True
+            self._itercache = []
         return ret
+
+class Cursor(CursorMixin, PymongoCursor):
+    """A pymongo cursor which wraps its results via the connection's class
+    router, and caches them as described in ``CursorMixin``."""
+    def __init__(self, *args, **kwargs):
+        cache = kwargs.pop('cache', None)
+        super(Cursor, self).__init__(*args, **kwargs)
+        collection = self.__collection
+        connection = collection.database.connection
+        self.as_class = self.__as_class = connection.class_router(collection.full_name)
+        self._setup_cache(cache, connection)
+
+    def _set_document_class(self, as_class):
+        self.as_class = self.__as_class = as_class
+
+    def _tailable(self):
+        # older pymongo keeps a flag, newer ones only the query flags
+        try:
+            return self.__tailable
+        except AttributeError:
+            return bool(self.__query_flags & 2)
+
+    def _next_result(self):
+        document = PymongoCursor.next(self)
+        loaded = getattr(document, '_loaded', None)
+        if loaded is not None:
+            loaded()
+        return document
+
+    def _refresh(self):
+        timer = self._timer
+        if timer is None:
+            return PymongoCursor._refresh(self)
+        start = time.time()
+        try:
+            return PymongoCursor._refresh(self)
+        finally:
+            timer.server_time += time.time() - start
+
+    def _description(self):
+        return self.__collection.full_name, self.__spec, self.__ordering
+
+    def _cache_key(self):
+        ordering = self.__ordering
+        if ordering is not None:
+            ordering = list(ordering.items())
+        return self.__collection.full_name, hashable((self.__spec, self.__fields,
+            ordering, self.__skip, self.__limit, self.__empty)), self.__limit
+
+    def _clone_base(self):
+        # pymongo's makes one of its own cursors, which has none of ours
+        return Cursor(self.__collection)
+
+    def _clone(self, *args, **kwargs):
+        clone = PymongoCursor._clone(self, *args, **kwargs)
+        clone._set_document_class(self.as_class)
+        clone._cachelimit = self._cachelimit
+        if self._query_cache is not None:
+            clone._use_query_cache(self._query_cache, self._cache_ttl)
+        clone._populate = self._populate
+        return clone
+
+    def close(self):
+        self._publish()
+        return PymongoCursor.close(self)
+
+    def rewind(self):
+        """Rewind this cursor, dropping any cached results."""
+        self._reset_cache()
+        return PymongoCursor.rewind(self)
+
+class AggregateCursor(CursorMixin):
+    """A cursor over the results of an aggregation pipeline, with the same
+    caching and iteration behavior as ``Cursor``.  ``sort`` (and so
+    ``order_by``), ``skip`` and ``limit`` add stages to the end of the
+    pipeline, so they run on the server too;  they can only be called before
+    the cursor is iterated over.  ``run`` is called with the pipeline to
+    execute it, and returns an iterable of result documents."""
+    def __init__(self, collection, pipeline, run, as_class=dict, cache=None):
+        self.collection = collection
+        self.pipeline = list(pipeline)
+        self.as_class = as_class
+        self._run = run
+        self._results = None
+        self._setup_cache(cache, collection.database.connection)
+
+    def _add_stage(self, stage):
+        if self._results is not None:
+            raise InvalidOperation("cannot set options after executing query")
+        self.pipeline.append(stage)
+        return self
+
+    def sort(self, key_or_list, direction=None):
+        if isinstance(key_or_list, basestring):
+            key_or_list = [(key_or_list, direction or pymongo.ASCENDING)]
+        return self._add_stage({'$sort': SON(key_or_list)})
+
+    def skip(self, skip):
+        return self._add_stage({'$skip': skip})
+
+    def limit(self, limit):
+        return self._add_stage({'$limit': limit})
+
+    def _tailable(self):
+        return False
+
+    def _description(self):
+        return self.collection.full_name, {'pipeline': self.pipeline}, None
+
+    def _publish(self):
+        if self._timer is not None:
+            self._timer.finish(*self._description(), operation='aggregate')
+
+    def _next_result(self):
+        if self._results is None:
+            timer = self._timer
+            if timer is not None:
+                start = time.time()
+            self._results = iter(self._run(self.pipeline))
+            if timer is not None:
+                timer.server_time += time.time() - start
+        return wrap_document(self.as_class, next(self._results))
+
+    def rewind(self):
+        """Rewind this cursor;  the pipeline is run again when it is next
+        iterated over."""
+        self._reset_cache()
+        self._results = None
+        return self
+
+    def close(self):
+        self._publish()
+        self._results = iter(())
@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""micromongo caches"""
+
+import time
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from micromongo.utils import copy_document
+
+__all__ = ['LRUCache', 'IdentityMap', 'QueryCache']
+
+_missing = object()
+
+class LRUCache(object):
+    """A size-bounded mapping which evicts its least recently used keys
+    once it holds more than ``maxsize`` of them.  If ``ttl`` is set, keys also
+    expire ``ttl`` seconds after they are set.  This is not thread-safe;
+    callers sharing one between threads must do their own locking."""
+    def __init__(self, maxsize=1000, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = OrderedDict()
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        try:
+            expires, value = self.data.pop(key)
+        except KeyError:
+            return default
+        if expires is not None and expires < time.time():
+            self.evictions += 1
+            return default
+        # re-insert to mark this key as the most recently used
+        self.data[key] = (expires, value)
+        return value
+
+    def set(self, key, value, ttl=_missing):
+        """Set ``key`` to ``value``.  ``ttl`` overrides the cache's ttl for
+        this key only."""
+        if ttl is _missing:
+            ttl = self.ttl
+        self.data.pop(key, None)
+        self.data[key] = (time.time() + ttl if ttl else None, value)
+        while len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+            self.evictions += 1
+
+    def pop(self, key, default=None):
+        return self.data.pop(key, (None, default))[1]
+
+    def clear(self):
+        self.data.clear()
+
+    def __contains__(self, key):
+        return self.get(key, _missing) is not _missing
+
+    def __len__(self):
+        return len(self.data)
+
+
+class IdentityMap(object):
+    """A cache of documents keyed on their collection and ``_id``, used to
+    serve ``Model.find_one`` and ``Model.get`` lookups by ``_id`` without a
+    round trip to the server.  Pass one (or ``True``) to ``connect`` as the
+    ``identity_map`` keyword to enable it.
+
+    Cached documents are never shared between threads;  each thread gets its
+    own LRU store holding at most ``maxsize`` documents for at most ``ttl``
+    seconds.  ``scope()`` is a context manager which gives the current thread
+    a fresh store that is thrown away when the block exits, so wrapping each
+    request in a scope keeps documents from leaking across requests.  If
+    ``scoped`` is True, documents are only cached inside of a scope."""
+    def __init__(self, maxsize=1000, ttl=None, scoped=False):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.scoped = scoped
+        self.hits = 0
+        self.misses = 0
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def _store(self):
+        stack = getattr(self._local, 'stack', None)
+        if stack:
+            return stack[-1]
+        if self.scoped:
+            return None
+        self._local.stack = [LRUCache(self.maxsize, self.ttl)]
+        return self._local.stack[0]
+
+    @contextmanager
+    def scope(self):
+        """Cache documents in a fresh store for the duration of a block."""
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        stack.append(LRUCache(self.maxsize, self.ttl))
+        try:
+            yield self
+        finally:
+            stack.pop()
+
+    @property
+    def active(self):
+        """True if documents are being cached in the current thread."""
+        return not self.scoped or bool(getattr(self._local, 'stack', None))
+
+    def get(self, collection, _id):
+        """Return the cached document with ``_id`` in ``collection``, or
+        None if there isn't one."""
+        store = self._store()
+        document = store.get((collection, _id)) if store is not None else None
+        with self._lock:
+            if document is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return document
+
+    def put(self, collection, document):
+        """Cache ``document``, which must have an ``_id``."""
+        store = self._store()
+        if store is not None:
+            store.set((collection, document['_id']), document)
+
+    def discard(self, collection, _id):
+        store = self._store()
+        if store is not None:
+            store.pop((collection, _id))
+
+    def clear(self, collection=None):
+        """Clear the current thread's store, or only its documents in
+        ``collection`` if one is given."""
+        store = self._store()
+        if store is None:
+            return
+        if collection is None:
+            store.clear()
+        else:
+            for key in [k for k in store.data if k[0] == collection]:
+                store.pop(key)
+
+    def stats(self):
+        """Return the hit and miss counters for all threads, along with the
+        size and eviction count of the current thread's store."""
+        store = self._store()
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(store) if store is not None else 0,
+            'evictions': store.evictions if store is not None else 0,
+        }
+
+
+class QueryCache(object):
+    """A cache of the results of queries, shared by all threads.  Pass one
+    (or ``True``, for one with the default settings) to ``connect`` as the
+    ``query_cache`` keyword to enable it;  queries are then cached for
+    ``cache_ttl`` seconds if ``find`` or ``find_one`` is given a
+    ``cache_ttl`` keyword, or the model sets a ``cache_ttl`` attribute.
+
+    Results are kept as plain copies of their documents, at most ``maxsize``
+    queries of at most ``max_results`` documents each, and cursors wrap every
+    hit in new copies, so changing the documents returned can't change the
+    cache.
+    Any write to a collection through micromongo invalidates its cached
+    queries.  A query that was running while a write was made is not cached,
+    since it may have read the collection from before the write."""
+    def __init__(self, maxsize=1000, max_results=1000):
+        self.max_results = max_results
+        self.hits = 0
+        self.misses = 0
+        self._lru = LRUCache(maxsize)
+        self._generations = {}
+        self._lock = threading.Lock()
+
+    def generation(self, collection):
+        """The number of times ``collection`` has been invalidated;  results
+        are stored under the generation their query started in."""
+        return self._generations.get(collection, 0)
+
+    def get(self, collection, generation, key):
+        """Return the cached documents for the query ``key`` on
+        ``collection``, or None if there are none."""
+        with self._lock:
+            documents = self._lru.get((collection, generation, key))
+            if documents is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return documents
+
+    def put(self, collection, generation, key, documents, ttl):
+        """Cache ``documents``, which must not be changed afterwards."""
+        with self._lock:
+            # results from before an invalidation would never be read
+            if generation == self.generation(collection):
+                self._lru.set((collection, generation, key), documents, ttl)
+
+    def invalidate(self, collection):
+        """Drop the cached queries of ``collection``.  Their entries are left
+        to be evicted, rather than searched for."""
+        with self._lock:
+            self._generations[collection] = self.generation(collection) + 1
+
+    def clear(self):
+        with self._lock:
+            self._lru.clear()
+            for collection in self._generations:
+                self._generations[collection] += 1
+
+    def stats(self):
+        """Return the hit and miss counters, and the size and eviction count
+        of the cache."""
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'size': len(self._lru), 'evictions': self._lru.evictions}
+
+class CachedQuery(object):
+    """A cursor's query in a ``QueryCache``:  the cached documents if the
+    query was a hit, or the results it is collecting if it was a miss."""
+    __slots__ = ('cache', 'ttl', 'collection', 'key', 'limit', 'generation',
+                 'hit', 'position', 'results')
+
+    def __init__(self, cache, ttl, collection, key, limit=0):
+        self.cache = cache
+        self.ttl = ttl
+        self.collection = collection
+        self.key = key
+        self.limit = abs(limit)
+        self.generation = cache.generation(collection)
+        self.hit = cache.get(collection, self.generation, key)
+        self.position = 0
+        self.results = [] if self.hit is None else None
+
+    def next_hit(self):
+        """Return the next cached document, which must not be changed;
+        cursors copy it as they wrap it."""
+        if self.position >= len(self.hit):
+            raise StopIteration
+        self.position += 1
+        return self.hit[self.position - 1]
+
+    def add(self, document):
+        """Collect a result of a miss, unless there are too many to cache.
+        A query with a limit is cached once it has returned that many
+        results, since cursors like ``find_one``'s are not exhausted."""
+        if self.results is not None:
+            self.results.append(copy_document(document))
+            if len(self.results) > self.cache.max_results:
+                self.results = None
+            elif len(self.results) == self.limit:
+                self.finish()
+
+    def finish(self):
+        """Cache the results of a miss once its query is exhausted."""
+        if self.results is not None:
+            self.cache.put(self.collection, self.generation, self.key,
+                           tuple(self.results), self.ttl)
+            self.results = None
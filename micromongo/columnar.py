@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Columnar export of query results, for analytics code that wants numpy
+arrays or pandas DataFrames rather than documents::
+
+    arrays = Sale.find({'year': 2013}).to_arrays(['amount', 'day'])
+    frame = Sale.find({'year': 2013}).to_dataframe()
+
+Results are read as plain dicts straight into per-column buffers;  no models
+are made and nothing is kept in the cursor's cache.  With ``chunk_size``, a
+generator of chunks of at most that many rows is returned instead, so that
+result sets larger than memory can be processed a piece at a time.
+
+The dtype of each column comes from the type of its field in the model's
+spec:  ints are ``int64``, floats ``float64``, bools ``bool`` and datetimes
+``datetime64[ms]``;  anything else, or a column with no field, is an
+``object`` column.  Int columns with missing values become ``float64``, with
+NaN for the missing values, and bool columns with missing values ``object``.
+
+This requires numpy, and ``to_dataframe`` pandas."""
+
+from collections import OrderedDict
+from datetime import datetime
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import pandas
+except ImportError:
+    pandas = None
+
+from micromongo.spec import InstanceCheck
+from micromongo.utils import get_path
+
+__all__ = ['to_arrays', 'to_dataframe']
+
+_dtypes = [
+    (bool, 'bool'),
+    (int, 'int64'),
+    (long, 'int64'),
+    (float, 'float64'),
+    (datetime, 'datetime64[ms]'),
+]
+
+def field_dtype(field):
+    """The dtype for values of a spec ``field``, or None if they should be
+    kept as objects."""
+    check = getattr(field, '_typecheck', None)
+    if check.__class__ is not InstanceCheck:
+        return None
+    types = check.types if isinstance(check.types, tuple) else (check.types,)
+    dtypes = set()
+    for t in types:
+        for base, dtype in _dtypes:
+            if issubclass(t, base):
+                dtypes.add(dtype)
+                break
+        else:
+            return None
+    if dtypes == set(['int64', 'float64']):
+        return 'float64'
+    return dtypes.pop() if len(dtypes) == 1 else None
+
+def spec_dtypes(spec):
+    return dict((key, field_dtype(field)) for key, field in (spec or {}).iteritems())
+
+def make_array(values, dtype):
+    if dtype in ('int64', 'bool') and any(v is None for v in values):
+        dtype = 'float64' if dtype == 'int64' else None
+    if dtype is None:
+        array = numpy.empty(len(values), dtype=object)
+        array[:] = values
+        return array
+    return numpy.array(values, dtype=dtype)
+
+def document_columns(documents):
+    """The keys of ``documents`` in the order they are first seen."""
+    columns, seen = [], set()
+    for document in documents:
+        for key in document:
+            if key not in seen:
+                seen.add(key)
+                columns.append(key)
+    return columns
+
+def chunks(cursor, chunk_size):
+    """Read the results of ``cursor`` as dicts, in lists of up to
+    ``chunk_size``, bypassing its cache."""
+    chunk = []
+    for document in cursor._raw_documents():
+        chunk.append(document)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def check_numpy():
+    if numpy is None:
+        raise ImportError("micromongo's columnar export requires numpy")
+
+def to_arrays(cursor, columns=None, dtypes=None, chunk_size=None):
+    """Return the results of ``cursor`` as an ordered dict of column names
+    to numpy arrays, or with ``chunk_size``, a generator of such dicts.
+    ``columns`` are the (possibly dotted) keys to export;  by default,
+    ``_id`` and the keys of the model's spec, or with no spec, every key in
+    the results.  ``dtypes`` maps columns to dtypes, overriding those from
+    the spec."""
+    check_numpy()
+    column_dtypes = spec_dtypes(getattr(cursor.as_class, 'spec', None))
+    column_dtypes.update(dtypes or {})
+    if columns is None and column_dtypes:
+        columns = ['_id'] + sorted(k for k in column_dtypes if k != '_id')
+    if chunk_size is None:
+        documents = list(cursor._raw_documents())
+        return build_arrays(documents, columns, column_dtypes)
+    return chunked_arrays(cursor, columns, column_dtypes, chunk_size)
+
+def chunked_arrays(cursor, columns, dtypes, chunk_size):
+    for chunk in chunks(cursor, chunk_size):
+        # every chunk has the columns of the first
+        if columns is None:
+            columns = document_columns(chunk)
+        yield build_arrays(chunk, columns, dtypes)
+
+def build_arrays(documents, columns, dtypes):
+    if columns is None:
+        columns = document_columns(documents)
+    return OrderedDict((column, make_array([get_path(d, column) for d in documents],
+                                           dtypes.get(column))) for column in columns)
+
+def to_dataframe(cursor, columns=None, dtypes=None, chunk_size=None):
+    """Like ``to_arrays``, but returns a pandas DataFrame, or a generator of
+    them with ``chunk_size``."""
+    if pandas is None:
+        raise ImportError("micromongo's to_dataframe requires pandas")
+    def frame(arrays):
+        return pandas.DataFrame(arrays, columns=list(arrays))
+    result = to_arrays(cursor, columns, dtypes, chunk_size)
+    if chunk_size is None:
+        return frame(result)
+    return (frame(arrays) for arrays in result)
@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Non-blocking access to micromongo.  The blocking Model and Cursor calls are
+run in a shared thread pool, and ``concurrent.futures.Future`` objects are
+returned in their place.  These can be yielded from tornado coroutines, or
+awaited under asyncio with ``asyncio.wrap_future``.
+
+On python 2 this requires the ``futures`` backport of ``concurrent.futures``."""
+
+import threading
+
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+    ThreadPoolExecutor = None
+
+__all__ = ['executor', 'set_executor', 'submit']
+
+__executor = None
+__lock = threading.Lock()
+
+default_max_workers = 16
+
+def executor():
+    """Return the executor used to run blocking calls, creating a thread pool
+    of ``default_max_workers`` threads if none has been set."""
+    global __executor
+    if __executor is None:
+        if ThreadPoolExecutor is None:
+            raise ImportError("micromongo's futures require concurrent.futures; "
+                "install the `futures` package on python 2")
+        with __lock:
+            if __executor is None:
+                __executor = ThreadPoolExecutor(max_workers=default_max_workers)
+    return __executor
+
+def set_executor(new):
+    """Set the executor used to run blocking calls.  Any object with a
+    ``submit`` method like ``concurrent.futures.Executor.submit`` will do.
+    Returns the previous executor, which is not shut down."""
+    global __executor
+    with __lock:
+        old, __executor = __executor, new
+    return old
+
+def submit(function, *args, **kwargs):
+    """Run ``function`` with the executor, returning a future for its
+    result."""
+    return executor().submit(function, *args, **kwargs)
@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Declarative indexes for models.  A model lists the indexes it expects on
+its collection in its ``indexes`` attribute, and ``micromongo.sync_indexes``
+creates (and drops) indexes on the server to match::
+
+    class Session(Model):
+        collection = 'app.session'
+        indexes = [
+            'user',                                 # a single key
+            ('user', '-created'),                   # a compound index
+            Index('token', unique=True),
+            Index('created', expire_after=3600),    # a TTL index
+        ]
+
+Keys with a leading ``-`` are descending, as with ``Cursor.order_by``;
+``(key, direction)`` pairs are accepted as well.
+
+If ``warn_unindexed`` is set (or ``MICROMONGO_WARN_UNINDEXED`` is in the
+environment), ``Model.find`` and ``Model.find_one`` issue an
+``UnindexedQueryWarning`` for queries on a model with declared indexes when
+none of them can be used for the query.  This is meant to be turned on in
+development and tests."""
+
+import os
+import warnings
+
+import pymongo
+
+__all__ = ['Index', 'UnindexedQueryWarning']
+
+warn_unindexed = bool(os.environ.get('MICROMONGO_WARN_UNINDEXED'))
+
+class UnindexedQueryWarning(UserWarning):
+    """Issued for queries which no declared index can be used for."""
+
+def parse_key(key):
+    if isinstance(key, basestring):
+        if key.startswith('-'):
+            return (key[1:], pymongo.DESCENDING)
+        return (key, pymongo.ASCENDING)
+    field, direction = key
+    return (field, direction)
+
+class Index(object):
+    """An index declaration.  ``keys`` are field names, optionally with a
+    leading ``-``, or ``(field, direction)`` pairs.  ``expire_after`` makes
+    a TTL index which expires documents that many seconds after the date
+    in its (single) key.  Other keyword arguments, like ``background``, are
+    passed along to ``create_index``."""
+    # options which make two indexes on the same keys different
+    compared = ('unique', 'sparse', 'expireAfterSeconds')
+
+    def __init__(self, *keys, **options):
+        if not keys:
+            raise ValueError("an Index needs at least one key")
+        self.keys = [parse_key(k) for k in keys]
+        if options.pop('unique', False):
+            options['unique'] = True
+        if options.pop('sparse', False):
+            options['sparse'] = True
+        expire_after = options.pop('expire_after', None)
+        if expire_after is not None:
+            options['expireAfterSeconds'] = int(expire_after)
+        self.name = options.pop('name', None) or \
+            '_'.join('%s_%s' % (k, d) for k, d in self.keys)
+        self.options = options
+
+    @classmethod
+    def make(cls, declaration):
+        """Make an Index from an entry of a model's ``indexes``."""
+        if isinstance(declaration, Index):
+            return declaration
+        if isinstance(declaration, basestring):
+            return cls(declaration)
+        declaration = tuple(declaration)
+        # a single (field, direction) pair rather than a list of keys
+        if len(declaration) == 2 and isinstance(declaration[1], (int, long)):
+            return cls(declaration)
+        return cls(*declaration)
+
+    @property
+    def field(self):
+        """The first key of this index, which a query must use to use it."""
+        return self.keys[0][0]
+
+    def matches(self, info):
+        """True if ``info``, from ``index_information``, describes this index."""
+        keys = [(k, int(d) if isinstance(d, float) else d) for k, d in info['key']]
+        if keys != self.keys:
+            return False
+        return all(info.get(o) == self.options.get(o) for o in self.compared)
+
+    def __eq__(self, other):
+        return isinstance(other, Index) and other.keys == self.keys \
+            and other.options == self.options
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return '<Index %s %r>' % (self.name, self.options)
+
+def diff(declared, existing):
+    """Compare the ``declared`` Indexes of a collection with its
+    ``existing`` index information, returning a list of Indexes to create
+    and a list of the names of existing indexes which are not declared."""
+    create, keep = [], set(['_id_'])
+    for index in declared:
+        for name, info in existing.iteritems():
+            if index.matches(info):
+                keep.add(name)
+                break
+        else:
+            create.append(index)
+    return create, [name for name in existing if name not in keep]
+
+def query_fields(spec):
+    """Return a list of sets of the fields used by a query;  each of them
+    must be indexed for the query to use an index.  Every branch of an
+    ``$or`` is a separate query."""
+    fields, branches = set(), []
+    for key, value in spec.iteritems():
+        if key == '$and':
+            for clause in value:
+                for sub in query_fields(clause):
+                    fields |= sub
+        elif key == '$or':
+            branches.extend(b for clause in value for b in query_fields(clause))
+        elif not key.startswith('$'):
+            fields.add(key)
+    if not branches:
+        return [fields]
+    return [fields | b for b in branches]
+
+def check_query(model, declared, spec):
+    """Warn if none of the ``declared`` indexes of ``model`` can be used for
+    the query ``spec``."""
+    if not isinstance(spec, dict) or not spec:
+        return
+    usable = set(['_id']) | set(index.field for index in declared)
+    for fields in query_fields(spec):
+        if not fields & usable:
+            warnings.warn("query on %s uses no declared index: %s" % (
+                model._collection_key, ', '.join(sorted(fields))),
+                UnindexedQueryWarning, stacklevel=4)
+            return
@@ -0,0 +1,1371 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""An in-memory stand-in for mongodb, with the same interface as the classes
+in ``micromongo.backend``.  It is selected by connecting to a ``mem://`` uri::
+
+    >>> from micromongo import connect
+    >>> c = connect('mem://')
+
+All ``mem://`` connections in a process share the same data, like connections
+to the same server would;  ``mem://name`` gives a separate, named server.
+Documents are copied going in and coming out, and results are wrapped by the
+class router just like they are by micromongo's regular cursors.
+
+A connection made with ``secondary='mem://other'`` stands in for a replica
+set:  reads with a secondary, secondary preferred or nearest read preference
+(or ``slave_okay``) go to the named server instead, and everything else to
+its own.  Nothing is replicated between them, so tests can tell which one
+served a read.
+
+It supports ``find`` with the common query operators, sorting, skip and
+limit, projections, ``insert``, ``save``, ``update`` with the common update
+modifiers, ``remove``, and simple secondary indexes which are used to look
+up candidate documents for equality and ``$in`` queries instead of scanning
+the collection.  ``aggregate`` runs pipelines with the common stages,
+accumulators and expression operators in python, and ``group`` takes python
+functions where mongodb would run javascript.  Capped collections made with
+``create_collection`` keep their newest ``max`` documents, and can be read
+with tailable cursors.  It is meant for tests and local tooling, not as a database;
+everything is kept in memory and lost when the process exits."""
+
+import re
+import time
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime
+
+import pymongo
+from bson.objectid import ObjectId
+from pymongo.errors import DuplicateKeyError, OperationFailure, InvalidOperation, \
+    CollectionInvalid
+try:
+    from pymongo import ReadPreference
+except ImportError:
+    ReadPreference = None
+
+from micromongo.backend import CursorMixin, AggregateCursor, PoolStats, \
+    default_class_router, routed_class, invalidating, wrap_nested
+from micromongo.utils import copy_document, hashable, get_path
+
+__all__ = ['Connection', 'Database', 'Collection', 'Cursor', 'is_memory_uri']
+
+__servers = {}
+__servers_lock = threading.Lock()
+
+# the read preferences which a secondary may serve
+if ReadPreference is not None:
+    secondary_reads = (ReadPreference.SECONDARY, ReadPreference.SECONDARY_PREFERRED,
+                       ReadPreference.NEAREST)
+else:
+    secondary_reads = ()
+
+def is_memory_uri(uri):
+    """True if ``uri`` selects the in-memory backend."""
+    return isinstance(uri, basestring) and uri.startswith('mem://')
+
+def server_name(uri):
+    return uri[len('mem://'):].strip('/')
+
+def server(name=''):
+    """Return the data of the in-memory server called ``name``."""
+    with __servers_lock:
+        if name not in __servers:
+            __servers[name] = Server(name)
+        return __servers[name]
+
+class Server(object):
+    """The databases of one in-memory server, and the lock that serializes
+    all access to them."""
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.RLock()
+        self.databases = {}
+
+    def store(self, database, collection):
+        with self.lock:
+            db = self.databases.setdefault(database, {})
+            if collection not in db:
+                db[collection] = Store(self.lock)
+            return db[collection]
+
+
+# -- documents -------------------------------------------------------------
+
+def resolve(document, path):
+    """Return the list of values at the dotted ``path`` in ``document``;
+    arrays along the way are traversed like mongodb does."""
+    values = [document]
+    for part in path.split('.'):
+        found = []
+        for value in values:
+            if isinstance(value, dict):
+                if part in value:
+                    found.append(value[part])
+            elif isinstance(value, list):
+                if part.isdigit():
+                    if int(part) < len(value):
+                        found.append(value[int(part)])
+                else:
+                    found.extend([v[part] for v in value
+                        if isinstance(v, dict) and part in v])
+        values = found
+    return values
+
+def set_path(document, path, value):
+    parts = path.split('.')
+    for part in parts[:-1]:
+        if isinstance(document, list) and part.isdigit():
+            document = document[int(part)]
+        else:
+            document = document.setdefault(part, {})
+    last = parts[-1]
+    if isinstance(document, list) and last.isdigit():
+        index = int(last)
+        document.extend([None] * (index + 1 - len(document)))
+        document[index] = value
+    elif isinstance(document, dict):
+        document[last] = value
+    else:
+        raise OperationFailure("cannot set field %r in a non-document" % path)
+
+def unset_path(document, path):
+    parts = path.split('.')
+    parent = get_path(document, '.'.join(parts[:-1])) if len(parts) > 1 else document
+    if isinstance(parent, dict):
+        parent.pop(parts[-1], None)
+    elif isinstance(parent, list) and parts[-1].isdigit() and int(parts[-1]) < len(parent):
+        parent[int(parts[-1])] = None
+
+
+# -- comparison & matching -------------------------------------------------
+
+_numbers = (int, long, float)
+_pattern = type(re.compile(''))
+
+def sort_class(value):
+    """The position of a value's type in mongodb's sort order."""
+    if value is None: return 1
+    if isinstance(value, bool): return 8
+    if isinstance(value, _numbers): return 2
+    if isinstance(value, basestring): return 3
+    if isinstance(value, dict): return 4
+    if isinstance(value, list): return 5
+    if isinstance(value, ObjectId): return 7
+    if isinstance(value, datetime): return 9
+    if isinstance(value, _pattern): return 11
+    return 6
+
+def sort_key(value):
+    return (sort_class(value), value)
+
+def equal(a, b):
+    if isinstance(a, bool) != isinstance(b, bool):
+        return False
+    return a == b
+
+def comparable(a, b):
+    return sort_class(a) == sort_class(b)
+
+def expand(values):
+    """The values a condition is tested against:  each value, and the
+    elements of each array value."""
+    for value in values:
+        yield value
+        if isinstance(value, list):
+            for item in value:
+                yield item
+
+def matches_value(condition, value):
+    if isinstance(condition, _pattern):
+        return isinstance(value, basestring) and bool(condition.search(value))
+    return equal(condition, value)
+
+def is_operator_doc(condition):
+    return isinstance(condition, dict) and condition and \
+        all(isinstance(k, basestring) and k.startswith('$') for k in condition)
+
+def match_condition(values, condition):
+    """Test the values at some path against a query condition."""
+    if not is_operator_doc(condition):
+        if condition is None and not values:
+            return True
+        return any(matches_value(condition, v) for v in expand(values))
+    for op, arg in condition.iteritems():
+        if op == '$eq':
+            ok = match_condition(values, arg) if not is_operator_doc(arg) else \
+                any(equal(arg, v) for v in expand(values))
+        elif op == '$ne':
+            ok = not match_condition(values, {'$eq': arg})
+        elif op in ('$gt', '$gte', '$lt', '$lte'):
+            ok = any(comparable(v, arg) and _compare[op](v, arg) for v in expand(values))
+        elif op == '$in':
+            ok = any(match_condition(values, item) for item in arg)
+        elif op == '$nin':
+            ok = not any(match_condition(values, item) for item in arg)
+        elif op == '$exists':
+            ok = bool(values) == bool(arg)
+        elif op == '$all':
+            ok = all(match_condition(values, item) for item in arg)
+        elif op == '$size':
+            ok = any(isinstance(v, list) and len(v) == arg for v in values)
+        elif op == '$elemMatch':
+            ok = any(isinstance(v, list) and any(match_element(item, arg) for item in v)
+                     for v in values)
+        elif op == '$not':
+            ok = not match_condition(values, arg)
+        elif op == '$regex':
+            pattern = arg
+            if not isinstance(pattern, _pattern):
+                flags = 0
+                for option in condition.get('$options', ''):
+                    flags |= {'i': re.I, 'm': re.M, 's': re.S, 'x': re.X}.get(option, 0)
+                pattern = re.compile(pattern, flags)
+            ok = any(matches_value(pattern, v) for v in expand(values))
+        elif op == '$options':
+            continue
+        elif op == '$mod':
+            divisor, remainder = arg
+            ok = any(isinstance(v, _numbers) and not isinstance(v, bool)
+                     and v % divisor == remainder for v in expand(values))
+        else:
+            raise OperationFailure("unsupported query operator %r" % op)
+        if not ok:
+            return False
+    return True
+
+_compare = {
+    '$gt': lambda a, b: a > b,
+    '$gte': lambda a, b: a >= b,
+    '$lt': lambda a, b: a < b,
+    '$lte': lambda a, b: a <= b,
+}
+
+# _id values which the _id index only finds equal documents for
+_exact_types = (int, long, float, basestring, ObjectId)
+
+def exact_id_spec(spec):
+    """Whether ``spec`` only looks documents up by ``_id`` values that the
+    _id index matches exactly, so its candidates don't have to be matched."""
+    if len(spec) != 1 or '_id' not in spec:
+        return False
+    condition = spec['_id']
+    if is_operator_doc(condition):
+        if condition.keys() != ['$in']:
+            return False
+        values = condition['$in']
+    else:
+        values = [condition]
+    return all(isinstance(v, _exact_types) and not isinstance(v, bool) for v in values)
+
+def match_element(element, condition):
+    if is_operator_doc(condition):
+        return match_condition([element], condition)
+    return isinstance(element, dict) and match(element, condition)
+
+def match(document, spec):
+    """True if ``document`` matches the query ``spec``."""
+    for key, condition in spec.iteritems():
+        if key == '$and':
+            if not all(match(document, s) for s in condition):
+                return False
+        elif key == '$or':
+            if not any(match(document, s) for s in condition):
+                return False
+        elif key == '$nor':
+            if any(match(document, s) for s in condition):
+                return False
+        elif key.startswith('$'):
+            raise OperationFailure("unsupported query operator %r" % key)
+        elif not match_condition(resolve(document, key), condition):
+            return False
+    return True
+
+
+# -- updates ---------------------------------------------------------------
+
+def apply_update(document, update, inserting=False):
+    """Apply the modifiers in ``update`` to ``document`` in place."""
+    for op, fields in update.iteritems():
+        if op == '$setOnInsert' and not inserting:
+            continue
+        for path, arg in fields.iteritems():
+            if path == '_id' and op not in ('$set', '$setOnInsert') or \
+                    path == '_id' and arg != document.get('_id', arg):
+                raise OperationFailure("the _id of a document cannot be modified")
+            _modifiers.get(op, _unknown_modifier)(document, path, copy_document(arg), op)
+
+def _unknown_modifier(document, path, arg, op):
+    raise OperationFailure("unsupported update modifier %r" % op)
+
+def _set(document, path, arg, op):
+    set_path(document, path, arg)
+
+def _unset(document, path, arg, op):
+    unset_path(document, path)
+
+def _inc(document, path, arg, op):
+    current = get_path(document, path, 0)
+    if not isinstance(current, _numbers) or not isinstance(arg, _numbers):
+        raise OperationFailure("cannot $inc a non-numeric value at %r" % path)
+    set_path(document, path, current + arg)
+
+def _array(document, path):
+    current = get_path(document, path)
+    if current is None:
+        current = []
+        set_path(document, path, current)
+    elif not isinstance(current, list):
+        raise OperationFailure("cannot apply an array modifier to non-array %r" % path)
+    return current
+
+def _each(arg, op):
+    if op in ('$pushAll', '$pullAll'):
+        return arg
+    if isinstance(arg, dict) and '$each' in arg:
+        return arg['$each']
+    return [arg]
+
+def _push(document, path, arg, op):
+    _array(document, path).extend(_each(arg, op))
+
+def _add_to_set(document, path, arg, op):
+    array = _array(document, path)
+    for value in _each(arg, op):
+        if not any(equal(value, v) for v in array):
+            array.append(value)
+
+def _pull(document, path, arg, op):
+    array = get_path(document, path)
+    if not isinstance(array, list):
+        return
+    if op == '$pullAll':
+        keep = [v for v in array if not any(equal(v, a) for a in arg)]
+    else:
+        keep = [v for v in array if not (match_element(v, arg) if isinstance(arg, dict)
+                                         else equal(v, arg))]
+    array[:] = keep
+
+def _pop(document, path, arg, op):
+    array = get_path(document, path)
+    if isinstance(array, list) and array:
+        array.pop(0 if arg < 0 else -1)
+
+def _rename(document, path, arg, op):
+    missing = object()
+    value = get_path(document, path, missing)
+    if value is not missing:
+        unset_path(document, path)
+        set_path(document, arg, value)
+
+_modifiers = {
+    '$set': _set, '$setOnInsert': _set, '$unset': _unset, '$inc': _inc,
+    '$push': _push, '$pushAll': _push, '$addToSet': _add_to_set,
+    '$pull': _pull, '$pullAll': _pull, '$pop': _pop, '$rename': _rename,
+}
+
+def upsert_document(spec):
+    """The document an upsert starts from: the equality conditions in its
+    query."""
+    document = {}
+    for key, condition in spec.iteritems():
+        if not key.startswith('$') and not is_operator_doc(condition):
+            set_path(document, key, copy_document(condition))
+    return document
+
+
+# -- projection & sorting --------------------------------------------------
+
+def project(document, fields):
+    """Apply a projection, given as a list of fields to include or a dict of
+    fields to include or exclude, to ``document``."""
+    if fields is None:
+        return document
+    if not isinstance(fields, dict):
+        fields = dict((f, 1) for f in fields)
+    include_id = fields.get('_id', 1)
+    includes = [k for k, v in fields.iteritems() if v and k != '_id']
+    if includes:
+        result = {}
+        missing = object()
+        for path in includes:
+            value = get_path(document, path, missing)
+            if value is not missing:
+                set_path(result, path, value)
+    else:
+        result = dict(document)
+        for path, v in fields.iteritems():
+            if not v and path != '_id':
+                unset_path(result, path)
+    if include_id and '_id' in document:
+        result['_id'] = document['_id']
+    else:
+        result.pop('_id', None)
+    return result
+
+def normalize_sort(key_or_list, direction=None):
+    if isinstance(key_or_list, basestring):
+        return [(key_or_list, direction or pymongo.ASCENDING)]
+    return list(key_or_list)
+
+def sort_documents(documents, sort):
+    for key, direction in reversed(sort):
+        documents.sort(key=lambda d: sort_key(get_path(d, key)),
+                       reverse=direction == pymongo.DESCENDING)
+    return documents
+
+# -- aggregation -----------------------------------------------------------
+
+_missing = object()
+
+def truthy(value):
+    """Truth in aggregation expressions:  only false, null and zero are false."""
+    if value is None or value is False or value is _missing:
+        return False
+    if isinstance(value, _numbers) and not isinstance(value, bool):
+        return value != 0
+    return True
+
+def field_value(document, path):
+    value = get_path(document, path, _missing)
+    if value is _missing:
+        # paths through arrays of subdocuments give the array of their values
+        values = resolve(document, path)
+        return values if values else _missing
+    return value
+
+def evaluate(document, expression):
+    """Evaluate an aggregation ``expression`` against ``document``.  Missing
+    fields evaluate to ``_missing``, which accumulators and stages skip."""
+    if isinstance(expression, basestring) and expression.startswith('$'):
+        if expression in ('$$ROOT', '$$CURRENT'):
+            return document
+        return field_value(document, expression[1:])
+    if isinstance(expression, list):
+        return [evaluate(document, e) for e in expression]
+    if not isinstance(expression, dict):
+        return expression
+    if len(expression) == 1 and expression.keys()[0].startswith('$'):
+        (op, args), = expression.items()
+        if op == '$literal':
+            return args
+        if op == '$cond':
+            if isinstance(args, dict):
+                args = [args.get('if'), args.get('then'), args.get('else')]
+            condition, then, otherwise = args
+            return evaluate(document, then if truthy(evaluate(document, condition))
+                            else otherwise)
+        if op not in _operators:
+            raise OperationFailure("unsupported aggregation operator %r" % op)
+        if not isinstance(args, list):
+            args = [args]
+        args = [evaluate(document, a) for a in args]
+        return _operators[op](*[None if a is _missing else a for a in args])
+    result = {}
+    for key, value in expression.iteritems():
+        value = evaluate(document, value)
+        if value is not _missing:
+            result[key] = value
+    return result
+
+def _arithmetic(function):
+    def operator(*args):
+        if any(a is None for a in args):
+            return None
+        return function(*args)
+    return operator
+
+def _divide(a, b):
+    if isinstance(a, (int, long)) and isinstance(b, (int, long)):
+        return float(a) / b
+    return a / b
+
+def _compare_values(a, b):
+    return cmp(sort_key(a), sort_key(b))
+
+def _date_part(function):
+    def operator(date):
+        if not isinstance(date, datetime):
+            raise OperationFailure("can't take a date part of %r" % (date,))
+        return function(date)
+    return operator
+
+_operators = {
+    '$add': _arithmetic(lambda *args: sum(args[1:], args[0])),
+    '$subtract': _arithmetic(lambda a, b: a - b),
+    '$multiply': _arithmetic(lambda *args: reduce(lambda a, b: a * b, args)),
+    '$divide': _arithmetic(_divide),
+    '$mod': _arithmetic(lambda a, b: a % b),
+    '$concat': lambda *args: None if any(a is None for a in args) else ''.join(args),
+    '$toLower': lambda s: (s or '').lower(),
+    '$toUpper': lambda s: (s or '').upper(),
+    '$substr': lambda s, start, length: (s or '')[start:] if length < 0 \
+        else (s or '')[start:start + length],
+    '$ifNull': lambda value, default: default if value is None else value,
+    '$size': lambda array: len(array),
+    '$cmp': _compare_values,
+    '$eq': lambda a, b: _compare_values(a, b) == 0,
+    '$ne': lambda a, b: _compare_values(a, b) != 0,
+    '$gt': lambda a, b: _compare_values(a, b) > 0,
+    '$gte': lambda a, b: _compare_values(a, b) >= 0,
+    '$lt': lambda a, b: _compare_values(a, b) < 0,
+    '$lte': lambda a, b: _compare_values(a, b) <= 0,
+    '$and': lambda *args: all(truthy(a) for a in args),
+    '$or': lambda *args: any(truthy(a) for a in args),
+    '$not': lambda a: not truthy(a),
+    '$year': _date_part(lambda d: d.year),
+    '$month': _date_part(lambda d: d.month),
+    '$dayOfMonth': _date_part(lambda d: d.day),
+    '$dayOfWeek': _date_part(lambda d: d.isoweekday() % 7 + 1),
+    '$dayOfYear': _date_part(lambda d: d.timetuple().tm_yday),
+    '$hour': _date_part(lambda d: d.hour),
+    '$minute': _date_part(lambda d: d.minute),
+    '$second': _date_part(lambda d: d.second),
+}
+
+def _sum(values):
+    return sum(v for v in values if isinstance(v, _numbers) and not isinstance(v, bool))
+
+def _avg(values):
+    numbers = [v for v in values if isinstance(v, _numbers) and not isinstance(v, bool)]
+    return float(sum(numbers)) / len(numbers) if numbers else None
+
+def _extreme(choose):
+    def accumulator(values):
+        values = [v for v in values if v is not None and v is not _missing]
+        return choose(values, key=sort_key) if values else None
+    return accumulator
+
+def _add_to_set_values(values):
+    result = []
+    for value in values:
+        if value is not _missing and not any(equal(value, v) for v in result):
+            result.append(value)
+    return result
+
+# accumulators take the list of values of their expression in a group
+_accumulators = {
+    '$sum': _sum,
+    '$avg': _avg,
+    '$min': _extreme(min),
+    '$max': _extreme(max),
+    '$first': lambda values: None if values[0] is _missing else values[0],
+    '$last': lambda values: None if values[-1] is _missing else values[-1],
+    '$push': lambda values: [v for v in values if v is not _missing],
+    '$addToSet': _add_to_set_values,
+}
+
+def _match_stage(documents, spec, collection):
+    return [d for d in documents if match(d, spec)]
+
+def _project_stage(documents, spec, collection):
+    computed = dict((k, v) for k, v in spec.iteritems()
+                    if not isinstance(v, (bool, int, long)))
+    included = [k for k, v in spec.iteritems() if k not in computed and v]
+    if not computed and not included:
+        return [project(d, spec) for d in documents]
+    results = []
+    for document in documents:
+        result = {}
+        for path in included:
+            value = get_path(document, path, _missing)
+            if value is not _missing:
+                set_path(result, path, value)
+        if spec.get('_id', 1) and '_id' in document and '_id' not in computed:
+            result['_id'] = document['_id']
+        for key, expression in computed.iteritems():
+            value = evaluate(document, expression)
+            if value is not _missing:
+                set_path(result, key, value)
+        results.append(result)
+    return results
+
+def _add_fields_stage(documents, spec, collection):
+    for document in documents:
+        for key, expression in spec.iteritems():
+            value = evaluate(document, expression)
+            if value is not _missing:
+                set_path(document, key, value)
+    return documents
+
+def _group_stage(documents, spec, collection):
+    if '_id' not in spec:
+        raise OperationFailure("a $group specification must include an _id")
+    fields = []
+    for key, accumulator in spec.iteritems():
+        if key == '_id':
+            continue
+        if not isinstance(accumulator, dict) or len(accumulator) != 1:
+            raise OperationFailure("the group field %r must be an accumulator" % key)
+        (op, expression), = accumulator.items()
+        if op not in _accumulators:
+            raise OperationFailure("unsupported group accumulator %r" % op)
+        fields.append((key, _accumulators[op], expression))
+    groups = OrderedDict()
+    for document in documents:
+        _id = evaluate(document, spec['_id'])
+        if _id is _missing:
+            _id = None
+        group = groups.get(hashable(_id))
+        if group is None:
+            group = groups[hashable(_id)] = (_id, [[] for f in fields])
+        for (key, accumulator, expression), values in zip(fields, group[1]):
+            values.append(evaluate(document, expression))
+    results = []
+    for _id, values in groups.itervalues():
+        result = {'_id': _id}
+        for (key, accumulator, expression), field_values in zip(fields, values):
+            result[key] = accumulator(field_values)
+        results.append(result)
+    return results
+
+def _sort_stage(documents, spec, collection):
+    return sort_documents(documents, normalize_sort(spec.items()))
+
+def _skip_stage(documents, skip, collection):
+    return documents[skip:]
+
+def _limit_stage(documents, limit, collection):
+    return documents[:limit]
+
+def _unwind_stage(documents, spec, collection):
+    if not isinstance(spec, dict):
+        spec = {'path': spec}
+    path = spec['path'].lstrip('$')
+    index_field = spec.get('includeArrayIndex')
+    preserve = spec.get('preserveNullAndEmptyArrays', False)
+    results = []
+    for document in documents:
+        array = get_path(document, path, _missing)
+        if not isinstance(array, list):
+            if array is not _missing and array is not None:
+                array = [array]
+            elif preserve:
+                results.append(document)
+                continue
+            else:
+                continue
+        if not array and preserve:
+            unset_path(document, path)
+            results.append(document)
+        for i, value in enumerate(array):
+            unwound = copy_document(document)
+            set_path(unwound, path, value)
+            if index_field:
+                unwound[index_field] = i
+            results.append(unwound)
+    return results
+
+def _count_stage(documents, name, collection):
+    return [{name: len(documents)}] if documents else []
+
+def _out_stage(documents, name, collection):
+    out = collection.database[name]
+    with out.store.lock:
+        out.store.clear()
+        for document in documents:
+            document.setdefault('_id', ObjectId())
+            out.store.insert(document)
+    return []
+
+_stages = {
+    '$match': _match_stage, '$project': _project_stage,
+    '$addFields': _add_fields_stage, '$group': _group_stage,
+    '$sort': _sort_stage, '$skip': _skip_stage, '$limit': _limit_stage,
+    '$unwind': _unwind_stage, '$count': _count_stage, '$out': _out_stage,
+}
+
+def run_pipeline(collection, pipeline):
+    """Run an aggregation ``pipeline`` on ``collection``, returning a list of
+    the resulting documents.  A leading ``$match`` uses the collection's
+    indexes like a query does;  later stages work on copies of the matched
+    documents, so they can't change the collection."""
+    stages = list(pipeline)
+    for stage in stages:
+        if not isinstance(stage, dict) or len(stage) != 1:
+            raise OperationFailure("a pipeline stage must be a document with one field")
+        if stage.keys()[0] not in _stages:
+            raise OperationFailure("unsupported pipeline stage %r" % stage.keys()[0])
+    spec = stages.pop(0)['$match'] if stages and '$match' in stages[0] else {}
+    store = collection.store
+    with store.lock:
+        documents = [copy_document(d) for d in store.candidates(spec) if match(d, spec)]
+    for stage in stages:
+        (name, arg), = stage.items()
+        documents = _stages[name](documents, arg, collection)
+    return documents
+
+def group_documents(documents, key, initial, reduce, finalize=None):
+    """The in-memory ``Collection.group``, with ``reduce`` and ``finalize``
+    given as python functions rather than javascript."""
+    if isinstance(reduce, basestring) or isinstance(key, basestring) or \
+            isinstance(finalize, basestring):
+        raise OperationFailure("the in-memory backend can't run javascript;  "
+                               "pass python functions to group")
+    if isinstance(key, dict):
+        key = [k for k, v in key.iteritems() if v]
+    groups = OrderedDict()
+    for document in documents:
+        values = dict((k, get_path(document, k)) for k in key or [])
+        group = groups.get(hashable(values))
+        if group is None:
+            group = groups[hashable(values)] = dict(values, **copy_document(initial))
+        reduce(document, group)
+    results = groups.values()
+    if finalize is not None:
+        results = [finalize(r) or r for r in results]
+    return results
+
+
+# -- storage ---------------------------------------------------------------
+
+def index_name(keys):
+    return '_'.join('%s_%s' % (k, d) for k, d in keys)
+
+class Index(object):
+    """A secondary index on one or more keys.  Documents are looked up by the
+    value of the first key;  array values are indexed by each of their
+    elements, and documents missing the key by None."""
+    def __init__(self, keys, unique=False, sparse=False, **options):
+        self.keys = keys
+        self.field = keys[0][0]
+        self.unique = unique
+        self.sparse = sparse
+        self.options = options
+        self.entries = {}
+        self.unique_entries = {}
+
+    def info(self):
+        info = {'key': list(self.keys)}
+        if self.unique: info['unique'] = True
+        if self.sparse: info['sparse'] = True
+        info.update(self.options)
+        return info
+
+    def values(self, document):
+        values = resolve(document, self.field)
+        if not values:
+            return [] if self.sparse else [None]
+        return set(hashable(v) for v in expand(values))
+
+    def unique_key(self, document):
+        values = [get_path(document, k) for k, d in self.keys]
+        if self.sparse and all(v is None for v in values):
+            return None
+        return tuple(hashable(v) for v in values)
+
+    def check(self, document):
+        if self.unique:
+            key = self.unique_key(document)
+            other = self.unique_entries.get(key)
+            if key is not None and other is not None and other != hashable(document['_id']):
+                raise DuplicateKeyError("E11000 duplicate key error index: %s "
+                    "dup key: %r" % (index_name(self.keys), key))
+
+    def add(self, document):
+        _id = hashable(document['_id'])
+        for value in self.values(document):
+            self.entries.setdefault(value, set()).add(_id)
+        if self.unique:
+            key = self.unique_key(document)
+            if key is not None:
+                self.unique_entries[key] = _id
+
+    def remove(self, document):
+        _id = hashable(document['_id'])
+        for value in self.values(document):
+            ids = self.entries.get(value)
+            if ids is not None:
+                ids.discard(_id)
+                if not ids:
+                    del self.entries[value]
+        if self.unique:
+            self.unique_entries.pop(self.unique_key(document), None)
+
+    def lookup(self, condition):
+        """Return the _ids of documents that may match ``condition`` on this
+        index's first key, or None if the index can't narrow it down."""
+        if is_operator_doc(condition):
+            if condition.keys() == ['$eq']:
+                condition = condition['$eq']
+            elif condition.keys() == ['$in']:
+                ids = set()
+                for item in condition['$in']:
+                    found = self.lookup(item)
+                    if found is None:
+                        return None
+                    ids |= found
+                return ids
+            else:
+                return None
+        if isinstance(condition, (dict, _pattern)):
+            return None
+        if condition is None and self.sparse:
+            return None
+        return set(self.entries.get(hashable(condition), ()))
+
+class Store(object):
+    """The documents and indexes of one collection.  Documents are kept in
+    the order they were inserted, which is the order they are found in."""
+    def __init__(self, lock):
+        self.lock = lock
+        self.documents = OrderedDict()
+        self.positions = {}
+        self.inserted = 0
+        self.indexes = {}
+        self.options = {}
+
+    def candidates(self, spec):
+        """Return the documents that may match ``spec``, using the _id and
+        secondary indexes where they can narrow the search down."""
+        if not spec:
+            return self.documents.values()
+        if '_id' in spec:
+            condition = spec['_id']
+            if is_operator_doc(condition) and condition.keys() == ['$in']:
+                ids = set(hashable(i) for i in condition['$in'])
+                return [self.documents[i] for i in sorted(ids, key=self.positions.get)
+                        if i in self.documents]
+            if not is_operator_doc(condition) and not isinstance(condition, _pattern):
+                document = self.documents.get(hashable(condition))
+                return [document] if document is not None else []
+        best = None
+        for index in self.indexes.itervalues():
+            if index.field in spec:
+                ids = index.lookup(spec[index.field])
+                if ids is not None and (best is None or len(ids) < len(best)):
+                    best = ids
+        if best is None:
+            return self.documents.values()
+        return [self.documents[i] for i in sorted(best, key=self.positions.get)
+                if i in self.documents]
+
+    def insert(self, document):
+        key = hashable(document['_id'])
+        if key in self.documents:
+            raise DuplicateKeyError("E11000 duplicate key error index: _id_ "
+                "dup key: %r" % (document['_id'],))
+        for index in self.indexes.itervalues():
+            index.check(document)
+        for index in self.indexes.itervalues():
+            index.add(document)
+        self.documents[key] = document
+        self.positions[key] = self.inserted
+        self.inserted += 1
+        limit = self.options.get('max')
+        if limit and self.options.get('capped'):
+            while len(self.documents) > limit:
+                self.remove(next(self.documents.itervalues()))
+
+    def replace(self, old, new):
+        for index in self.indexes.itervalues():
+            index.check(new)
+        for index in self.indexes.itervalues():
+            index.remove(old)
+            index.add(new)
+        self.documents[hashable(new['_id'])] = new
+
+    def remove(self, document):
+        for index in self.indexes.itervalues():
+            index.remove(document)
+        key = hashable(document['_id'])
+        del self.documents[key]
+        del self.positions[key]
+
+    def clear(self):
+        self.documents.clear()
+        self.positions.clear()
+        for index in self.indexes.itervalues():
+            index.entries.clear()
+            index.unique_entries.clear()
+
+
+# -- pymongo-like interface ------------------------------------------------
+
+class Connection(object):
+    """An in-memory stand-in for ``micromongo.backend.Connection``."""
+    max_pool_size = None
+
+    def __init__(self, host='mem://', port=None, **kwargs):
+        self.host = host
+        self.class_router = kwargs.pop('class_router', default_class_router)
+        self.cursor_cache = kwargs.pop('cursor_cache', True)
+        self.identity_map = kwargs.pop('identity_map', None)
+        self.query_cache = kwargs.pop('query_cache', None)
+        self.max_pool_size = kwargs.pop('max_pool_size', None)
+        self.socket_stats = PoolStats()
+        self.server = server(server_name(host))
+        secondary = kwargs.pop('secondary', None)
+        self.secondary = server(server_name(secondary)) if secondary else None
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return Database(self, name)
+
+    def __getitem__(self, name):
+        return Database(self, name)
+
+    def database_names(self):
+        with self.server.lock:
+            return self.server.databases.keys()
+
+    def drop_database(self, name_or_database):
+        name = getattr(name_or_database, 'name', name_or_database)
+        with self.server.lock:
+            for store in self.server.databases.get(name, {}).itervalues():
+                store.clear()
+            self.server.databases.pop(name, None)
+        if self.query_cache is not None:
+            self.query_cache.clear()
+
+    def pool_stats(self):
+        stats = self.socket_stats.snapshot()
+        stats['max_size'] = self.max_pool_size
+        return stats
+
+    def start_request(self):
+        return self
+
+    def end_request(self):
+        pass
+
+    @contextmanager
+    def request(self):
+        yield self
+
+    def close(self):
+        pass
+    disconnect = close
+
+class Database(object):
+    def __init__(self, connection, name):
+        self.connection = connection
+        self.name = name
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return Collection(self, name)
+
+    def __getitem__(self, name):
+        return Collection(self, name)
+
+    def __eq__(self, other):
+        return isinstance(other, Database) and other.name == self.name \
+            and other.connection.server is self.connection.server
+
+    def collection_names(self):
+        server = self.connection.server
+        with server.lock:
+            return server.databases.get(self.name, {}).keys()
+
+    def create_collection(self, name, **kwargs):
+        """Create a collection, which may be capped with ``capped`` and
+        ``max``;  ``size`` is kept as an option, but not enforced."""
+        server = self.connection.server
+        with server.lock:
+            if name in server.databases.get(self.name, {}):
+                raise CollectionInvalid("collection %s already exists" % name)
+            store = server.store(self.name, name)
+            store.options = dict((k, v) for k, v in kwargs.iteritems()
+                                 if k in ('capped', 'size', 'max'))
+        return Collection(self, name)
+
+    def drop_collection(self, name_or_collection):
+        name = getattr(name_or_collection, 'name', name_or_collection)
+        server = self.connection.server
+        with server.lock:
+            store = server.databases.get(self.name, {}).pop(name, None)
+            if store is not None:
+                store.clear()
+        query_cache = self.connection.query_cache
+        if query_cache is not None:
+            query_cache.invalidate('%s.%s' % (self.name, name))
+
+class Collection(object):
+    def __init__(self, database, name):
+        self.database = database
+        self.name = name
+        self.full_name = '%s.%s' % (database.name, name)
+
+    @property
+    def store(self):
+        # looked up every time, since the collection may have been dropped
+        return self.database.connection.server.store(self.database.name, self.name)
+
+    def read_store(self, read_preference=None, slave_okay=False):
+        """The store that serves reads with ``read_preference``:  the one on
+        the connection's secondary, if it has one and the read may use it."""
+        secondary = self.database.connection.secondary
+        if secondary is not None and (slave_okay or read_preference in secondary_reads):
+            return secondary.store(self.database.name, self.name)
+        return self.store
+
+    def __getitem__(self, name):
+        return Collection(self.database, '%s.%s' % (self.name, name))
+
+    def __eq__(self, other):
+        return isinstance(other, Collection) and other.store is self.store
+
+    def find(self, *args, **kwargs):
+        ttl = kwargs.pop('cache_ttl', None)
+        cursor = Cursor(self, *args, **kwargs)
+        if ttl:
+            cursor._use_query_cache(self.database.connection.query_cache, ttl)
+        return cursor
+
+    def find_one(self, spec_or_id=None, *args, **kwargs):
+        if spec_or_id is not None and not isinstance(spec_or_id, dict):
+            spec_or_id = {'_id': spec_or_id}
+        for document in self.find(spec_or_id, *args, **kwargs).limit(-1):
+            return document
+        return None
+
+    def count(self):
+        return self.find().count()
+
+    def distinct(self, key):
+        return self.find().distinct(key)
+
+    def aggregate(self, pipeline, as_class=dict, cache=None, **kwargs):
+        if isinstance(as_class, basestring):
+            as_class = routed_class(self.database.connection, as_class)
+        run = lambda pipeline: run_pipeline(self, pipeline)
+        return AggregateCursor(self, pipeline, run, as_class, cache)
+
+    def group(self, key, condition, initial, reduce, finalize=None, **kwargs):
+        with self.store.lock:
+            documents = [copy_document(d) for d in self.store.candidates(condition or {})
+                         if match(d, condition or {})]
+        return group_documents(documents, key, initial, reduce, finalize)
+
+    @invalidating
+    def insert(self, doc_or_docs, manipulate=True, *args, **kwargs):
+        docs = doc_or_docs if isinstance(doc_or_docs, list) else [doc_or_docs]
+        ids = []
+        with self.store.lock:
+            for doc in docs:
+                if '_id' not in doc:
+                    doc['_id'] = ObjectId()
+                self.store.insert(copy_document(doc))
+                ids.append(doc['_id'])
+        return ids if isinstance(doc_or_docs, list) else ids[0]
+
+    @invalidating
+    def save(self, to_save, manipulate=True, *args, **kwargs):
+        if '_id' not in to_save:
+            return self.insert(to_save)
+        self.update({'_id': to_save['_id']}, to_save, upsert=True)
+        return to_save['_id']
+
+    @invalidating
+    def update(self, spec, document, upsert=False, manipulate=False,
+               safe=None, multi=False, **kwargs):
+        modifiers = is_operator_doc(document)
+        if not modifiers and any(k.startswith('$') for k in document):
+            raise OperationFailure("cannot mix update modifiers and fields")
+        updated = 0
+        with self.store.lock:
+            for old in list(self.store.candidates(spec)):
+                if not match(old, spec):
+                    continue
+                if modifiers:
+                    new = copy_document(old)
+                    apply_update(new, document)
+                else:
+                    new = copy_document(document)
+                    if new.get('_id', old['_id']) != old['_id']:
+                        raise OperationFailure("the _id of a document cannot be modified")
+                    new['_id'] = old['_id']
+                self.store.replace(old, new)
+                updated += 1
+                if not multi:
+                    break
+            result = {'ok': 1.0, 'n': updated, 'err': None,
+                      'updatedExisting': bool(updated)}
+            if not updated and upsert:
+                if modifiers:
+                    new = upsert_document(spec)
+                    apply_update(new, document, inserting=True)
+                else:
+                    new = copy_document(document)
+                if '_id' not in new:
+                    new['_id'] = spec.get('_id') if '_id' in spec and \
+                        not is_operator_doc(spec['_id']) else ObjectId()
+                self.store.insert(new)
+                result.update({'n': 1, 'upserted': new['_id']})
+        return result
+
+    @invalidating
+    def find_and_modify(self, query=None, update=None, upsert=False, sort=None,
+                        full_response=False, manipulate=False, new=False,
+                        remove=False, fields=None, **kwargs):
+        if not update and not remove:
+            raise ValueError("Must either update or remove")
+        if update and remove:
+            raise ValueError("Can't do both update and remove")
+        query = query or {}
+        with self.store.lock:
+            documents = [d for d in self.store.candidates(query) if match(d, query)]
+            if sort:
+                sort_documents(documents, normalize_sort(sort))
+            if not documents:
+                if not upsert or remove:
+                    return None
+                result = self.update(query, update, upsert=True)
+                return project(copy_document(self.store.documents[
+                    hashable(result['upserted'])]), fields) if new else None
+            old = documents[0]
+            if remove:
+                self.store.remove(old)
+                return project(copy_document(old), fields)
+            self.update({'_id': old['_id']}, update)
+            document = self.store.documents[hashable(old['_id'])] if new else old
+            return project(copy_document(document), fields)
+
+    @invalidating
+    def remove(self, spec_or_id=None, safe=None, multi=True, **kwargs):
+        if spec_or_id is None:
+            spec_or_id = {}
+        elif not isinstance(spec_or_id, dict):
+            spec_or_id = {'_id': spec_or_id}
+        removed = 0
+        with self.store.lock:
+            for document in list(self.store.candidates(spec_or_id)):
+                if match(document, spec_or_id):
+                    self.store.remove(document)
+                    removed += 1
+                    if not multi:
+                        break
+        return {'ok': 1.0, 'n': removed, 'err': None}
+
+    def drop(self):
+        self.database.drop_collection(self.name)
+
+    def options(self):
+        with self.store.lock:
+            return dict(self.store.options)
+
+    def ensure_index(self, key_or_list, cache_for=300, **kwargs):
+        return self.create_index(key_or_list, **kwargs)
+
+    def create_index(self, key_or_list, **kwargs):
+        keys = normalize_sort(key_or_list, kwargs.pop('direction', None))
+        name = kwargs.pop('name', None) or index_name(keys)
+        for option in ('background', 'drop_dups', 'dropDups', 'cache_for'):
+            kwargs.pop(option, None)
+        with self.store.lock:
+            if name in self.store.indexes or keys == [('_id', 1)]:
+                return name
+            index = Index(keys, **kwargs)
+            for document in self.store.documents.itervalues():
+                index.check(document)
+                index.add(document)
+            self.store.indexes[name] = index
+        return name
+
+    def drop_index(self, index_or_name):
+        name = index_or_name
+        if not isinstance(name, basestring):
+            name = index_name(normalize_sort(name))
+        with self.store.lock:
+            if name not in self.store.indexes:
+                raise OperationFailure("index not found with name [%s]" % name)
+            del self.store.indexes[name]
+
+    def drop_indexes(self):
+        with self.store.lock:
+            self.store.indexes.clear()
+
+    def index_information(self):
+        with self.store.lock:
+            info = dict((name, index.info()) for name, index in self.store.indexes.iteritems())
+        info['_id_'] = {'key': [('_id', 1)]}
+        return info
+
+class Cursor(CursorMixin):
+    """An in-memory cursor.  The query runs against a snapshot of the
+    collection when the cursor is first iterated, and each result is copied
+    and wrapped by the class router as it is returned."""
+    def __init__(self, collection, spec=None, fields=None, skip=0, limit=0,
+                 timeout=True, snapshot=False, tailable=False, sort=None,
+                 cache=None, read_preference=None, slave_okay=False, **kwargs):
+        if spec is not None and not isinstance(spec, dict):
+            raise TypeError("spec must be an instance of dict")
+        self.collection = collection
+        self.read_preference = read_preference
+        self.slave_okay = slave_okay
+        self.spec = spec or {}
+        self.fields = fields
+        self._skip = skip
+        self._limit = limit
+        # like pymongo's, an empty slice has no results, since limit 0 means
+        # no limit
+        self._empty = False
+        self._sort = normalize_sort(sort) if sort else []
+        self._is_tailable = tailable
+        self._tail_position = -1
+        self._killed = False
+        self._results = None
+        connection = collection.database.connection
+        self.as_class = routed_class(connection, collection.full_name)
+        self._cache_arg = cache
+        self._setup_cache(cache, connection)
+
+    def _check_unstarted(self):
+        if self._results is not None:
+            raise InvalidOperation("cannot set options after executing query")
+
+    def sort(self, key_or_list, direction=None):
+        self._check_unstarted()
+        self._sort = normalize_sort(key_or_list, direction)
+        return self
+
+    def skip(self, skip):
+        self._check_unstarted()
+        self._skip = skip
+        return self
+
+    def limit(self, limit):
+        self._check_unstarted()
+        self._limit = limit
+        self._empty = False
+        return self
+
+    def batch_size(self, batch_size):
+        return self
+
+    def hint(self, index):
+        return self
+
+    def _store(self):
+        return self.collection.read_store(self.read_preference, self.slave_okay)
+
+    def _query(self, with_limit_and_skip=True):
+        if self._empty and with_limit_and_skip:
+            return []
+        store = self._store()
+        with store.lock:
+            documents = store.candidates(self.spec)
+            if not exact_id_spec(self.spec):
+                documents = [d for d in documents if match(d, self.spec)]
+        if self._sort:
+            sort_documents(documents, self._sort)
+        if with_limit_and_skip:
+            documents = documents[self._skip:]
+            if self._limit:
+                documents = documents[:abs(self._limit)]
+        return documents
+
+    def count(self, with_limit_and_skip=False):
+        return len(self._query(with_limit_and_skip))
+
+    def distinct(self, key):
+        values = []
+        for value in expand([v for d in self._query() for v in resolve(d, key)]):
+            if not isinstance(value, list) and not any(equal(value, v) for v in values):
+                values.append(value)
+        return values
+
+    def clone(self):
+        clone = Cursor(self.collection, self.spec, self.fields, self._skip,
+                       self._limit, tailable=self._is_tailable, sort=self._sort,
+                       cache=self._cache_arg, read_preference=self.read_preference,
+                       slave_okay=self.slave_okay)
+        clone._empty = self._empty
+        clone._cachelimit = self._cachelimit
+        if self._query_cache is not None:
+            clone._use_query_cache(self._query_cache, self._cache_ttl)
+        clone._populate = self._populate
+        return clone
+
+    def __getitem__(self, index):
+        clone = self.clone()
+        if isinstance(index, slice):
+            start = index.start or 0
+            clone._skip = self._skip + start
+            if index.stop is not None:
+                if index.stop <= start:
+                    clone._empty = True
+                else:
+                    clone._limit = index.stop - start
+            return clone
+        clone._skip = self._skip + index
+        clone._limit = -1
+        for document in clone:
+            return document
+        raise IndexError("no such item for Cursor instance")
+
+    def _tailable(self):
+        return self._is_tailable
+
+    def _description(self):
+        return self.collection.full_name, self.spec, self._sort or None
+
+    def _cache_key(self):
+        return self.collection.full_name, hashable((self.spec, self.fields,
+            self._sort, self._skip, self._limit, self._empty)), self._limit
+
+    @property
+    def alive(self):
+        if self._killed:
+            return False
+        return self._is_tailable or self._results is None or \
+            self._position < len(self._results)
+
+    def _tail(self):
+        """Read the matching documents inserted into this tailable cursor's
+        capped collection since it last looked, returning whether there
+        are any."""
+        store = self._store()
+        with store.lock:
+            if not store.options.get('capped'):
+                raise OperationFailure("tailable cursor requested on non capped collection")
+            new = []
+            for key in reversed(store.documents):
+                if store.positions[key] <= self._tail_position:
+                    break
+                new.append(store.documents[key])
+            if new:
+                self._tail_position = store.positions[hashable(new[0]['_id'])]
+            self._results = [d for d in reversed(new) if match(d, self.spec)]
+        self._position = 0
+        return bool(self._results)
+
+    def _next_result(self):
+        if self._results is None:
+            timer = self._timer
+            if timer is not None:
+                start = time.time()
+            if self._is_tailable:
+                self._tail()
+            else:
+                self._results = self._query()
+                self._position = 0
+            if timer is not None:
+                timer.server_time += time.time() - start
+        if self._position >= len(self._results):
+            if not (self._is_tailable and self._tail()):
+                raise StopIteration
+        document = self._results[self._position]
+        self._position += 1
+        # like pymongo's decoder, subdocuments are wrapped by the router too
+        document = wrap_nested(self.as_class, project(document, self.fields))
+        loaded = getattr(document, '_loaded', None)
+        if loaded is not None:
+            loaded()
+        return document
+
+    def rewind(self):
+        self._reset_cache()
+        self._results = None
+        self._tail_position = -1
+        self._killed = False
+        return self
+
+    def close(self):
+        self._publish()
+        self._results = []
+        self._killed = True
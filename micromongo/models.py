@@ -3,22 +3,86 @@
 
 """micromongo models"""
 
+import re
+import time
 from pprint import pprint, pformat
 
 from pymongo import Connection as PymongoConnection
+try:
+    from pymongo import ReadPreference
+except ImportError:
+    ReadPreference = None
+try:
+    from pymongo.mongo_replica_set_client import MongoReplicaSetClient
+except ImportError:
+    MongoReplicaSetClient = None
 
-from micromongo.utils import OpenStruct, uncamel
-from micromongo.backend import Connection
-from micromongo.spec import validate, make_default
+from micromongo.utils import OpenStruct, uncamel, memoize, bson_index, bson_decode_element, \
+    copy_document, hashable
+from micromongo.backend import Connection, ReplicaSetConnection, ModelSONManipulator, \
+    routed_class, wrap_document
+from micromongo import memory
+from micromongo.spec import compile_spec, make_default, Ref
+from micromongo.cache import IdentityMap, QueryCache
+from micromongo.indexes import Index, diff as diff_indexes
+from micromongo import indexes
+from micromongo import futures, monitoring, parallel, snapshot, watch
 
-__all__ = ['current', 'connect', 'clean_connection', 'Model']
+__all__ = ['current', 'connect', 'clean_connection', 'request', 'sync_indexes', 'Model', 'LazyModel']
 
-__connection_args = tuple()
-__connection = None
+_identifier = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
 
-def current():
-    global __connection
-    return __connection
+DEFAULT_CONNECTION = 'default'
+
+class ConnectionSlot(object):
+    """Holds the connection registered under an alias by ``connect``, and the
+    arguments it was made with.  Models keep the slot for their alias, so
+    they see the alias being (re)connected without looking it up.
+
+    The slot is also the routing table of its connection:  ``collections``
+    maps "db.collection" keys to Collection handles, which are made once
+    rather than on every query.  It is rebuilt when the alias is connected
+    again."""
+    __slots__ = ('alias', 'connection', 'args', 'collections')
+    def __init__(self, alias):
+        self.alias = alias
+        self.connection = None
+        self.args = tuple()
+        self.collections = {}
+
+    def set_connection(self, connection, paths=()):
+        """Replace this slot's connection, and build the collection handles
+        for the ``(key, path)`` pairs of ``paths``.  Handles on the old
+        connection are dropped."""
+        self.connection = connection
+        self.collections = {}
+        for key, path in paths:
+            self.collection(key, path)
+
+    def collection(self, key, path=None):
+        """Return the handle of the collection named by the "db.collection"
+        ``key`` on this slot's connection.  ``path`` is the key's
+        ``(database, collection)`` pair, if the caller has it already."""
+        try:
+            return self.collections[key]
+        except KeyError:
+            database, collection = path or key.split('.', 1)
+            handle = self.connection[database][collection]
+            # replaced rather than changed, for readers in other threads
+            self.collections = dict(self.collections, **{key: handle})
+            return handle
+
+__connections = {}
+
+def connection_slot(alias=DEFAULT_CONNECTION):
+    """Return the ``ConnectionSlot`` for ``alias``, creating it if needed."""
+    if alias not in __connections:
+        __connections.setdefault(alias, ConnectionSlot(alias))
+    return __connections[alias]
+
+def current(alias=DEFAULT_CONNECTION):
+    """Return the connection made by ``connect`` for ``alias``."""
+    return connection_slot(alias).connection
 
 def connect(*args, **kwargs):
     """Connect to the database.  Passes arguments along to
@@ -27,38 +91,137 @@ def connect(*args, **kwargs):
     The Connection returned by this proxy method will be used by micromongo
     for all of its queries.  Micromongo will alter the behavior of this
     conneciton object in some subtle ways;  if you want a clean one, call
-    ``micromongo.clean_connection`` after connecting."""
-    global __connection, __connection_args
-    __connection_args = (args, dict(kwargs))
+    ``micromongo.clean_connection`` after connecting.
+
+    Connections to more than one server can be made by giving each of them
+    an ``alias`` keyword;  Models with a ``connection`` attribute use the
+    connection with that alias, and others use the default connection.
+
+    The ``cursor_cache`` keyword sets the default result caching for this
+    connection's cursors;  see ``micromongo.backend.Cursor``.  The
+    ``identity_map`` keyword takes a ``micromongo.cache.IdentityMap`` (or
+    True, for one with the default settings) used to cache documents
+    looked up by ``_id``, and the ``query_cache`` keyword a
+    ``micromongo.cache.QueryCache`` (or True) used to cache the results of
+    queries made with a ``cache_ttl``.
+
+    Giving the name of a replica set, with the ``replicaset`` keyword or a
+    ``replicaSet`` option in the uri, connects with pymongo's
+    ``MongoReplicaSetClient``, which sends reads to secondaries according to
+    their read preference;  a plain connection sends every read to the
+    server it is connected to, so read preferences only take effect through
+    a mongos.
+
+    Connecting to a ``mem://`` uri uses the in-memory backend in
+    ``micromongo.memory`` instead of a server."""
+    slot = connection_slot(kwargs.pop('alias', DEFAULT_CONNECTION))
+    slot.args = (args, dict(kwargs))
+    slot.args[1].pop('cursor_cache', None)
+    slot.args[1].pop('identity_map', None)
+    slot.args[1].pop('query_cache', None)
+    if kwargs.get('identity_map') is True:
+        kwargs['identity_map'] = IdentityMap()
+    if kwargs.get('query_cache') is True:
+        kwargs['query_cache'] = QueryCache()
     # inject our class_router
     kwargs['class_router'] = class_router
-    __connection = Connection(*args, **kwargs)
-    return __connection
+    connection = connection_class(args, kwargs)(*args, **kwargs)
+    slot.set_connection(connection, [(key, model._collection_path
+        if model._collection_key == key else None) for key, model in
+        AccountingMeta.collection_map.items() if model._connection_slot is slot])
+    return slot.connection
+
+def connection_class(args, kwargs, memory_class=memory.Connection,
+                     server_class=Connection, replica_set_class=ReplicaSetConnection):
+    """Return the class to connect with for these ``connect`` arguments."""
+    host = args[0] if args else kwargs.get('host')
+    if memory.is_memory_uri(host):
+        return memory_class
+    if replica_set_class is not None and is_replica_set(host, kwargs):
+        return replica_set_class
+    return server_class
+
+def is_replica_set(host, kwargs):
+    """Whether these ``connect`` arguments name a replica set."""
+    if any(k.lower() == 'replicaset' for k in kwargs):
+        return True
+    hosts = host if isinstance(host, (list, tuple)) else [host]
+    return any(isinstance(h, basestring) and 'replicaset=' in h.lower() for h in hosts)
 
-def clean_connection():
+def request(alias=DEFAULT_CONNECTION):
+    """Pin a socket of the current connection to this thread for a block;
+    see ``micromongo.backend.Connection.request``."""
+    return current(alias).request()
+
+def clean_connection(alias=DEFAULT_CONNECTION):
     """Get a clean Connection object on the database.  This connection will
     not have the behavioral changes that micromongo's regular connection
     will have."""
-    global __connection_args, __connection
-    if not __connection_args and __connection is None:
+    slot = connection_slot(alias)
+    if not slot.args and slot.connection is None:
         raise Exception('must call `connect` before `clean_connection`')
-    return PymongoConnection(*__connection_args[0], **__connection_args[1])
+    cls = connection_class(slot.args[0], slot.args[1], server_class=PymongoConnection,
+                           replica_set_class=MongoReplicaSetClient)
+    return cls(*slot.args[0], **slot.args[1])
 
 def registered_models():
     """Return the AccountingMeta's model mapping, which is a dictionary of
     keys in the form of "db.collection" to model classes."""
     return dict(AccountingMeta.collection_map)
 
+def sync_indexes(drop=True):
+    """Make the indexes of the collections of all models that declare
+    ``indexes`` match their declarations, creating the indexes that are
+    missing and, if ``drop`` is True, dropping those that are not declared.
+    An existing index on the same keys as a declared one but with different
+    options is replaced.  Returns a dictionary of "db.collection" keys to
+    the names of the indexes that were ``created`` and ``dropped``."""
+    changes = {}
+    for key, declared in AccountingMeta.index_map.items():
+        model = AccountingMeta.collection_map.get(key)
+        if model is None:
+            continue
+        collection = model._collection()
+        existing = collection.index_information()
+        create, undeclared = diff_indexes(declared, existing)
+        # indexes on the same keys would conflict with the new ones
+        conflicts = [name for name in undeclared if any(
+            [tuple(k) for k in existing[name]['key']] == index.keys
+            for index in create)]
+        dropped = [name for name in undeclared if drop or name in conflicts]
+        for name in dropped:
+            collection.drop_index(name)
+        for index in create:
+            collection.create_index(index.keys, name=index.name, **index.options)
+        changes[key] = {'created': [i.name for i in create], 'dropped': dropped}
+    return changes
+
 def class_router(collection_full_name):
     return AccountingMeta.route(collection_full_name)
 
+@memoize(maxsize=1024)
+def module_database(module):
+    """The database of the models in ``module`` that don't name one."""
+    return uncamel(module.split('.')[-1])
+
+def collection_path(cls, attrs):
+    """The ``(database, collection)`` pair of the model class ``cls``,
+    which is being created with ``attrs``."""
+    if 'collection' in attrs and 'database' in attrs:
+        return attrs['database'], attrs['collection']
+    elif 'collection' in attrs:
+        return tuple(attrs['collection'].split('.', 1))
+    return module_database(cls.__module__), uncamel(cls.__name__)
+
 class AccountingMeta(type):
     """Metaclass for all model classes.
 
     This class keeps track of the database & collection that each model
     covers, and is used by the ``DocumentClassProxy`` to look up the right
-    model class to wrap around objects."""
+    model class to wrap around objects.  The indexes declared by models are
+    kept in ``index_map``, under the same keys."""
     collection_map = {}
+    index_map = {}
 
     def __new__(cls, name, bases, attrs):
         cls = type.__new__(cls, name, bases, attrs)
@@ -72,21 +235,267 @@ class AccountingMeta(type):
         return AccountingMeta.collection_map.get(collection_full_name, dict)
 
 
+# the keyword arguments of ``Model.update`` and ``Model.find_and_modify``
+update_modifiers = {
+    'set': '$set',
+    'unset': '$unset',
+    'inc': '$inc',
+    'push': '$push',
+    'pull': '$pull',
+    'add_to_set': '$addToSet',
+}
+
+# modifiers whose values are elements of arrays
+array_modifiers = frozenset(['$push', '$addToSet', '$pull', '$pushAll', '$pullAll'])
+
+def _array_elements(op, fields):
+    """The elements that the array modifier ``op`` adds to (or removes
+    from) each of the keys of ``fields``, as lists.  Conditions given to
+    ``$pull`` are left out, since they aren't elements."""
+    elements = {}
+    for key, value in fields.iteritems():
+        if op in ('$pushAll', '$pullAll'):
+            elements[key] = list(value)
+        elif isinstance(value, dict) and '$each' in value:
+            elements[key] = list(value['$each'])
+        elif op != '$pull' or not isinstance(value, dict):
+            elements[key] = [value]
+    return elements
+
+def _lookup_id(spec):
+    """Return the ``_id`` a find_one spec looks up, or None if it is not a
+    plain lookup of a single hashable ``_id``."""
+    if isinstance(spec, dict):
+        if len(spec) != 1 or '_id' not in spec:
+            return None
+        spec = spec['_id']
+        if isinstance(spec, dict):
+            return None
+    try:
+        hash(spec)
+    except TypeError:
+        return None
+    return spec
+
+def read_preference_args(read):
+    """Return the find arguments for a read preference, which can be one of
+    pymongo's ``ReadPreference`` values or the lower case name of one, like
+    'secondary' or 'nearest'.  On versions of pymongo without read
+    preferences, anything other than 'primary' sets ``slave_okay``.
+
+    Reads are only routed to secondaries by connections made with the name
+    of a replica set or to a mongos;  see ``connect``."""
+    if not isinstance(read, basestring):
+        return {'read_preference': read}
+    name = read.upper()
+    if ReadPreference is None:
+        return {'slave_okay': name != 'PRIMARY'}
+    if not hasattr(ReadPreference, name):
+        raise ValueError('%r is not a valid read preference' % read)
+    return {'read_preference': getattr(ReadPreference, name)}
+
+@memoize
+def data_descriptor(cls, name):
+    """Whether ``name`` is a data descriptor of ``cls``, like a property or
+    a slot, which attribute assignment goes to instead of the document."""
+    for klass in cls.__mro__:
+        if name in klass.__dict__:
+            return hasattr(type(klass.__dict__[name]), '__set__')
+    return False
+
+class classinstancemethod(object):
+    """A method descriptor which calls ``classfunc`` with the class when it is
+    accessed on the class and ``instfunc`` with the instance when accessed
+    on an instance."""
+    def __init__(self, classfunc, instfunc):
+        self.classfunc = classfunc
+        self.instfunc = instfunc
+    def __get__(self, obj, cls):
+        if obj is None:
+            return self.classfunc.__get__(cls, type(cls))
+        return self.instfunc.__get__(obj, cls)
+
 class Model(OpenStruct):
-    """Micromongo Model object."""
+    """Micromongo Model object.  If ``fields`` is set on a model class, it is
+    used as the default projection for ``find`` and ``find_one``, and since
+    documents loaded that way may be partial, saving a document that has an
+    ``_id`` then ``$set``s its fields rather than replacing the document.
+
+    Models use micromongo's default connection unless ``connection`` is set
+    to the alias of another connection made with ``connect``.  Reads made
+    with ``find`` and ``find_one`` use the ``read_preference`` of the model,
+    if it has one, while writes always go to the primary.
+
+    If ``closed`` is True, the model's documents are expected to only have
+    the keys in its ``spec`` (and ``_id``), and instances are created from a
+    generated subclass that stores those keys in ``__slots__``;  see
+    ``CompactStruct``.
+
+    ``indexes`` declares the indexes the model's collection should have;  see
+    ``micromongo.indexes`` and ``sync_indexes``.
+
+    Documents loaded from the database track the keys that are set or
+    deleted on them, so that ``save`` can send just the changes;  see
+    ``Model.save``.  Lists and subdocuments can be changed in place, so they
+    are sent with every save, unless ``diff_in_place`` is True:  then each
+    document keeps a copy of them as they were loaded, and only sends those
+    that differ from it, at the cost of the copies' memory and the time it
+    takes to make them."""
     __metaclass__ = AccountingMeta
+    # the changed keys of a loaded or saved document, or None if the
+    # document isn't tracked and has to be saved whole;  and with
+    # ``diff_in_place``, copies of the values it had that can be changed in
+    # place, to find those changes
+    __slots__ = ('_dirty', '_originals')
+    _validator = None
+    _compact_class = None
+    # the (key, field) pairs of the spec's references
+    _refs = ()
+    fields = None
+    closed = False
+    connection = None
+    read_preference = None
+    indexes = None
+    cache_ttl = None
+    diff_in_place = False
+    _indexes = None
+    _connection_slot = connection_slot()
+
+    def __init__(self, *d, **dd):
+        object.__setattr__(self, '_dirty', None)
+        object.__setattr__(self, '_originals', None)
+        if d and not dd:
+            self.__dict__.update(d[0])
+        else:
+            self.__dict__.update(dd)
+
+    def __setattr__(self, name, value):
+        if data_descriptor(type(self), name):
+            object.__setattr__(self, name, value)
+        else:
+            self[name] = value
+
+    def __delattr__(self, name):
+        if data_descriptor(type(self), name):
+            object.__delattr__(self, name)
+        else:
+            del self[name]
+
+    def __setitem__(self, item, value):
+        self.__dict__[item] = value
+        if self._dirty is not None:
+            self._dirty.add(item)
+
+    def __delitem__(self, item):
+        if item in self.__dict__:
+            del self.__dict__[item]
+            if self._dirty is not None:
+                self._dirty.add(item)
+
+    def _update(self, d):
+        self.__dict__.update(d)
+        if self._dirty is not None:
+            self._dirty.update(d.keys())
+
+    def clear(self):
+        if self._dirty is not None:
+            self._dirty.update(self.keys())
+        self.__dict__.clear()
+
+    def _loaded(self):
+        """Start tracking changes;  called on documents as they are loaded
+        and after they are saved."""
+        object.__setattr__(self, '_dirty', set())
+        object.__setattr__(self, '_originals', None)
+        if type(self).diff_in_place:
+            for key, value in self._mutable_items():
+                self._remember(key, value)
+
+    def _remember(self, key, value):
+        """With ``diff_in_place``, keep a copy of ``value``, the value of
+        ``key`` as the database has it, if it can be changed in place."""
+        if not type(self).diff_in_place:
+            return
+        originals = self._originals
+        if isinstance(value, (dict, list, OpenStruct)):
+            if originals is None:
+                originals = {}
+                object.__setattr__(self, '_originals', originals)
+            originals[key] = self._comparable(key, value)
+        elif originals:
+            originals.pop(key, None)
+
+    def _comparable(self, key, value):
+        """A copy of ``value`` as it would be saved, to compare to others."""
+        for ref, field in self._refs:
+            if ref == key:
+                value = field.stored(value)
+        return copy_document(value)
+
+    def _mutable_items(self):
+        """The values which can be changed in place, without being set."""
+        return [(k, v) for k, v in self.__dict__.iteritems()
+                if isinstance(v, (dict, list, OpenStruct))]
+
+    def changes(self):
+        """Return the update document ``save`` would send for this document,
+        or None if it isn't tracked and would be saved whole.  Values which
+        can be changed in place, like lists and subdocuments, are always
+        included, unless the model has ``diff_in_place`` set;  then they are
+        compared to copies taken when the document was loaded, and only
+        included if they differ."""
+        if self._dirty is None:
+            return None
+        sets, unsets = self._changed_values()
+        update = {}
+        if sets:
+            update['$set'] = ModelSONManipulator().transform_incoming(sets, None)
+        if unsets:
+            update['$unset'] = unsets
+        return update
+
+    def _changed_values(self):
+        """The values ``changes`` sets, and the keys it unsets, as dicts."""
+        dirty = self._dirty
+        sets, unsets = {}, {}
+        for key in dirty:
+            if key in self:
+                sets[key] = self[key]
+            else:
+                unsets[key] = 1
+        originals = self._originals or {}
+        for key, value in self._mutable_items():
+            if key not in sets and (key not in originals or
+                                    self._comparable(key, value) != originals[key]):
+                sets[key] = value
+        sets.pop('_id', None)
+        for key, field in self._refs:
+            if key in sets:
+                # a document in a reference is stored as its id, so it can't
+                # be changed in place
+                if key not in dirty and not field.many and isinstance(sets[key], OpenStruct):
+                    del sets[key]
+                else:
+                    sets[key] = field.stored(sets[key])
+        return sets, unsets
 
     def __classinit__(cls, attrs):
-        if cls.__name__ == 'Model':
+        if cls.__module__ == __name__:
             return
-        if 'collection' in attrs and 'database' in attrs:
-            key = '%s.%s' % (attrs['database'], attrs['collection'])
-        elif 'collection' in attrs:
-            key = attrs['collection']
-        else:
-            module = cls.__module__.split('.')[-1]
-            key = '%s.%s' % (uncamel(module), uncamel(cls.__name__))
-        cls._collection_key = key
+        cls._validator = compile_spec(getattr(cls, 'spec', None))
+        cls._refs = tuple((k, f) for k, f in (getattr(cls, 'spec', None) or {}).iteritems()
+                          if isinstance(f, Ref))
+        cls._collection_path = collection_path(cls, attrs)
+        cls._collection_key = key = '.'.join(cls._collection_path)
+        cls._connection_slot = connection_slot(cls.connection or DEFAULT_CONNECTION)
+        cls._compact_class = None
+        if cls.closed:
+            cls._compact_class = CompactStruct.make_class(cls)
+            cls.__new__ = staticmethod(_new_compact)
+        cls._indexes = None
+        if cls.indexes is not None:
+            cls._indexes = [Index.make(i) for i in cls.indexes]
+            AccountingMeta.index_map[key] = cls._indexes
         AccountingMeta.collection_map[key] = cls
 
     @classmethod
@@ -97,39 +506,816 @@ class Model(OpenStruct):
         new.update(args[0] if args and not kwargs else kwargs)
         return new
 
+    @classmethod
+    def _find_kwargs(cls, args, kwargs):
+        """Apply the default projection and read preference, or the one given
+        with ``read``, to the arguments of a find.  Warns about unindexed
+        queries if ``micromongo.indexes.warn_unindexed`` is set."""
+        if indexes.warn_unindexed and cls._indexes is not None:
+            indexes.check_query(cls, cls._indexes, args[0] if args else kwargs.get('spec'))
+        if cls.fields is not None and len(args) < 2 and 'fields' not in kwargs:
+            kwargs['fields'] = cls.fields
+        if cls.cache_ttl and 'cache_ttl' not in kwargs:
+            kwargs['cache_ttl'] = cls.cache_ttl
+        read = kwargs.pop('read', cls.read_preference)
+        if read is not None:
+            kwargs.update(read_preference_args(read))
+        return kwargs
+
     @classmethod
     def find(cls, *args, **kwargs):
         """Run a find on this model's collection.  The arguments to ``Model.find``
-        are the same as to ``pymongo.Collection.find``."""
-        database, collection = cls._collection_key.split('.')
-        return current()[database][collection].find(*args, **kwargs)
+        are the same as to ``pymongo.Collection.find``, with the addition of
+        ``read``, which sets the read preference of this query;  see
+        ``micromongo.models.read_preference_args``."""
+        kwargs = cls._find_kwargs(args, kwargs)
+        return cls._collection().find(*args, **kwargs)
 
     @classmethod
     def find_one(cls, *args, **kwargs):
         """Run a find_one on this model's collection.  The arguments to
-        ``Model.find_one`` are the same as to ``pymongo.Collection.find_one``."""
-        database, collection = cls._collection_key.split('.')
-        return current()[database][collection].find_one(*args, **kwargs)
+        ``Model.find_one`` are the same as to ``Model.find``.  If the
+        connection has an identity map, lookups on ``_id`` alone are served
+        from it when possible."""
+        if not monitoring.listeners:
+            return cls._find_one(args, kwargs)
+        start = time.time()
+        spec = args[0] if args else kwargs.get('spec')
+        document = cls._find_one(args, kwargs)
+        monitoring.publish(monitoring.QueryEvent(cls._collection_key, 'find_one',
+            spec, kwargs.get('sort'), int(document is not None), time.time() - start))
+        return document
+
+    @classmethod
+    def _find_one(cls, args, kwargs):
+        collection = cls._collection()
+        imap = collection.database.connection.identity_map
+        explicit = bool(kwargs)
+        kwargs = cls._find_kwargs(args, kwargs)
+        if imap is None or explicit or len(args) != 1 or not imap.active:
+            return collection.find_one(*args, **kwargs)
+        _id = _lookup_id(args[0])
+        if _id is None:
+            return collection.find_one(*args, **kwargs)
+        document = imap.get(cls._collection_key, _id)
+        if document is None:
+            document = collection.find_one(*args, **kwargs)
+            if document is not None:
+                imap.put(cls._collection_key, document)
+        return document
+
+    def _get_by_id(cls, _id):
+        """Get the document with ``_id`` from this model's collection, or None
+        if there isn't one.  Uses the identity map if there is one."""
+        return cls.find_one({'_id': _id})
+
+    # Model.get(_id) looks a document up, while instance.get(key) keeps
+    # the dict interface of OpenStruct
+    get = classinstancemethod(_get_by_id, OpenStruct.get.im_func)
+
+    @classmethod
+    def afind_one(cls, *args, **kwargs):
+        """A non-blocking ``find_one``, which returns a future for its result.
+        See ``micromongo.futures``."""
+        return futures.submit(cls.find_one, *args, **kwargs)
+
+    @classmethod
+    def parallel_scan(cls, spec=None, workers=4, mode='thread', **kwargs):
+        """Scan the documents matching ``spec`` with ``workers`` threads or,
+        with ``mode='process'``, processes, each reading a range of ``_id``
+        (or of another unique ``key``).  Returns an iterator over the
+        documents, or with ``map``, over the results of calling it on each
+        document in the workers.  See ``micromongo.parallel``."""
+        return parallel.parallel_scan(cls, spec, workers, mode, **kwargs)
+
+    @classmethod
+    def watch(cls, query=None, resume_from=None, **kwargs):
+        """Return a change feed over the documents matching ``query`` which
+        come after ``resume_from``, a checkpoint of an earlier feed.  The
+        feed tails capped collections and polls others on ``key``;  see
+        ``micromongo.watch``."""
+        return watch.Watch(cls, query, resume_from, **kwargs)
+
+    @classmethod
+    def populate(cls, documents, *keys):
+        """Replace the ids in the references at ``keys`` of ``documents``
+        with the documents they refer to, making one ``$in`` query for each
+        collection referred to.  The documents are found with the models
+        registered for those collections, and each is shared by every
+        reference to it.  References to documents that don't exist keep
+        their ids.  Returns ``documents``."""
+        fields = cls._ref_fields(keys)
+        targets = {}
+        for key, field in fields:
+            ids = targets.setdefault(field.collection, {})
+            for document in documents:
+                value = document.get(key)
+                for _id in (value if field.many and isinstance(value, list) else [value]):
+                    if _id is not None and not isinstance(_id, OpenStruct):
+                        ids[hashable(_id)] = _id
+        found = {}
+        for collection, ids in targets.iteritems():
+            model = AccountingMeta.collection_map.get(collection)
+            if model is None:
+                raise ValueError("no model is registered for %s" % collection)
+            found[collection] = dict((hashable(d['_id']), d) for d in
+                model.find({'_id': {'$in': ids.values()}}, cache=False)) if ids else {}
+        for key, field in fields:
+            referred = found[field.collection]
+            def resolve(value):
+                if isinstance(value, OpenStruct):
+                    return value
+                return referred.get(hashable(value), value)
+            for document in documents:
+                if key not in document:
+                    continue
+                value = document[key]
+                if field.many and isinstance(value, list):
+                    value = [resolve(v) for v in value]
+                else:
+                    value = resolve(value)
+                # replacing ids with their documents doesn't change what
+                # would be saved, so it isn't tracked as a change
+                dirty = document._dirty
+                changed = dirty is not None and key in dirty
+                document[key] = value
+                if dirty is not None and not changed:
+                    dirty.discard(key)
+        return documents
+
+    @classmethod
+    def _ref_fields(cls, keys):
+        """The ``(key, field)`` pairs of the references at ``keys``."""
+        refs = dict(cls._refs)
+        for key in keys:
+            if key not in refs:
+                raise ValueError("%s.%s is not a Ref field" % (cls.__name__, key))
+        return [(key, refs[key]) for key in keys]
+
+    @classmethod
+    def snapshot(cls, path, query=None, keys=(), **kwargs):
+        """Write the documents matching ``query`` to a snapshot file at
+        ``path``, indexed on ``_id`` and on each of ``keys``, to be opened
+        with ``open_snapshot``.  Other keyword arguments are passed along to
+        ``find``.  Returns the number of documents written.  See
+        ``micromongo.snapshot``."""
+        cursor = cls.find(query, cache=False, **kwargs).sort('_id', 1)
+        return snapshot.write_snapshot(path, cursor._raw_documents(),
+                                       cls._collection_key, keys)
+
+    @classmethod
+    def open_snapshot(cls, path):
+        """Memory-map the snapshot file at ``path``, returning a ``Snapshot``
+        whose documents are of the model routed to for its collection."""
+        return snapshot.Snapshot(path, class_router)
 
     def validate(self):
-        """Validate this object based on its spec document."""
-        return validate(self, getattr(self, 'spec', None))
+        """Validate this object based on its spec document.  The spec is
+        compiled once when the class is created;  if ``spec`` is replaced
+        afterwards, it is recompiled here."""
+        spec = getattr(self, 'spec', None)
+        validator = self._validator
+        if validator is None or validator.spec is not spec:
+            validator = self.__class__._validator = compile_spec(spec)
+        return validator.validate(self)
+
+    def _validate_changes(self, keys):
+        validator = self._validator
+        if type(self).validate.im_func is not Model.validate.im_func or \
+                validator is None or validator.spec is not getattr(self, 'spec', None):
+            return self.validate()
+        return validator.validate(self, keys)
 
-    def save(self):
+    def save(self, full=False):
         """Save this object to the database.  Behaves very similarly to
         whatever collection.save(document) would, ie. does upserts on _id
         presence.  If methods ``pre_save`` or ``post_save`` are defined, those
         are called.  If there is a spec document, then the document is
-        validated against it after the ``pre_save`` hook but before the save."""
+        validated against it after the ``pre_save`` hook but before the save.
+
+        Documents that were loaded from the database (or saved before) only
+        send the keys that have changed since, as an update that ``$set``s
+        and ``$unset``s them, and only the keys it sends are validated.  Pass
+        ``full=True`` to validate and save the whole document instead.  If
+        the update is acknowledged and finds that the document has been
+        removed, the whole document is saved again;  with unacknowledged
+        writes, the update is lost."""
         if hasattr(self, 'pre_save'):
             self.pre_save()
-        database, collection = self._collection_key.split('.')
-        self.validate()
-        _id = current()[database][collection].save(dict(self))
+        timed = bool(monitoring.listeners)
+        if timed:
+            start = time.time()
+        changes = None
+        if full or self._dirty is None or '_id' not in self:
+            self.validate()
+        else:
+            # every key the update sends is validated, including values that
+            # were changed in place rather than set
+            sets, unsets = self._changed_values()
+            self._validate_changes(set(sets) | set(unsets))
+            changes = self.changes()
+        if timed:
+            validated = time.time()
+        collection = self._collection()
+        connection = collection.database.connection
+        if changes is not None:
+            _id = self['_id']
+            if changes:
+                result = collection.update({'_id': _id}, changes)
+                # the document was removed since it was loaded
+                if isinstance(result, dict) and result.get('n') == 0:
+                    collection.save(self._document())
+        elif self.__class__.fields is not None and '_id' in self:
+            document = self._document()
+            _id = document.pop('_id')
+            if document:
+                collection.update({'_id': _id}, {'$set': document}, upsert=True)
+        else:
+            _id = collection.save(self._document())
         if _id: self._id = _id
+        self._loaded()
+        if timed:
+            monitoring.publish(monitoring.QueryEvent(self._collection_key, 'save',
+                {'_id': _id}, returned=1, server_time=time.time() - validated,
+                validate_time=validated - start))
+        if connection.identity_map is not None:
+            connection.identity_map.put(self._collection_key, self)
         if hasattr(self, 'post_save'):
             self.post_save()
 
+    def _document(self):
+        """This document as it is saved:  a dict of its items, with the
+        documents in its references replaced by their ids."""
+        document = dict(self)
+        for key, field in self._refs:
+            if key in document:
+                document[key] = field.stored(document[key])
+        return document
+
+    def asave(self):
+        """A non-blocking ``save``, which returns a future that is done when
+        the document has been saved.  See ``micromongo.futures``."""
+        return futures.submit(self.save)
+
+    @classmethod
+    def save_many(cls, documents, batch_size=1000):
+        """Save an iterable of instances of this model in batches of up to
+        ``batch_size`` documents.  Each batch has its ``pre_save`` hooks and
+        validation run first;  documents without an ``_id`` are then sent in
+        a single multi-document insert and documents with one as a single
+        batch of upserts.  New ``_id`` values are set on the instances and
+        ``post_save`` hooks are run after the batch is written.
+
+        Documents that fail their ``pre_save`` hook or validation with a
+        ``ValueError`` are skipped rather than aborting the batch;  a list of
+        ``(document, exception)`` pairs for these documents is returned."""
+        collection = cls._collection()
+        failed, batch = [], []
+        for document in documents:
+            batch.append(document)
+            if len(batch) >= batch_size:
+                failed.extend(cls._save_batch(collection, batch))
+                batch = []
+        if batch:
+            failed.extend(cls._save_batch(collection, batch))
+        return failed
+
+    @classmethod
+    def _save_batch(cls, collection, batch):
+        failed, saved, new, existing = [], [], [], []
+        timed = bool(monitoring.listeners)
+        if timed:
+            start = time.time()
+        for document in batch:
+            try:
+                if hasattr(document, 'pre_save'):
+                    document.pre_save()
+                document.validate()
+            except ValueError, e:
+                failed.append((document, e))
+                continue
+            saved.append(document)
+            if '_id' in document:
+                existing.append(document)
+            else:
+                new.append(document)
+        if timed:
+            validated = time.time()
+        if new:
+            ids = collection.insert([d._document() for d in new])
+            for document, _id in zip(new, ids):
+                document._id = _id
+        if cls.fields is not None:
+            # these may be partial documents;  see ``Model.save``
+            existing = [d._document() for d in existing]
+            existing = [(d.pop('_id'), {'$set': d}) for d in existing if len(d) > 1]
+        else:
+            existing = [(d['_id'], d._document()) for d in existing]
+        if existing and hasattr(collection, 'initialize_unordered_bulk_op'):
+            bulk = collection.initialize_unordered_bulk_op()
+            for _id, document in existing:
+                if cls.fields is not None:
+                    bulk.find({'_id': _id}).upsert().update_one(document)
+                else:
+                    bulk.find({'_id': _id}).upsert().replace_one(document)
+            bulk.execute()
+        elif existing:
+            for _id, document in existing:
+                collection.update({'_id': _id}, document, upsert=True)
+        if timed:
+            monitoring.publish(monitoring.QueryEvent(cls._collection_key,
+                'save_many', returned=len(saved), server_time=time.time() - validated,
+                validate_time=validated - start))
+        imap = collection.database.connection.identity_map
+        for document in saved:
+            document._loaded()
+            if imap is not None:
+                imap.put(cls._collection_key, document)
+            if hasattr(document, 'post_save'):
+                document.post_save()
+        return failed
+
+    @classmethod
+    def _collection(cls):
+        """Return the handle of this model's collection, from the routing
+        table of its connection."""
+        try:
+            return cls._connection_slot.collections[cls._collection_key]
+        except KeyError:
+            return cls._connection_slot.collection(cls._collection_key, cls._collection_path)
+
+    @classmethod
+    def _check_update(cls, update):
+        """Check the values an update document sets against the spec.  Only
+        the modified fields are checked:  values that are ``$set`` (or
+        ``$min``/``$max``) are validated, required fields can't be
+        ``$unset``, ``$inc`` and ``$mul`` need numbers, and the elements
+        given to ``$push``, ``$addToSet`` and ``$pull`` are validated as a
+        list of them would be.  Other modifiers can't be checked, and are
+        refused for keys in the spec.  Documents without modifiers are
+        validated whole."""
+        spec = getattr(cls, 'spec', None)
+        if not spec:
+            return
+        validator = cls._validator
+        if validator is None or validator.spec is not spec:
+            validator = cls._validator = compile_spec(spec)
+        if not any(key.startswith('$') for key in update):
+            return validator.validate(update)
+        for op, fields in update.iteritems():
+            if op in ('$set', '$setOnInsert', '$min', '$max'):
+                validator.validate(fields, fields.keys())
+            elif op == '$unset':
+                required = [k for k in fields if k in validator.required]
+                if required:
+                    raise ValueError("Required fields missing: %s" % (required))
+            elif op in ('$inc', '$mul'):
+                failed = [k for k, v in fields.iteritems() if isinstance(v, bool)
+                          or not isinstance(v, (int, long, float))]
+                if failed:
+                    raise ValueError("Keys did not match spec: %s" % (failed))
+            elif op in array_modifiers:
+                elements = _array_elements(op, fields)
+                validator.validate(elements, elements.keys())
+            elif op != '$pop':
+                unchecked = [k for k in fields if k in validator.by_key]
+                if unchecked:
+                    raise ValueError("%s can't be checked against the spec: %s" % (
+                        op, unchecked))
+
+    @classmethod
+    def _update_document(cls, document, modifiers):
+        """Merge the modifier keywords of ``update`` and ``find_and_modify``
+        into ``document`` and check the result."""
+        update = dict(document or {})
+        for name, fields in modifiers.iteritems():
+            if name not in update_modifiers:
+                raise TypeError("unknown update modifier %r" % name)
+            update.setdefault(update_modifiers[name], {}).update(fields)
+        if not update:
+            raise ValueError("an update needs a document or modifiers")
+        cls._check_update(update)
+        return update
+
+    @classmethod
+    def _forget(cls, spec):
+        """Drop documents that an update may have changed from the identity
+        map."""
+        imap = cls._connection_slot.connection.identity_map
+        if imap is not None:
+            _id = _lookup_id(spec)
+            if _id is None:
+                imap.clear(cls._collection_key)
+            else:
+                imap.discard(cls._collection_key, _id)
+
+    @classmethod
+    def _wrap(cls, document):
+        """Wrap a document returned by a command the way a cursor would."""
+        connection = cls._connection_slot.connection
+        return wrap_document(routed_class(connection, cls._collection_key), document)
+
+    def _update_where(cls, spec, document=None, upsert=False, multi=False, **modifiers):
+        """Atomically update the documents matching ``spec`` on the server,
+        without loading them.  The update is given as an update document,
+        as keywords naming modifiers, or both::
+
+            Post.update({'_id': post_id}, inc={'views': 1},
+                        push={'viewers': user_id})
+
+        The keywords are ``set``, ``unset``, ``inc``, ``push``, ``pull`` and
+        ``add_to_set``.  Only the modified fields are checked against the
+        spec.  Returns the result of ``Collection.update``."""
+        update = cls._update_document(document, modifiers)
+        result = cls._collection().update(spec, update, upsert=upsert, multi=multi)
+        cls._forget(spec)
+        return result
+
+    # Model.update(spec, ...) updates documents on the server, while
+    # instance.update(d) keeps the dict interface of OpenStruct
+    update = classinstancemethod(_update_where, _update)
+
+    @classmethod
+    def find_and_modify(cls, spec, document=None, sort=None, new=False,
+                        upsert=False, remove=False, fields=None, **modifiers):
+        """Atomically update (or with ``remove``, delete) the first document
+        matching ``spec`` in ``sort`` order, and return it wrapped in its
+        model.  The document is returned as it was before the update, or
+        after it if ``new`` is True;  None is returned if there was no match.
+        The update is given like it is to ``Model.update``."""
+        update = None
+        if not remove:
+            update = cls._update_document(document, modifiers)
+        kwargs = {'new': new, 'remove': remove}
+        if fields is not None:
+            kwargs['fields'] = fields
+        result = cls._collection().find_and_modify(spec, update, upsert=upsert,
+            sort=sort, **kwargs)
+        cls._forget(spec)
+        # pymongo returns {} for upserts that don't ask for the new document
+        if not result:
+            return None
+        return cls._wrap(result)
+
+    @classmethod
+    def aggregate(cls, pipeline, model=None, cache=None, **kwargs):
+        """Run an aggregation ``pipeline`` on this model's collection,
+        returning a cursor over the results.  The cursor caches and iterates
+        like the cursors from ``find``, and ``order_by``, ``sort``, ``skip``
+        and ``limit`` on it add stages to the end of the pipeline.
+
+        Results are dicts, since they rarely have the shape of the model's
+        documents, unless ``model`` is given as a model class or the
+        "db.collection" name of one, in which case they are wrapped in it."""
+        as_class = dict
+        if model is not None:
+            key = model if isinstance(model, basestring) else model._collection_key
+            as_class = AccountingMeta.collection_map.get(key)
+            if as_class is None:
+                raise ValueError("no model is registered for %r" % key)
+        return cls._collection().aggregate(pipeline, as_class=as_class,
+                                           cache=cache, **kwargs)
+
+    @classmethod
+    def count(cls, spec=None, **kwargs):
+        """Return the number of documents matching ``spec``.  Keyword
+        arguments are passed on to ``Model.find``."""
+        return cls.find(spec, **kwargs).count()
+
+    @classmethod
+    def distinct(cls, key, spec=None, **kwargs):
+        """Return the distinct values of ``key`` in the documents matching
+        ``spec``."""
+        return cls.find(spec, **kwargs).distinct(key)
+
+    @classmethod
+    def group(cls, key, condition, initial, reduce, finalize=None, **kwargs):
+        """Run a ``group`` command on this model's collection, returning a
+        list of dicts.  ``reduce`` and ``finalize`` are javascript, or with
+        the in-memory backend, python functions.  Prefer ``aggregate``, which
+        is faster on the server and not limited in its result size."""
+        return cls._collection().group(key, condition, initial, reduce,
+                                       finalize, **kwargs)
+
+    def _modify(self, modifier, key, value):
+        """Apply a single modifier to this document on the server, and set
+        the resulting value of ``key`` on it, returning the value."""
+        if '_id' not in self:
+            raise ValueError("%s must be saved before it can be modified" % (
+                self.__class__.__name__))
+        update = self._update_document(None, {modifier: {key: value}})
+        top = key.split('.')[0]
+        result = self._collection().find_and_modify({'_id': self['_id']},
+            update, new=True, fields={top: 1})
+        if result is None:
+            raise ValueError("%s %r does not exist" % (self.__class__.__name__,
+                self['_id']))
+        if top in result:
+            self[top] = result[top]
+        else:
+            del self[top]
+        # the server already has this value
+        if self._dirty is not None:
+            self._dirty.discard(top)
+            self._remember(top, self[top] if top in self else None)
+        for part in key.split('.'):
+            result = result.get(part) if isinstance(result, dict) else None
+        return result
+
+    def inc(self, key, amount=1):
+        """Atomically increment ``key`` by ``amount``, returning its new
+        value.  Like the other atomic methods, this updates the document on
+        the server in one round trip, and sets the key's new value here."""
+        return self._modify('inc', key, amount)
+
+    def push(self, key, value):
+        """Atomically append ``value`` to the list at ``key``."""
+        return self._modify('push', key, value)
+
+    def pull(self, key, value):
+        """Atomically remove all occurrences of ``value`` from ``key``."""
+        return self._modify('pull', key, value)
+
+    def add_to_set(self, key, value):
+        """Atomically append ``value`` to ``key`` if it isn't in it yet."""
+        return self._modify('add_to_set', key, value)
+
     def __repr__(self):
         return '<%s: %s>' % (self.__class__.__name__, pformat(dict(self)))
 
+
+
+class LazyModel(Model):
+    """A Model which is created from a raw bson document with ``from_bson``,
+    and which only decodes each of its fields the first time it is accessed.
+    Only the key index of the document is built up front, so documents with
+    large embedded values that are never looked at never pay to decode
+    them.  Operations on the whole document, like ``items`` or ``dict()``,
+    decode every remaining field first.  Values that have been set on the
+    document always take precedence over its undecoded ones.
+
+    Only documents made with ``from_bson`` (which includes those read from a
+    snapshot) are lazy.  Cursors decode whole documents before they are
+    wrapped, so a ``LazyModel`` returned by ``find`` or ``find_one`` has
+    every field decoded already;  use ``fields`` to keep large values from
+    being read at all."""
+    __slots__ = ('_bson', '_offsets')
+
+    def __init__(self, *d, **dd):
+        self._clear_bson()
+        super(LazyModel, self).__init__(*d, **dd)
+
+    def _clear_bson(self):
+        object.__setattr__(self, '_bson', None)
+        object.__setattr__(self, '_offsets', None)
+
+    @classmethod
+    def from_bson(cls, data):
+        """Create an instance from the bson document ``data``.  Changes to
+        the instance are tracked as they are for loaded documents."""
+        new = cls()
+        object.__setattr__(new, '_bson', data)
+        object.__setattr__(new, '_offsets', bson_index(data))
+        new._loaded()
+        return new
+
+    def _decode(self, key):
+        offsets = self._offsets
+        if offsets and key in offsets:
+            start, end = offsets.pop(key)
+            if key not in self.__dict__:
+                self._decode_value(key, start, end)
+            if not offsets:
+                self._clear_bson()
+
+    def _decode_value(self, key, start, end):
+        value = self.__dict__[key] = bson_decode_element(self._bson, start, end)
+        # it is as loaded, so later changes to it in place are compared to it
+        if self._dirty is not None:
+            self._remember(key, value)
+
+    def _hydrate(self):
+        if self._offsets is not None:
+            for key, (start, end) in self._offsets.iteritems():
+                if key not in self.__dict__:
+                    self._decode_value(key, start, end)
+            self._clear_bson()
+
+    def _discard(self, key):
+        if self._offsets is not None:
+            self._offsets.pop(key, None)
+
+    def __getitem__(self, item):
+        self._decode(item)
+        return super(LazyModel, self).__getitem__(item)
+
+    def __setitem__(self, item, value):
+        self._discard(item)
+        super(LazyModel, self).__setitem__(item, value)
+
+    def __delitem__(self, item):
+        if item in (self._offsets or ()):
+            self._discard(item)
+            self.__dict__.setdefault(item, None)
+        super(LazyModel, self).__delitem__(item)
+
+    def __contains__(self, item):
+        return item in self.__dict__ or item in (self._offsets or ())
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def _get(self, key, *args):
+        self._decode(key)
+        return self.__dict__.get(key, *args)
+    get = classinstancemethod(Model._get_by_id.im_func, _get)
+
+    def keys(self):
+        keys = self.__dict__.keys()
+        if self._offsets:
+            keys.extend([k for k in self._offsets if k not in self.__dict__])
+        return keys
+    def iterkeys(self): return iter(self.keys())
+
+    def values(self):
+        self._hydrate()
+        return self.__dict__.values()
+    def itervalues(self):
+        self._hydrate()
+        return self.__dict__.itervalues()
+    def items(self):
+        self._hydrate()
+        return self.__dict__.items()
+    def iteritems(self):
+        self._hydrate()
+        return self.__dict__.iteritems()
+
+    def _update(self, d):
+        for key in d.keys():
+            self._discard(key)
+        Model._update(self, d)
+    update = classinstancemethod(Model._update_where.im_func, _update)
+
+    def clear(self):
+        if self._dirty is not None:
+            self._dirty.update(self.keys())
+        self._clear_bson()
+        self.__dict__.clear()
+
+
+class ShadowedKey(object):
+    """A spec key of a closed model which has the name of an attribute of
+    the model.  On documents, it is the key's value when the document has
+    one, as it would be on a dict backed model, and the model's attribute
+    otherwise;  on the class, it is always the model's attribute."""
+    def __init__(self, name):
+        self.name = name
+
+    def __get__(self, obj, cls):
+        compact = cls._compact_class
+        if obj is not None:
+            overflow = obj._overflow
+            if overflow and self.name in overflow:
+                return overflow[self.name]
+            return getattr(super(compact, obj), self.name)
+        return getattr(super(compact, cls), self.name)
+
+def _new_compact(cls, *args, **kwargs):
+    return object.__new__(cls._compact_class or cls)
+
+class CompactStruct(object):
+    """The dict interface of ``OpenStruct`` for the slotted subclasses that
+    are generated for closed models.  Each key in the spec (plus ``_id``)
+    gets a slot, and any other keys are kept in an ``_overflow`` dict which
+    is only created when needed.  These classes never touch the instance
+    ``__dict__`` they inherit, so python never allocates one, which saves
+    most of the per-document overhead of a dict backed ``OpenStruct``."""
+    __slots__ = ()
+    _slots = ()
+    _slotset = frozenset()
+
+    @staticmethod
+    def make_class(cls):
+        """Create the slotted subclass for the model class ``cls``."""
+        keys = ['_id'] + sorted(getattr(cls, 'spec', None) or {})
+        slots, shadowed = [], []
+        for key in keys:
+            if not isinstance(key, basestring) or key in slots:
+                continue
+            # keys that aren't identifiers or would shadow private attributes
+            # live in the overflow;  those that shadow public attributes of
+            # the model (like ``count`` or ``update``) do too, but get a
+            # ``ShadowedKey`` so attribute access still finds their values
+            if not _identifier.match(key) or key.startswith('__'):
+                continue
+            if hasattr(cls, key):
+                if not key.startswith('_'):
+                    shadowed.append(str(key))
+            else:
+                slots.append(str(key))
+        attrs = {
+            '__slots__': tuple(slots) + ('_overflow',),
+            '__module__': cls.__module__,
+            '__doc__': cls.__doc__,
+            '_slots': tuple(slots),
+            '_slotset': frozenset(slots),
+        }
+        for key in shadowed:
+            attrs[key] = ShadowedKey(key)
+        # bypass AccountingMeta.__new__ so the subclass isn't registered
+        return type.__new__(type(cls), cls.__name__, (CompactStruct, cls), attrs)
+
+    def __init__(self, *d, **dd):
+        object.__setattr__(self, '_overflow', None)
+        object.__setattr__(self, '_dirty', None)
+        object.__setattr__(self, '_originals', None)
+        self.update(d[0] if d and not dd else dd)
+
+    def __setattr__(self, name, value):
+        if name not in self._slotset and data_descriptor(type(self), name):
+            object.__setattr__(self, name, value)
+        else:
+            self[name] = value
+
+    def __delattr__(self, name):
+        if name not in self._slotset and data_descriptor(type(self), name):
+            object.__delattr__(self, name)
+        else:
+            del self[name]
+
+    def __getitem__(self, item):
+        if item in self._slotset:
+            return object.__getattribute__(self, item)
+        overflow = self._overflow
+        if overflow and item in overflow:
+            return overflow[item]
+        return object.__getattribute__(self, item)
+
+    def __setitem__(self, item, value):
+        if item in self._slotset:
+            object.__setattr__(self, item, value)
+        elif self._overflow is None:
+            object.__setattr__(self, '_overflow', {item: value})
+        else:
+            self._overflow[item] = value
+        if self._dirty is not None:
+            self._dirty.add(item)
+
+    def __delitem__(self, item):
+        if item in self._slotset:
+            try: object.__delattr__(self, item)
+            except AttributeError: return
+        elif self._overflow and item in self._overflow:
+            del self._overflow[item]
+        else:
+            return
+        if self._dirty is not None:
+            self._dirty.add(item)
+
+    def __contains__(self, item):
+        if item in self._slotset:
+            try: object.__getattribute__(self, item)
+            except AttributeError: return False
+            return True
+        return bool(self._overflow) and item in self._overflow
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def iteritems(self):
+        get = object.__getattribute__
+        for name in self._slots:
+            try: yield name, get(self, name)
+            except AttributeError: pass
+        if self._overflow:
+            for item in self._overflow.iteritems():
+                yield item
+
+    def _get(self, key, *args):
+        if key in self:
+            return self[key]
+        return args[0] if args else None
+    get = classinstancemethod(Model._get_by_id.im_func, _get)
+
+    def items(self): return list(self.iteritems())
+    def keys(self): return [k for k, v in self.iteritems()]
+    def iterkeys(self): return iter(self.keys())
+    def values(self): return [v for k, v in self.iteritems()]
+    def itervalues(self): return iter(self.values())
+
+    def _update(self, d):
+        for key in d.keys():
+            self[key] = d[key]
+    update = classinstancemethod(Model._update_where.im_func, _update)
+
+    def _mutable_items(self):
+        return [(k, v) for k, v in self.iteritems()
+                if isinstance(v, (dict, list, OpenStruct))]
+
+    def clear(self):
+        if self._dirty is not None:
+            self._dirty.update(self.keys())
+        for name in self._slots:
+            try: object.__delattr__(self, name)
+            except AttributeError: pass
+        object.__setattr__(self, '_overflow', None)
@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Instrumentation of micromongo's queries and saves.  Listeners are
+callables which are passed a ``QueryEvent`` for every query run through a
+micromongo cursor and every ``Model.save``::
+
+    from micromongo import monitoring
+
+    monitoring.register(monitoring.SlowQueryLogger(threshold=0.2))
+
+With no listeners registered, nothing is timed;  cursors and saves only
+check whether the listener list is empty.
+
+Cursor events are published once a cursor is exhausted or closed, so
+cursors which are abandoned before then (including the one ``find_one``
+reads its document from) are not reported by the cursor;  ``Model.find_one``
+publishes its own event instead."""
+
+import logging
+import threading
+from bisect import bisect_left
+
+__all__ = ['QueryEvent', 'register', 'unregister', 'publish',
+           'SlowQueryLogger', 'PrometheusExporter']
+
+# the list is replaced rather than changed, so it can be iterated over
+# without locking while listeners are registered from other threads
+listeners = []
+__lock = threading.Lock()
+
+def register(listener):
+    """Register ``listener`` to be called with every ``QueryEvent``."""
+    global listeners
+    with __lock:
+        listeners = listeners + [listener]
+
+def unregister(listener):
+    """Unregister a listener registered with ``register``."""
+    global listeners
+    with __lock:
+        listeners = [l for l in listeners if l is not listener]
+
+class QueryEvent(object):
+    """The timing of one operation.  ``server_time`` is the time spent
+    waiting on the database;  with pymongo, this includes decoding the bson
+    of the returned documents into their classes, which the driver does as
+    they arrive.  ``decode_time`` is the remaining time spent preparing
+    results in micromongo, and ``validate_time`` the time spent validating
+    documents against their spec.  All times are in seconds."""
+    __slots__ = ('collection', 'operation', 'spec', 'sort', 'returned',
+                 'server_time', 'decode_time', 'validate_time')
+
+    def __init__(self, collection, operation, spec=None, sort=None, returned=0,
+                 server_time=0.0, decode_time=0.0, validate_time=0.0):
+        self.collection = collection
+        self.operation = operation
+        self.spec = spec
+        self.sort = sort
+        self.returned = returned
+        self.server_time = server_time
+        self.decode_time = decode_time
+        self.validate_time = validate_time
+
+    @property
+    def duration(self):
+        return self.server_time + self.decode_time + self.validate_time
+
+    def __repr__(self):
+        return '<QueryEvent %s %s %r: %d in %.4fs>' % (self.operation,
+            self.collection, self.spec, self.returned, self.duration)
+
+def publish(event):
+    """Pass ``event`` to every listener.  Exceptions raised by listeners are
+    logged rather than raised into the code being instrumented."""
+    for listener in listeners:
+        try:
+            listener(event)
+        except Exception:
+            logging.getLogger('micromongo').exception(
+                "query listener %r failed", listener)
+
+class CursorTimer(object):
+    """Accumulates the timing of a cursor's results until it publishes its
+    event.  Made by cursors only while there are listeners."""
+    __slots__ = ('total', 'server_time', 'returned', 'published')
+
+    def __init__(self):
+        self.total = 0.0
+        self.server_time = 0.0
+        self.returned = 0
+        self.published = False
+
+    def finish(self, collection, spec, sort, operation='find'):
+        if self.published:
+            return
+        self.published = True
+        publish(QueryEvent(collection, operation, spec, sort, self.returned,
+            self.server_time, max(self.total - self.server_time, 0.0)))
+
+class SlowQueryLogger(object):
+    """A listener which logs operations taking ``threshold`` seconds or more
+    as warnings to ``logger``, which defaults to the "micromongo.slow"
+    logger."""
+    def __init__(self, threshold=0.1, logger=None):
+        self.threshold = threshold
+        self.logger = logger or logging.getLogger('micromongo.slow')
+
+    def __call__(self, event):
+        if event.duration >= self.threshold:
+            self.logger.warning("slow %s on %s: %.3fs (server %.3fs, decode "
+                "%.3fs, validate %.3fs), %d documents, spec=%r sort=%r",
+                event.operation, event.collection, event.duration,
+                event.server_time, event.decode_time, event.validate_time,
+                event.returned, event.spec, event.sort)
+
+class PrometheusExporter(object):
+    """A listener which keeps prometheus style counters and histograms of
+    operations per collection and operation.  ``render`` returns them in
+    prometheus' text exposition format, to be served from a metrics
+    endpoint."""
+    default_buckets = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+                       2.5, 5.0, 10.0)
+
+    def __init__(self, buckets=default_buckets, prefix='micromongo'):
+        self.buckets = tuple(sorted(buckets))
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.series = {}
+
+    def __call__(self, event):
+        labels = (event.collection, event.operation)
+        bucket = bisect_left(self.buckets, event.duration)
+        with self.lock:
+            series = self.series.get(labels)
+            if series is None:
+                series = self.series[labels] = {
+                    'count': 0, 'documents': 0, 'sum': 0.0, 'server': 0.0,
+                    'decode': 0.0, 'validate': 0.0,
+                    'buckets': [0] * (len(self.buckets) + 1),
+                }
+            series['count'] += 1
+            series['documents'] += event.returned
+            series['sum'] += event.duration
+            series['server'] += event.server_time
+            series['decode'] += event.decode_time
+            series['validate'] += event.validate_time
+            series['buckets'][bucket] += 1
+
+    def render(self):
+        """Return the current metrics in prometheus' text format."""
+        p = self.prefix
+        lines = [
+            '# TYPE %s_operations_total counter' % p,
+            '# TYPE %s_documents_total counter' % p,
+            '# TYPE %s_seconds_total counter' % p,
+            '# TYPE %s_operation_seconds histogram' % p,
+        ]
+        with self.lock:
+            series = sorted((k, dict(v, buckets=list(v['buckets'])))
+                            for k, v in self.series.iteritems())
+        for (collection, operation), s in series:
+            labels = 'collection="%s",operation="%s"' % (collection, operation)
+            lines.append('%s_operations_total{%s} %d' % (p, labels, s['count']))
+            lines.append('%s_documents_total{%s} %d' % (p, labels, s['documents']))
+            for phase in ('server', 'decode', 'validate'):
+                lines.append('%s_seconds_total{%s,phase="%s"} %r' % (
+                    p, labels, phase, s[phase]))
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), s['buckets']):
+                cumulative += count
+                lines.append('%s_operation_seconds_bucket{%s,le="%s"} %d' % (
+                    p, labels, bound, cumulative))
+            lines.append('%s_operation_seconds_sum{%s} %r' % (p, labels, s['sum']))
+            lines.append('%s_operation_seconds_count{%s} %d' % (p, labels, s['count']))
+        return '\n'.join(lines) + '\n'
+
+    def reset(self):
+        with self.lock:
+            self.series.clear()
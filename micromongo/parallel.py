@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Parallel scans of a model's collection, for batch jobs that would
+otherwise read a whole collection through one cursor::
+
+    for user in User.parallel_scan({'active': True}, workers=8):
+        ...
+
+    totals = User.parallel_scan(workers=8, mode='process', map=summarize)
+
+The collection is split into ranges of a key (``_id`` by default) holding
+about the same number of documents, and each range is read in chunks by a
+pool of ``workers`` threads or, with ``mode='process'``, processes.  The key
+should be unique, indexed and of the same type in every document, like
+``_id``;  documents whose key is missing or of another type are not scanned.
+
+Results are yielded as they arrive, or in key order if ``ordered`` is True.
+At most ``max_queued`` results are read ahead of the consumer;  a slow
+consumer holds the workers back rather than letting results pile up.  A
+chunk that fails with a ``PyMongoError`` is retried, up to ``retries``
+times, from where its range left off.
+
+With ``map``, the function is applied to each document in the workers and
+its results are yielded instead.  In process mode, the model, ``map`` and
+its results must be picklable, so the model has to be importable by name;
+each process connects with the arguments its alias was connected with."""
+
+import os
+import time
+from collections import deque
+
+from pymongo.errors import PyMongoError
+
+try:
+    from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, \
+        wait, FIRST_COMPLETED
+except ImportError:
+    ThreadPoolExecutor = ProcessPoolExecutor = None
+
+from micromongo.backend import ModelSONManipulator
+from micromongo.utils import get_path
+
+__all__ = ['parallel_scan', 'split_points']
+
+retry_delay = 0.1
+
+def split_points(collection, spec, key, parts):
+    """Return up to ``parts - 1`` increasing values of ``key`` which split
+    the documents matching ``spec`` into ``parts`` ranges of about the same
+    size."""
+    count = collection.find(spec).count()
+    points = []
+    if parts < 2 or count < parts:
+        return points
+    for i in range(1, parts):
+        for document in collection.find(spec, [key]).sort(key, 1) \
+                .skip(i * count // parts).limit(1):
+            value = get_path(document, key)
+            if value is not None and (not points or value != points[-1]):
+                points.append(value)
+    return points
+
+def range_spec(spec, key, low, high, after):
+    """The query for the documents of ``spec`` in the range ``[low, high)``
+    of ``key`` that come after ``after``."""
+    condition = {}
+    if after is not None:
+        condition['$gt'] = after
+    elif low is not None:
+        condition['$gte'] = low
+    if high is not None:
+        condition['$lt'] = high
+    if not condition:
+        return spec
+    if not spec:
+        return {key: condition}
+    return {'$and': [spec, {key: condition}]}
+
+def scan_chunk(model, query, key, limit, find_args, map, attempt):
+    """Read up to ``limit`` documents matching ``query`` in ``key`` order,
+    returning them (or the results of ``map`` on them), the last key read
+    and the number of documents read."""
+    if attempt:
+        time.sleep(retry_delay * attempt)
+    args, kwargs = find_args
+    cursor = model.find(query, *args, **kwargs).sort(key, 1).limit(limit)
+    documents = cursor.fetch(limit)
+    last = get_path(documents[-1], key) if documents else None
+    if map is not None:
+        documents = [map(d) for d in documents]
+    return documents, last, len(documents)
+
+__process_pid = None
+
+def scan_chunk_process(model, alias_args, query, key, limit, find_args, map, attempt):
+    """``scan_chunk`` in a worker process, which connects first if it
+    hasn't yet, and returns documents as dicts that can be pickled."""
+    global __process_pid
+    if __process_pid != os.getpid():
+        from micromongo.models import connect
+        connect(*alias_args[0], alias=model._connection_slot.alias, **alias_args[1])
+        __process_pid = os.getpid()
+    documents, last, count = scan_chunk(model, query, key, limit, find_args, map, attempt)
+    if map is None:
+        manipulator = ModelSONManipulator()
+        documents = [manipulator.transform_incoming(dict(d), None) for d in documents]
+    return documents, last, count
+
+class Range(object):
+    __slots__ = ('low', 'high', 'after', 'done', 'attempts', 'buffer', 'running')
+    def __init__(self, low, high):
+        self.low = low
+        self.high = high
+        self.after = None
+        self.done = False
+        self.attempts = 0
+        self.buffer = deque()
+        self.running = False
+
+def parallel_scan(model, spec=None, workers=4, mode='thread', key='_id',
+                  map=None, ordered=False, retries=2, max_queued=10000,
+                  splits=None, fields=None, **kwargs):
+    """Scan the documents of ``model`` matching ``spec`` in parallel,
+    returning an iterator over them (or over the results of ``map``).
+    ``splits`` is the number of ranges to split the collection into,
+    ``workers * 4`` by default, and ``fields`` and the other keyword
+    arguments are passed along to ``Model.find``."""
+    if mode not in ('thread', 'process'):
+        raise ValueError("mode must be 'thread' or 'process', not %r" % mode)
+    if ThreadPoolExecutor is None:
+        raise ImportError("parallel scans require concurrent.futures; "
+            "install the `futures` package on python 2")
+    spec = spec or {}
+    find_args = ((), dict(kwargs, cache=False))
+    if fields is not None:
+        if not isinstance(fields, dict) and key not in fields:
+            fields = list(fields) + [key]
+        find_args = ((fields,), find_args[1])
+    points = split_points(model._collection(), spec, key, splits or workers * 4)
+    bounds = [None] + points + [None]
+    ranges = [Range(low, high) for low, high in zip(bounds, bounds[1:])]
+    chunk_size = max(1, max_queued // (workers * 2))
+    return _scan(model, spec, key, ranges, workers, mode, map, ordered, retries,
+                 max_queued, chunk_size, find_args)
+
+def _scan(model, spec, key, ranges, workers, mode, map, ordered, retries,
+          max_queued, chunk_size, find_args):
+    if mode == 'process':
+        executor = ProcessPoolExecutor(max_workers=workers)
+        alias_args = model._connection_slot.args
+        task = lambda r: executor.submit(scan_chunk_process, model, alias_args,
+            range_spec(spec, key, r.low, r.high, r.after), key, chunk_size,
+            find_args, map, r.attempts)
+    else:
+        executor = ThreadPoolExecutor(max_workers=workers)
+        task = lambda r: executor.submit(scan_chunk, model,
+            range_spec(spec, key, r.low, r.high, r.after), key, chunk_size,
+            find_args, map, r.attempts)
+    running, queued, current = {}, 0, 0
+
+    def submit():
+        # earlier ranges first, so that ordered scans can drain them;  the
+        # range an ordered scan is waiting on is read even if the queue is
+        # full of later ranges
+        for r in ranges:
+            if len(running) >= workers:
+                break
+            if queued >= max_queued and not (ordered and r is ranges[current]):
+                continue
+            if not r.done and not r.running:
+                r.running = True
+                running[task(r)] = r
+
+    try:
+        while current < len(ranges):
+            submit()
+            if running:
+                finished = wait(list(running), return_when=FIRST_COMPLETED)[0]
+                for future in finished:
+                    r = running.pop(future)
+                    r.running = False
+                    try:
+                        documents, last, count = future.result()
+                    except PyMongoError:
+                        r.attempts += 1
+                        if r.attempts > retries:
+                            raise
+                        continue
+                    r.attempts = 0
+                    r.after = last if last is not None else r.after
+                    r.done = count < chunk_size
+                    if documents:
+                        r.buffer.append(documents)
+                        queued += len(documents)
+            for r in (ranges[current:] if ordered else ranges):
+                while r.buffer:
+                    documents = r.buffer.popleft()
+                    queued -= len(documents)
+                    for document in documents:
+                        if mode == 'process' and map is None:
+                            document = model._wrap(document)
+                        yield document
+                if ordered and not r.done:
+                    break
+            while current < len(ranges) and ranges[current].done and \
+                    not ranges[current].buffer:
+                current += 1
+    finally:
+        for future in running:
+            future.cancel()
+        executor.shutdown(wait=False)
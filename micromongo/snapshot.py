@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""On-disk snapshots of read-mostly collections, like geo tables or product
+catalogs, which every worker would otherwise load with ``find`` and keep a
+copy of::
+
+    Country.snapshot('/var/cache/app/countries.snap', keys=['iso2'])
+
+    countries = Country.open_snapshot('/var/cache/app/countries.snap')
+    countries.get(country_id)
+    countries.find('iso2', 'FR')
+    countries.range('_id', low, high)
+
+A snapshot file holds the documents as bson, in ``_id`` order, followed by
+an index on ``_id`` and on each of the secondary ``keys`` (which may be
+dotted).  An open snapshot memory-maps the file and reads documents and
+index entries straight from the map, so processes which open the same file
+(or fork after opening it) share its pages rather than each holding a copy
+of the collection.  Documents are decoded when they are read, into the class
+the model router gives for the snapshot's collection;  a ``LazyModel``
+decodes each field only when it is accessed.
+
+Keys are ordered as mongodb orders values of different types, and values
+that are missing from a document are indexed as None.  Snapshots are
+read-only;  to refresh one, write it again, which replaces the file
+atomically.  Processes that still have the old file open keep reading it."""
+
+import os
+import mmap
+import struct
+from bisect import bisect_left
+
+from bson import BSON
+
+from micromongo.backend import wrap_document
+from micromongo.memory import sort_key
+from micromongo.utils import get_path
+
+__all__ = ['write_snapshot', 'Snapshot']
+
+MAGIC = 'MMSNAP01'
+
+_int32 = struct.Struct('<i')
+_uint64 = struct.Struct('<Q')
+# the footer:  the offset of the header document, then the magic again
+_footer = struct.Struct('<Q8s')
+
+def write_snapshot(path, documents, collection, keys=()):
+    """Write the dicts ``documents`` of ``collection`` to a snapshot at
+    ``path``, with indexes on ``_id`` and on each of ``keys``.  Returns the
+    number of documents written."""
+    keys = ['_id'] + [k for k in keys if k != '_id']
+    entries = dict((key, []) for key in keys)
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    try:
+        with open(tmp, 'wb') as f:
+            f.write(MAGIC)
+            offset = len(MAGIC)
+            for position, document in enumerate(documents):
+                data = BSON.encode(document)
+                f.write(data)
+                for key in keys:
+                    entries[key].append((sort_key(get_path(document, key)), position,
+                                         get_path(document, key), offset))
+                offset += len(data)
+            count = len(entries['_id'])
+            indexes = {}
+            for key in keys:
+                indexes[key] = offset
+                offset = write_index(f, offset, sorted(entries[key]))
+            header = BSON.encode({'collection': collection, 'count': count,
+                                  'keys': keys, 'indexes': indexes})
+            f.write(header)
+            f.write(_footer.pack(offset, MAGIC))
+        os.rename(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    return count
+
+def write_index(f, offset, entries):
+    """Write an index of sorted ``entries`` at ``offset``:  a table of the
+    offsets of its entries, then the entries themselves, each a bson
+    document of the key's value and the offset of its document.  Returns
+    the offset after the index."""
+    encoded = [BSON.encode({'k': value, 'o': document})
+               for _, _, value, document in entries]
+    position = offset + _uint64.size * len(encoded)
+    table = []
+    for data in encoded:
+        table.append(_uint64.pack(position))
+        position += len(data)
+    f.write(''.join(table))
+    f.write(''.join(encoded))
+    return position
+
+class SnapshotIndex(object):
+    """The sorted entries of one key of a snapshot, searched in place."""
+    def __init__(self, snapshot, offset):
+        self.map = snapshot.map
+        self.offset = offset
+        self.count = snapshot.count
+
+    def __len__(self):
+        return self.count
+
+    def entry(self, i):
+        start = _uint64.unpack_from(self.map, self.offset + i * _uint64.size)[0]
+        end = start + _int32.unpack_from(self.map, start)[0]
+        return BSON(self.map[start:end]).decode()
+
+    def __getitem__(self, i):
+        # bisect compares the sort keys of the entries
+        return sort_key(self.entry(i)['k'])
+
+    def bisect(self, value):
+        return bisect_left(self, sort_key(value))
+
+    def offsets(self, start, stop):
+        for i in xrange(start, stop):
+            yield self.entry(i)['o']
+
+    def matches(self, value):
+        """The offsets of the documents whose key is ``value``;  rather than
+        searching for the end of the run, it is read until the key changes."""
+        key = sort_key(value)
+        for i in xrange(self.bisect(value), self.count):
+            entry = self.entry(i)
+            if sort_key(entry['k']) != key:
+                break
+            yield entry['o']
+
+class Snapshot(object):
+    """A snapshot file opened with ``open_snapshot``.  ``router`` is called
+    with the snapshot's collection to get the class of its documents."""
+    def __init__(self, path, router=None):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        footer = self.map[-_footer.size:]
+        if self.map[:len(MAGIC)] != MAGIC or len(footer) != _footer.size or \
+                _footer.unpack(footer)[1] != MAGIC:
+            self.map.close()
+            raise ValueError("%s is not a micromongo snapshot" % path)
+        start = _footer.unpack(footer)[0]
+        header = BSON(self.map[start:len(self.map) - _footer.size]).decode()
+        self.collection = header['collection']
+        self.count = header['count']
+        self.keys = header['keys']
+        self.indexes = dict((key, SnapshotIndex(self, offset))
+                            for key, offset in header['indexes'].iteritems())
+        as_class = router(self.collection) if router is not None else dict
+        self.as_class = as_class if isinstance(as_class, type) else type(as_class)
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        """Iterate over the documents in ``_id`` order."""
+        return self.range('_id')
+
+    def __contains__(self, _id):
+        return self.get(_id) is not None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Unmap the file.  Documents already read stay usable."""
+        self.map.close()
+
+    def document(self, offset):
+        """Decode the document at ``offset`` into the snapshot's class."""
+        data = self.map[offset:offset + _int32.unpack_from(self.map, offset)[0]]
+        as_class = self.as_class
+        from_bson = getattr(as_class, 'from_bson', None)
+        if from_bson is not None:
+            return from_bson(data)
+        return wrap_document(as_class, BSON(data).decode())
+
+    def index(self, key):
+        try:
+            return self.indexes[key]
+        except KeyError:
+            raise KeyError("snapshot of %s has no index on %r (it has %s)" % (
+                self.collection, key, ', '.join(self.keys)))
+
+    def get(self, _id, default=None):
+        """The document with ``_id``, or ``default`` if there isn't one."""
+        for document in self.find('_id', _id):
+            return document
+        return default
+
+    def find(self, key, value):
+        """Iterate over the documents whose indexed ``key`` is ``value``."""
+        return (self.document(o) for o in self.index(key).matches(value))
+
+    def range(self, key, low=None, high=None):
+        """Iterate, in ``key`` order, over the documents whose indexed
+        ``key`` is at least ``low`` and less than ``high``;  a bound of None
+        leaves that end of the range open."""
+        index = self.index(key)
+        start = index.bisect(low) if low is not None else 0
+        stop = index.bisect(high) if high is not None else len(index)
+        return (self.document(o) for o in index.offsets(start, stop))
@@ -3,13 +3,42 @@
 
 """micromongo spec documents & validation"""
 
-from functools import partial
 from uuid import uuid4
 
-__all__ = ['validate', 'make_default', 'Field']
+from micromongo.utils import OpenStruct
+
+__all__ = ['validate', 'make_default', 'compile_spec', 'Field', 'Ref']
 
 no_default = uuid4().hex
 
+def _always(value):
+    return True
+
+class InstanceCheck(object):
+    """A typecheck that passes if a value is an instance of ``types``."""
+    def __init__(self, types):
+        self.types = types
+    def __call__(self, value):
+        return isinstance(value, self.types)
+
+class EnumCheck(object):
+    """A typecheck that passes if a value is one of ``values``.  Hashable
+    values are looked up in a frozenset;  the original sequence is kept
+    around for unhashable values and values that can't be hashed."""
+    def __init__(self, values):
+        self.values = values
+        try:
+            self.lookup = frozenset(values)
+        except TypeError:
+            self.lookup = None
+    def __call__(self, value):
+        if self.lookup is not None:
+            try:
+                return value in self.lookup
+            except TypeError:
+                pass
+        return value in self.values
+
 class Field(object):
     """A base Field type, which itself can be used pretty reasonably to get
     type coersion, field defaults, etc.  If ``required`` is True, then
@@ -43,23 +72,16 @@ class Field(object):
         If none of these conditions are met, a TypeError is raised.
         """
         if t is None:
-            return lambda x: True
-
-        def _isinstance(types, value):
-            return isinstance(value, types)
-
-        def _enum(values, value):
-            return value in values
-
+            return _always
         if t.__class__ is type:
-            return partial(_isinstance, t)
+            return InstanceCheck(t)
         elif isinstance(t, (tuple, list)):
             if all([x.__class__ is type for x in t]):
-                return partial(_isinstance, t)
-            return partial(_enum, t)
+                return InstanceCheck(tuple(t))
+            return EnumCheck(t)
         elif callable(t):
             return t
-        raise TypeError('%r is not a valid field type' % r)
+        raise TypeError('%r is not a valid field type' % t)
 
     def _get_default(self):
         if self.required:
@@ -85,6 +107,43 @@ class Field(object):
             raise ValueError('%r failed type check' % value)
         return value
 
+class RefCheck(object):
+    """A typecheck for references, which checks the ids of the documents
+    in them, or the ids themselves, with ``check``."""
+    def __init__(self, check, many):
+        self.check = check
+        self.many = many
+    def __call__(self, value):
+        if not self.many:
+            return self.check(reference_id(value))
+        return isinstance(value, list) and \
+            all(self.check(reference_id(v)) for v in value)
+
+def reference_id(value):
+    """The id stored for a reference to ``value``, a document or an id."""
+    return value['_id'] if isinstance(value, OpenStruct) else value
+
+class Ref(Field):
+    """A reference to a document in another collection, which is stored as
+    that document's ``_id``.  ``collection`` is the full name of the
+    collection referred to, and ``type`` checks the ids.  With ``many``,
+    the value is a list of references.
+
+    A cursor's ``populate`` replaces the ids in references with the
+    documents they refer to;  a reference may hold either, and is always
+    saved as the ids."""
+    def __init__(self, collection, required=False, default=None, type=None, many=False):
+        super(Ref, self).__init__(required, default, type)
+        self.collection = collection
+        self.many = many
+        self._typecheck = RefCheck(self._typecheck, many)
+
+    def stored(self, value):
+        """The ids stored for the reference ``value``."""
+        if self.many and isinstance(value, list):
+            return [reference_id(v) for v in value]
+        return reference_id(value)
+
 def make_default(spec):
     """Create an empty document that follows spec.  Any field with a default
     will take that value, required or not.  Required fields with no default
@@ -97,28 +156,105 @@ def make_default(spec):
             doc[key] = field.default
     return doc
 
+# the kinds of checks a compiled spec can run inline
+CHECK_NONE, CHECK_INSTANCE, CHECK_ENUM, CHECK_CALL, CHECK_FIELD = range(5)
+
+class CompiledSpec(object):
+    """A spec document compiled down to a flat tuple of per-field checks.
+    Compiling does the work that ``validate`` would otherwise redo on every
+    call:  the required keys are collected once, ``pre_validate`` is only
+    dispatched for fields that override it, and the common typechecks are
+    run inline rather than through a function call.  Fields that override
+    ``validate`` itself are always validated through that method."""
+    def __init__(self, spec):
+        self.spec = spec
+        spec = spec or {}
+        self.required = tuple([k for k, f in spec.iteritems() if f.required])
+        self.checks = tuple([(k,) + self.compile_field(f)
+            for k, f in spec.iteritems()])
+        self.by_key = dict((check[0], check) for check in self.checks)
+
+    @staticmethod
+    def compile_field(field):
+        """Return a ``(pre_validate, kind, arg)`` tuple for a field."""
+        cls = field.__class__
+        if cls.validate.im_func is not Field.validate.im_func:
+            return (None, CHECK_FIELD, field.validate)
+        pre = None
+        if cls.pre_validate.im_func is not Field.pre_validate.im_func:
+            pre = field.pre_validate
+        check = field._typecheck
+        if check is _always:
+            return (pre, CHECK_NONE, None)
+        if check.__class__ is InstanceCheck:
+            return (pre, CHECK_INSTANCE, check.types)
+        if check.__class__ is EnumCheck and check.lookup is not None:
+            return (pre, CHECK_ENUM, check)
+        return (pre, CHECK_CALL, check)
+
+    def __nonzero__(self):
+        return bool(self.spec)
+
+    def validate(self, document, keys=None):
+        """Validate ``document`` against this spec;  behaves exactly like
+        ``micromongo.spec.validate``.  If ``keys`` is given, only those keys
+        of the document are validated."""
+        if not self.checks:
+            return True
+        if keys is None:
+            required, checks = self.required, self.checks
+        else:
+            required = [k for k in self.required if k in keys]
+            checks = [self.by_key[k] for k in keys if k in self.by_key]
+        missing = [k for k in required if k not in document]
+        failed = []
+        for key, pre, kind, arg in checks:
+            if key not in document:
+                continue
+            value = document[key]
+            try:
+                if kind is CHECK_FIELD:
+                    document[key] = arg(value)
+                    continue
+                if pre is not None:
+                    value = pre(value)
+                if kind is CHECK_INSTANCE:
+                    ok = isinstance(value, arg)
+                elif kind is CHECK_ENUM:
+                    try: ok = value in arg.lookup
+                    except TypeError: ok = value in arg.values
+                elif kind is CHECK_CALL:
+                    ok = arg(value)
+                else:
+                    ok = True
+                if not ok:
+                    raise ValueError('%r failed type check' % value)
+                if pre is not None:
+                    document[key] = value
+            except ValueError:
+                failed.append(key)
+
+        if missing or failed:
+            if missing and not failed:
+                raise ValueError("Required fields missing: %s" % (missing))
+            if failed and not missing:
+                raise ValueError("Keys did not match spec: %s" % (failed))
+            raise ValueError("Missing fields: %s, Invalid fields: %s" % (missing, failed))
+        # just a token of my kindness, a return for you
+        return True
+
+def compile_spec(spec):
+    """Compile a spec document into a ``CompiledSpec``.  Already compiled
+    specs are returned as is."""
+    if isinstance(spec, CompiledSpec):
+        return spec
+    return CompiledSpec(spec)
+
 def validate(document, spec):
     """Validate that a document meets a specification.  Returns True if
-    validation was successful, but otherwise raises a ValueError."""
+    validation was successful, but otherwise raises a ValueError.  ``spec``
+    may be a spec document or a spec compiled with ``compile_spec``."""
     if not spec:
         return True
-    missing = []
-    for key, field in spec.iteritems():
-        if field.required and key not in document:
-            missing.append(key)
-
-    failed = []
-    for key, field in spec.iteritems():
-        if key in document:
-            try: document[key] = field.validate(document[key])
-            except ValueError: failed.append(key)
-
-    if missing or failed:
-        if missing and not failed:
-            raise ValueError("Required fields missing: %s" % (missing))
-        if failed and not missing:
-            raise ValueError("Keys did not match spec: %s" % (failed))
-        raise ValueError("Missing fields: %s, Invalid fields: %s" % (missing, failed))
-    # just a token of my kindness, a return for you
-    return True
+    return compile_spec(spec).validate(document)
 
@@ -4,27 +4,110 @@
 """micromongo utilities"""
 
 import re
+import struct
+import threading
+from collections import deque
 from functools import wraps
 
-def memoize(function):
-    """Memoizing function.  Potentially not thread-safe, since it will return
-    resuts across threads.  Make sure this is okay with callers."""
-    _cache = {}
+from datetime import datetime
+
+from bson import BSON
+from bson.objectid import ObjectId
+
+_missing = object()
+# separates the positional arguments of a memoize key from the keywords
+_kwmark = object()
+
+def memoize(function=None, maxsize=None):
+    """Memoizing decorator, usable as ``@memoize`` or, to keep at most
+    ``maxsize`` results, ``@memoize(maxsize=N)``, which drops the oldest
+    results first.  Results are shared across threads;  lookups are single
+    dict reads, and only storing a new result takes a lock.  Arguments are
+    told apart by type as well as value, so ``f(1)`` and ``f(True)`` are
+    cached separately.  Calls with arguments that can't be hashed aren't
+    cached."""
+    if function is None:
+        return lambda function: memoize(function, maxsize)
+    results = {}
+    order = deque()
+    lock = threading.Lock()
     @wraps(function)
     def wrapper(*args, **kwargs):
-        key = str(args) + str(kwargs)
-        if key not in _cache:
-            _cache[key] = function(*args, **kwargs)
-        return _cache[key]
+        key = (args, tuple(map(type, args)))
+        try:
+            if kwargs:
+                key += (_kwmark, frozenset((k, v, type(v)) for k, v in kwargs.iteritems()))
+            result = results.get(key, _missing)
+        except TypeError:
+            return function(*args, **kwargs)
+        if result is _missing:
+            result = function(*args, **kwargs)
+            with lock:
+                if key not in results:
+                    results[key] = result
+                    if maxsize is not None:
+                        order.append(key)
+                        while len(order) > maxsize:
+                            del results[order.popleft()]
+        return result
     return wrapper
 
+_camel_words = re.compile('(.)([A-Z][a-z]+)')
+_camel_humps = re.compile('([a-z0-9])([A-Z])')
+
+@memoize(maxsize=4096)
 def uncamel(name):
     """Convert a CamelCase name to a lower_underscore one.  From:
         http://stackoverflow.com/questions/1175208/
     """
-    s1 = re.sub('(.)([A-Z][a-z]+)', r'\1_\2', name)
-    return re.sub('([a-z0-9])([A-Z])', r'\1_\2', s1).lower()
+    s1 = _camel_words.sub(r'\1_\2', name)
+    return _camel_humps.sub(r'\1_\2', s1).lower()
+
+_int32 = struct.Struct('<i')
+
+def _cstring_end(data, start):
+    return data.index('\x00', start) + 1
+
+# sizes of the fixed width bson element values, by type byte
+_fixed_sizes = {
+    '\x01': 8, '\x06': 0, '\x07': 12, '\x08': 1, '\x09': 8, '\x0A': 0,
+    '\x10': 4, '\x11': 8, '\x12': 8, '\x13': 16, '\xFF': 0, '\x7F': 0,
+}
 
+def bson_index(data):
+    """Index the top level elements of the bson document ``data`` without
+    decoding them.  Returns a dictionary of keys to ``(start, end)`` offsets
+    of each whole element, suitable for ``bson_decode_element``."""
+    index = {}
+    position, end = 4, len(data) - 1
+    while position < end:
+        kind = data[position]
+        name_end = _cstring_end(data, position + 1)
+        name = data[position + 1:name_end - 1].decode('utf-8')
+        if kind in _fixed_sizes:
+            value_end = name_end + _fixed_sizes[kind]
+        elif kind in ('\x02', '\x0D', '\x0E'):
+            value_end = name_end + 4 + _int32.unpack_from(data, name_end)[0]
+        elif kind in ('\x03', '\x04', '\x0F'):
+            value_end = name_end + _int32.unpack_from(data, name_end)[0]
+        elif kind == '\x05':
+            value_end = name_end + 5 + _int32.unpack_from(data, name_end)[0]
+        elif kind == '\x0B':
+            value_end = _cstring_end(data, _cstring_end(data, name_end))
+        elif kind == '\x0C':
+            value_end = name_end + 16 + _int32.unpack_from(data, name_end)[0]
+        else:
+            raise ValueError('unknown bson element type %r' % kind)
+        index[name] = (position, value_end)
+        position = value_end
+    return index
+
+def bson_decode_element(data, start, end):
+    """Decode the single bson element at ``data[start:end]``, returning its
+    value."""
+    element = data[start:end]
+    doc = BSON(_int32.pack(len(element) + 5) + element + '\x00').decode()
+    return doc.itervalues().next()
 
 class OpenStruct(object):
     """Ruby style openstruct.  Implemented by myself millions of times."""
@@ -43,6 +126,7 @@ class OpenStruct(object):
     def __delitem__(self, item):
         if item in self.__dict__:
             del self.__dict__[item]
+    def __contains__(self, item): return item in self.__dict__
     # the rest of the dict interface
     def get(self, key, *args):
         return self.__dict__.get(key, *args)
@@ -55,3 +139,45 @@ class OpenStruct(object):
     def update(self, d): self.__dict__.update(d)
     def clear(self): self.__dict__.clear()
 
+
+# -- document helpers --------------------------------------------------------
+
+# values which are copied as they are, checked first since they're most
+# documents' leaves
+_leaves = (basestring, int, long, float, type(None), datetime, ObjectId)
+
+def copy_document(value):
+    """Deep copy a document, turning any mappings (like Models) in it into
+    dicts.  Values other than mappings, lists and tuples are treated as
+    immutable."""
+    if isinstance(value, _leaves):
+        return value
+    if isinstance(value, (dict, OpenStruct)) or hasattr(value, 'iteritems'):
+        return dict((k, copy_document(v)) for k, v in value.iteritems())
+    if isinstance(value, (list, tuple)):
+        return [copy_document(v) for v in value]
+    return value
+
+def hashable(value):
+    """A hashable stand-in for a document value, used for index and cache
+    keys, in which the order of the keys of a dict doesn't matter but the
+    order of a list does."""
+    if isinstance(value, dict):
+        return ('__dict__',) + tuple(sorted((k, hashable(v)) for k, v in value.iteritems()))
+    if isinstance(value, (list, tuple)):
+        return ('__list__',) + tuple(hashable(v) for v in value)
+    return value
+
+def get_path(document, path, default=None):
+    """Get the value at the dotted ``path`` of a document or Model without
+    traversing arrays;  numeric parts index into them."""
+    for part in path.split('.'):
+        if isinstance(document, list):
+            if part.isdigit() and int(part) < len(document):
+                document = document[int(part)]
+                continue
+        elif hasattr(document, 'iteritems') and part in document:
+            document = document[part]
+            continue
+        return default
+    return document
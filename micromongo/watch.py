@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Change feeds over a model's collection, for daemons that would otherwise
+poll ``find`` for documents newer than the last ones they saw::
+
+    feed = Event.watch({'kind': 'price'}, resume_from=load_checkpoint())
+    for event in feed:
+        invalidate(event)
+        save_checkpoint(feed.checkpoint)
+
+A feed returns the documents matching its query in order of an increasing
+``key``, ``_id`` by default.  On a capped collection, it follows the
+collection with a tailable cursor, which the server holds open while it
+waits for new documents.  On any other collection, it polls for documents
+whose key is greater than the last one it returned;  with a key that every
+save sets, like an update timestamp or counter, this returns changed
+documents as well as new ones.  ``tail`` forces one or the other.
+
+Whenever there is nothing new, the feed waits ``min_wait`` seconds before
+looking again, doubling the wait up to ``max_wait`` for as long as it stays
+idle.  With ``timeout``, it stops after being idle for that many seconds;
+otherwise it runs until it is closed with ``close``, which may be called
+from another thread.
+
+``checkpoint`` is the key of the last document returned;  a feed started
+with it as ``resume_from`` picks up after that document.  Documents whose
+key is equal to the checkpoint are not returned again, so the key should
+increase with every write:  timestamps written in the same instant as the
+checkpoint will be missed.
+
+With ``batch_size``, the feed returns lists of up to that many documents
+that were available at once, rather than single documents, and the
+checkpoint is that of the last document of the last list."""
+
+import time
+import threading
+
+from pymongo.errors import AutoReconnect
+
+from micromongo.parallel import range_spec
+from micromongo.utils import get_path
+
+__all__ = ['Watch']
+
+class Watch(object):
+    """A change feed over the documents of ``model`` matching ``query``.
+    Other keyword arguments are passed along to ``Model.find``."""
+    def __init__(self, model, query=None, resume_from=None, key='_id', tail=None,
+                 min_wait=0.1, max_wait=5.0, batch_size=None, timeout=None, **kwargs):
+        self.model = model
+        self.query = query or {}
+        self.checkpoint = resume_from
+        self.key = key
+        self.tail = tail
+        self.min_wait = min_wait
+        self.max_wait = max_wait
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self.find_kwargs = kwargs
+        self._closed = threading.Event()
+        self._cursor = None
+        self._events = self._run()
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        return self._events.next()
+
+    def close(self):
+        """Stop the feed;  it raises StopIteration from then on."""
+        self._closed.set()
+
+    @property
+    def closed(self):
+        return self._closed.is_set()
+
+    def _find(self):
+        """A cursor over the documents after the checkpoint."""
+        if self.tail is None:
+            self.tail = bool(self.model._collection().options().get('capped'))
+        spec = range_spec(self.query, self.key, None, None, self.checkpoint)
+        # the feed's reads are never cached
+        kwargs = dict(self.find_kwargs, cache=False, cache_ttl=0)
+        if self.tail:
+            return self.model.find(spec, tailable=True, await_data=True, **kwargs)
+        return self.model.find(spec, **kwargs).sort(self.key, 1)
+
+    def _read(self, count):
+        """Read up to ``count`` documents that are available now."""
+        documents = []
+        try:
+            if self._cursor is None or not self._cursor.alive:
+                self._cursor = self._find()
+            while len(documents) < count:
+                documents.append(self._cursor.next())
+        except StopIteration:
+            pass
+        except AutoReconnect:
+            # start over from the checkpoint once the server is back
+            self._cursor = None
+        return documents
+
+    def _run(self):
+        wait = self.min_wait
+        idle_since = time.time()
+        try:
+            while not self.closed:
+                documents = self._read(self.batch_size or 1)
+                if documents:
+                    wait, idle_since = self.min_wait, time.time()
+                    self.checkpoint = get_path(documents[-1], self.key)
+                    yield documents if self.batch_size else documents[0]
+                    continue
+                if self.timeout is not None and time.time() - idle_since >= self.timeout:
+                    return
+                self._closed.wait(wait)
+                wait = min(wait * 2, self.max_wait)
+        finally:
+            if self._cursor is not None:
+                self._cursor.close()
+                self._cursor = None
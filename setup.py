@@ -42,6 +42,10 @@ if __name__ == '__main__':
         install_requires=[
             'pymongo',
         ],
+        extras_require={
+            'futures': ['futures'],
+            'columnar': ['numpy', 'pandas'],
+        },
         # -*- Entry points: -*-
         entry_points="",
     )
@@ -22,6 +22,22 @@ class AccountingMetaclassTest(TestCase):
         self.assertEquals(cmap['stream.stream_entry'], StreamEntry)
         self.assertEquals(cmap['blog.post'], BlogPost)
         self.assertEquals(cmap['test_accountingmeta.auto_model'], AutoModel)
+        self.assertEquals(BlogPost._collection_path, ('blog', 'post'))
+        self.assertEquals(StreamEntry._collection_path, ('stream', 'stream_entry'))
+        self.assertEquals(AutoModel._collection_path, ('test_accountingmeta', 'auto_model'))
+
+    def test_connection_alias(self):
+        from micromongo.models import Model, connection_slot
+        class Default(Model):
+            collection = 'test_db.default'
+
+        class Analytics(Model):
+            collection = 'test_db.analytics'
+            connection = 'analytics'
+
+        self.assertTrue(Default._connection_slot is connection_slot())
+        self.assertTrue(Analytics._connection_slot is connection_slot('analytics'))
+        self.assertEqual(Analytics._connection_slot.alias, 'analytics')
 
 if __name__ == '__main__':
     main()
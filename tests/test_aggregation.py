@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""test aggregation and the in-memory pipeline evaluator"""
+
+from datetime import datetime
+from unittest import TestCase
+
+from pymongo.errors import OperationFailure, InvalidOperation
+
+from micromongo import *
+from micromongo import monitoring
+
+class AggregationTest(TestCase):
+    def setUp(self):
+        self.c = connect('mem://test_aggregation')
+        self.col = self.c.test_db.orders
+        self.col.insert([
+            {'customer': 'ann', 'amount': 10, 'items': ['a', 'b'], 'day': datetime(2013, 1, 1)},
+            {'customer': 'bob', 'amount': 5, 'items': ['b'], 'day': datetime(2013, 1, 2)},
+            {'customer': 'ann', 'amount': 7, 'items': [], 'day': datetime(2013, 2, 1)},
+            {'customer': 'cat', 'amount': 1, 'day': datetime(2013, 2, 3)},
+        ])
+
+    def tearDown(self):
+        from micromongo.models import AccountingMeta
+        AccountingMeta.collection_map = {}
+        self.c.drop_database('test_db')
+
+    def test_group(self):
+        cursor = self.col.aggregate([
+            {'$match': {'amount': {'$gt': 1}}},
+            {'$group': {'_id': '$customer', 'total': {'$sum': '$amount'},
+                        'orders': {'$sum': 1}, 'avg': {'$avg': '$amount'},
+                        'largest': {'$max': '$amount'}, 'first': {'$first': '$amount'},
+                        'items': {'$addToSet': '$items'}}},
+        ]).order_by('-total')
+        results = list(cursor)
+        self.assertEqual([r['_id'] for r in results], ['ann', 'bob'])
+        ann = results[0]
+        self.assertEqual((ann['total'], ann['orders'], ann['avg'], ann['largest'], ann['first']),
+                         (17, 2, 8.5, 10, 10))
+        self.assertEqual(ann['items'], [['a', 'b'], []])
+        # cached like other cursors, and can't be changed once run
+        self.assertEqual(list(cursor), results)
+        self.assertRaises(InvalidOperation, cursor.limit, 1)
+        self.assertEqual(len(list(cursor.rewind())), 2)
+
+    def test_stages(self):
+        unwound = list(self.col.aggregate([{'$unwind': '$items'}, {'$sort': {'amount': 1}},
+                                           {'$project': {'_id': 0, 'items': 1}}]))
+        self.assertEqual(unwound, [{'items': 'b'}, {'items': 'a'}, {'items': 'b'}])
+        preserved = list(self.col.aggregate([
+            {'$unwind': {'path': '$items', 'preserveNullAndEmptyArrays': True}}]))
+        self.assertEqual(len(preserved), 5)
+
+        projected = list(self.col.aggregate([
+            {'$match': {'customer': 'ann'}},
+            {'$project': {'_id': 0, 'month': {'$month': '$day'},
+                          'double': {'$multiply': ['$amount', 2]},
+                          'name': {'$toUpper': '$customer'},
+                          'big': {'$cond': [{'$gte': ['$amount', 10]}, 'yes', 'no']},
+                          'note': {'$ifNull': ['$note', 'none']}}},
+        ]).skip(1))
+        self.assertEqual(projected, [{'month': 2, 'double': 14, 'name': 'ANN',
+                                      'big': 'no', 'note': 'none'}])
+        self.assertEqual(list(self.col.aggregate([{'$count': 'n'}])), [{'n': 4}])
+
+        self.col.aggregate([{'$group': {'_id': '$customer'}}, {'$out': 'customers'}]).fetch()
+        self.assertEqual(sorted(self.c.test_db.customers.distinct('_id')), ['ann', 'bob', 'cat'])
+
+        self.assertRaises(OperationFailure, list, self.col.aggregate([{'$bogus': {}}]))
+        self.assertRaises(OperationFailure, list, self.col.aggregate(
+            [{'$project': {'x': {'$bogus': 1}}}]))
+
+    def test_models(self):
+        class Order(Model):
+            collection = 'test_db.orders'
+
+        class Total(Model):
+            collection = 'test_db.totals'
+
+        pipeline = [{'$group': {'_id': '$customer', 'total': {'$sum': '$amount'}}}]
+        results = list(Order.aggregate(pipeline).order_by('_id'))
+        self.assertEqual(type(results[0]), dict)
+        for model in (Total, 'test_db.totals'):
+            results = list(Order.aggregate(pipeline, model=model).order_by('_id'))
+            self.assertTrue(isinstance(results[0], Total))
+            self.assertEqual(results[0].total, 17)
+            self.assertEqual(results[0].changes(), {})
+        self.assertRaises(ValueError, Order.aggregate, pipeline, model='test_db.nothing')
+
+        self.assertEqual(Order.count(), 4)
+        self.assertEqual(Order.count({'customer': 'ann'}), 2)
+        self.assertEqual(sorted(Order.distinct('items')), ['a', 'b'])
+        self.assertEqual(Order.distinct('customer', {'amount': {'$lt': 6}}), ['bob', 'cat'])
+
+        def reduce(document, out):
+            out['total'] += document['amount']
+        groups = Order.group(['customer'], {'amount': {'$gt': 1}}, {'total': 0}, reduce)
+        self.assertEqual(groups, [{'customer': 'ann', 'total': 17},
+                                  {'customer': 'bob', 'total': 5}])
+        self.assertRaises(OperationFailure, Order.group, ['customer'], {}, {},
+                          'function(doc, out) {}')
+
+    def test_instrumentation(self):
+        events = []
+        monitoring.register(events.append)
+        try:
+            list(self.col.aggregate([{'$match': {'customer': 'ann'}}]))
+        finally:
+            monitoring.unregister(events.append)
+        event, = events
+        self.assertEqual((event.operation, event.returned), ('aggregate', 2))
+        self.assertEqual(event.spec, {'pipeline': [{'$match': {'customer': 'ann'}}]})
@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""test the caches in micromongo.cache"""
+
+import time
+import threading
+from unittest import TestCase
+
+from micromongo.cache import LRUCache, IdentityMap, QueryCache
+
+class LRUCacheTest(TestCase):
+    def test_lru(self):
+        cache = LRUCache(maxsize=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.set('c', 3)
+        # 'b' was the least recently used
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+        self.assertEqual(cache.evictions, 1)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.pop('a'), 1)
+        self.assertFalse('a' in cache)
+
+    def test_ttl(self):
+        cache = LRUCache(ttl=0.01)
+        cache.set('a', 1)
+        cache.set('b', 2, ttl=None)
+        self.assertEqual(cache.get('a'), 1)
+        time.sleep(0.02)
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(cache.get('b'), 2)
+
+class IdentityMapTest(TestCase):
+    def test_identity_map(self):
+        imap = IdentityMap(maxsize=10)
+        doc = {'_id': 1, 'name': 'foo'}
+        self.assertEqual(imap.get('test.test', 1), None)
+        imap.put('test.test', doc)
+        self.assertTrue(imap.get('test.test', 1) is doc)
+        self.assertEqual(imap.get('test.other', 1), None)
+        stats = imap.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 2))
+
+        # documents are not shared across threads
+        found = []
+        t = threading.Thread(target=lambda: found.append(imap.get('test.test', 1)))
+        t.start(); t.join()
+        self.assertEqual(found, [None])
+
+        imap.discard('test.test', 1)
+        self.assertEqual(imap.get('test.test', 1), None)
+
+    def test_scopes(self):
+        imap = IdentityMap(scoped=True)
+        self.assertFalse(imap.active)
+        imap.put('test.test', {'_id': 1})
+        self.assertEqual(imap.get('test.test', 1), None)
+        with imap.scope():
+            self.assertTrue(imap.active)
+            imap.put('test.test', {'_id': 1})
+            self.assertEqual(imap.get('test.test', 1), {'_id': 1})
+            with imap.scope():
+                self.assertEqual(imap.get('test.test', 1), None)
+        self.assertEqual(imap.get('test.test', 1), None)
+
+    def test_model_get(self):
+        from micromongo.models import Model, AccountingMeta
+        class Foo(Model):
+            collection = 'test_db.identity_map'
+        AccountingMeta.collection_map.pop('test_db.identity_map')
+        self.assertEqual(Foo.get.im_self, Foo)
+        self.assertEqual(Foo(a=1).get('a'), 1)
+        self.assertEqual(Foo(a=1).get('b', 2), 2)
+
+class QueryCacheTest(TestCase):
+    def setUp(self):
+        from micromongo import connect
+        self.c = connect('mem://test_query_cache', query_cache=True)
+
+    def tearDown(self):
+        from micromongo.models import AccountingMeta
+        AccountingMeta.collection_map = {}
+        self.c.drop_database('test_db')
+
+    def test_server_cursor_clones(self):
+        from micromongo import backend, Model, Ref
+        from micromongo.models import class_router
+        class Post(Model):
+            collection = 'test_db.posts'
+            spec = {'author': Ref('test_db.authors')}
+
+        # cursors are only made here, so no server is needed
+        c = backend.Connection('localhost', 27017, _connect=False, class_router=class_router,
+                               query_cache=QueryCache(), cursor_cache=10)
+        cursor = c.test_db.posts.find({'a': 1}, cache_ttl=5).populate('author')
+        clone = cursor.clone()
+        self.assertTrue(isinstance(clone, backend.Cursor))
+        self.assertTrue(clone.as_class is Post)
+        self.assertEqual(clone._cache_key(), cursor._cache_key())
+        self.assertEqual((clone._query_cache, clone._cache_ttl), (c.query_cache, 5))
+        self.assertEqual((clone._populate, clone._cachelimit), (cursor._populate, 10))
+
+    def test_generations(self):
+        cache = QueryCache(maxsize=10)
+        generation = cache.generation('db.col')
+        cache.put('db.col', generation, 'key', ({'a': 1},), None)
+        self.assertEqual(cache.get('db.col', generation, 'key'), ({'a': 1},))
+        # a query that started before an invalidation is not cached
+        cache.invalidate('db.col')
+        self.assertEqual(cache.get('db.col', cache.generation('db.col'), 'key'), None)
+        cache.put('db.col', generation, 'key', ({'a': 2},), None)
+        self.assertEqual(cache.get('db.col', cache.generation('db.col'), 'key'), None)
+        self.assertEqual((cache.stats()['hits'], cache.stats()['misses']), (1, 2))
+
+    def test_model_queries(self):
+        from micromongo.models import Model
+        class Foo(Model):
+            collection = 'test_db.query_cache'
+            cache_ttl = 60
+
+        for i in range(4):
+            Foo.new(n=i).save()
+        Foo.new(n=4, sub={'x': 4, 'ys': [{'y': 4}]}).save()
+        cache = self.c.query_cache
+        # subdocuments of hits are wrapped as those of misses are
+        for i in range(2):
+            foo = Foo.find_one({'n': 4})
+            self.assertEqual((foo.sub.x, foo.sub.ys[0].y), (4, 4))
+        self.assertEqual(cache.stats()['hits'], 1)
+        cache.clear()
+        cache.hits = 0
+        first = list(Foo.find({'n': {'$lt': 3}}).order_by('-n'))
+        second = list(Foo.find({'n': {'$lt': 3}}).order_by('-n'))
+        self.assertEqual(cache.stats()['hits'], 1)
+        self.assertEqual([f.n for f in second], [2, 1, 0])
+        self.assertTrue(all(type(f) is Foo for f in second))
+        self.assertEqual(second[0].changes(), {})
+        # hits are copies, so changing them doesn't change the cache
+        second[0].n = 10
+        self.assertEqual(Foo.find({'n': {'$lt': 3}}).order_by('-n')[0].n, 2)
+        # different sorts, skips and limits are different queries
+        self.assertEqual([f.n for f in Foo.find({'n': {'$lt': 3}}).order_by('n')], [0, 1, 2])
+        self.assertEqual(Foo.find({'n': {'$lt': 3}}).order_by('-n')[0].n, 2)
+        self.assertEqual(Foo.find_one({'n': 1}).n, 1)
+        self.assertEqual(Foo.find_one({'n': 1}).n, 1)
+        hits = cache.stats()['hits']
+        self.assertEqual(hits, 3)
+
+        # saves invalidate the collection's queries
+        first[0].n = 20
+        first[0].save()
+        self.assertEqual([f.n for f in Foo.find({'n': {'$lt': 3}}).order_by('-n')], [1, 0])
+        Foo.update({'n': 1}, inc={'n': 1})
+        self.assertEqual(Foo.find_one({'n': 1}), None)
+        self.c.test_db.query_cache.remove({'n': 0})
+        self.assertEqual([f.n for f in Foo.find({'n': {'$lt': 3}}).order_by('-n')], [2])
+        self.assertEqual(cache.stats()['hits'], hits)
+
+        # queries without a ttl aren't cached
+        self.assertEqual(len(list(Foo.find(cache_ttl=None))), 4)
+        self.assertEqual(len(list(self.c.test_db.query_cache.find())), 4)
+        self.assertEqual(cache.stats()['hits'], hits)
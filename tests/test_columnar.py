@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""test columnar export in micromongo.columnar"""
+
+from datetime import datetime
+from unittest import TestCase, skipIf
+
+from pymongo.errors import InvalidOperation
+
+from micromongo import *
+from micromongo import columnar
+
+@skipIf(columnar.numpy is None, "numpy is not installed")
+class ColumnarTest(TestCase):
+    def setUp(self):
+        self.c = connect('mem://test_columnar')
+        self.c.test_db.sales.insert([
+            {'_id': i, 'amount': i * 1.5, 'units': i, 'paid': i % 2 == 0,
+             'day': datetime(2013, 1, i + 1), 'region': {'name': 'r%d' % (i % 3)}}
+            for i in range(10)])
+
+    def tearDown(self):
+        from micromongo.models import AccountingMeta
+        AccountingMeta.collection_map = {}
+        self.c.drop_database('test_db')
+
+    def test_spec_dtypes(self):
+        class Sale(Model):
+            collection = 'test_db.sales'
+            spec = {
+                'amount': Field(type=(int, float)),
+                'units': Field(type=int),
+                'paid': Field(type=bool),
+                'day': Field(type=datetime),
+                'note': Field(type=basestring),
+            }
+
+        cursor = Sale.find().order_by('_id')
+        arrays = cursor.to_arrays()
+        self.assertEqual(list(arrays), ['_id', 'amount', 'day', 'note', 'paid', 'units'])
+        self.assertEqual(arrays['amount'].dtype.name, 'float64')
+        self.assertEqual(arrays['units'].dtype.name, 'int64')
+        self.assertEqual(arrays['paid'].dtype.name, 'bool')
+        self.assertEqual(arrays['day'].dtype.name, 'datetime64[ms]')
+        self.assertEqual(arrays['note'].dtype.name, 'object')
+        self.assertEqual(arrays['units'].sum(), 45)
+        # the results weren't cached, so the cursor can't be iterated again
+        self.assertRaises(InvalidOperation, list, cursor)
+
+        # missing ints become NaN in a float column
+        self.c.test_db.sales.insert({'_id': 10, 'amount': 1})
+        arrays = Sale.find().to_arrays(['units', 'region.name'], {'region.name': 'S2'})
+        self.assertEqual(arrays['units'].dtype.name, 'float64')
+        self.assertEqual(arrays['region.name'][4], 'r1')
+        self.assertTrue(columnar.numpy.isnan(arrays['units'][10]))
+
+    def test_chunks(self):
+        cursor = self.c.test_db.sales.find({}, ['units']).order_by('_id')
+        chunks = list(cursor.to_arrays(chunk_size=4))
+        self.assertEqual([len(c['units']) for c in chunks], [4, 4, 2])
+        self.assertEqual(list(chunks[0]), ['units', '_id'])
+        self.assertEqual(chunks[2]['units'].tolist(), [8, 9])
+
+    @skipIf(columnar.pandas is None, "pandas is not installed")
+    def test_dataframe(self):
+        frame = self.c.test_db.sales.find().order_by('_id').to_dataframe(['units', 'amount'])
+        self.assertEqual(list(frame.columns), ['units', 'amount'])
+        self.assertEqual(frame.units.sum(), 45)
+        frames = list(self.c.test_db.sales.find().to_dataframe(chunk_size=5))
+        self.assertEqual([len(f) for f in frames], [5, 5])
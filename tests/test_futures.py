@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""test the non-blocking api in micromongo.futures"""
+
+from unittest import TestCase
+
+from micromongo import *
+from micromongo.backend import from_env
+from micromongo import futures
+
+class FuturesTest(TestCase):
+    def tearDown(self):
+        from micromongo.models import AccountingMeta
+        AccountingMeta.collection_map = {}
+        c = connect(*from_env())
+        c.test_db.drop_collection('test_collection')
+
+    def test_futures(self):
+        c = connect(*from_env())
+        col = c.test_db.test_collection
+
+        class Foo(Model):
+            collection = col.full_name
+            spec = {'docid': Field(type=int, required=True)}
+
+        pending = [Foo.new(docid=i).asave() for i in range(20)]
+        for future in pending:
+            self.assertEqual(future.result(), None)
+        self.assertRaises(ValueError, Foo.new(docid='bad').asave().result)
+
+        # many queries can be in flight at once
+        pending = [Foo.afind_one({'docid': i}) for i in range(20)]
+        self.assertEqual([f.result().docid for f in pending], range(20))
+
+        cursor = Foo.find().order_by('-docid')
+        self.assertEqual([f.docid for f in cursor.afetch(15).result()], range(19, 4, -1))
+        self.assertEqual(len(cursor.afetch(15).result()), 5)
+        self.assertEqual(cursor.afetch(15).result(), [])
+
+class ExecutorTest(TestCase):
+    def test_executor(self):
+        class Executor(object):
+            def __init__(self):
+                self.calls = []
+            def submit(self, function, *args, **kwargs):
+                self.calls.append(function)
+                return function(*args, **kwargs)
+
+        executor = Executor()
+        old = futures.set_executor(executor)
+        try:
+            self.assertEqual(futures.submit(sum, [1, 2]), 3)
+            self.assertEqual(executor.calls, [sum])
+        finally:
+            futures.set_executor(old)
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""test declarative indexes in micromongo.indexes"""
+
+import warnings
+from unittest import TestCase
+
+from micromongo import *
+from micromongo import indexes
+from micromongo.indexes import Index, UnindexedQueryWarning
+
+class IndexTest(TestCase):
+    def setUp(self):
+        self.c = connect('mem://test_indexes')
+
+    def tearDown(self):
+        from micromongo.models import AccountingMeta
+        AccountingMeta.collection_map = {}
+        AccountingMeta.index_map = {}
+        self.c.drop_database('test_db')
+
+    def test_declarations(self):
+        self.assertEqual(Index.make('a').keys, [('a', 1)])
+        self.assertEqual(Index.make(('a', -1)).keys, [('a', -1)])
+        self.assertEqual(Index.make(('a', '-b')).keys, [('a', 1), ('b', -1)])
+        self.assertEqual(Index.make([('a', 1), ('b', -1)]).name, 'a_1_b_-1')
+        index = Index('created', expire_after=60, unique=True)
+        self.assertEqual(index.options, {'expireAfterSeconds': 60, 'unique': True})
+        self.assertRaises(ValueError, Index)
+
+    def test_sync_indexes(self):
+        col = self.c.test_db.test_collection
+        col.ensure_index('old')
+        col.ensure_index('token')
+
+        class Foo(Model):
+            collection = col.full_name
+            indexes = ['user', ('user', '-created'), Index('token', unique=True)]
+
+        changes = sync_indexes()[col.full_name]
+        self.assertEqual(changes['created'], ['user_1', 'user_1_created_-1', 'token_1'])
+        self.assertEqual(sorted(changes['dropped']), ['old_1', 'token_1'])
+        self.assertEqual(sorted(col.index_information()),
+            ['_id_', 'token_1', 'user_1', 'user_1_created_-1'])
+        self.assertTrue(col.index_information()['token_1']['unique'])
+        # a second sync has nothing to do
+        self.assertEqual(sync_indexes()[col.full_name], {'created': [], 'dropped': []})
+
+        col.ensure_index('extra')
+        self.assertEqual(sync_indexes(drop=False)[col.full_name]['dropped'], [])
+        self.assertTrue('extra_1' in col.index_information())
+
+    def test_unindexed_warning(self):
+        class Foo(Model):
+            collection = 'test_db.test_collection'
+            indexes = ['user']
+
+        old = indexes.warn_unindexed
+        indexes.warn_unindexed = True
+        try:
+            with warnings.catch_warnings(record=True) as caught:
+                warnings.simplefilter('always')
+                list(Foo.find({'user': 1, 'name': 'foo'}))
+                Foo.find_one({'_id': 1})
+                Foo.find_one({'$or': [{'user': 1}, {'_id': 2}]})
+                self.assertEqual(caught, [])
+                Foo.find_one({'name': 'foo'})
+                list(Foo.find({'$or': [{'user': 1}, {'name': 'foo'}]}))
+            self.assertEqual([w.category for w in caught], [UnindexedQueryWarning] * 2)
+            self.assertTrue('name' in str(caught[0].message))
+        finally:
+            indexes.warn_unindexed = old
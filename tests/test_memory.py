@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""test the in-memory backend in micromongo.memory"""
+
+import re
+from unittest import TestCase
+
+from pymongo.errors import DuplicateKeyError, OperationFailure, InvalidOperation
+
+from micromongo import *
+from micromongo import memory
+
+class MemoryTest(TestCase):
+    def setUp(self):
+        self.c = connect('mem://test_memory')
+        self.col = self.c.test_db.test_collection
+
+    def tearDown(self):
+        from micromongo.models import AccountingMeta
+        AccountingMeta.collection_map = {}
+        self.c.drop_database('test_db')
+
+    def find(self, spec, **kwargs):
+        return sorted(d['n'] for d in self.col.find(spec, **kwargs))
+
+    def test_connect(self):
+        self.assertTrue(isinstance(self.c, memory.Connection))
+        self.assertTrue(current() is self.c)
+        # connections to the same uri share their data, others don't
+        self.col.insert({'n': 1})
+        self.assertEqual(connect('mem://test_memory').test_db.test_collection.count(), 1)
+        self.assertEqual(clean_connection().test_db.test_collection.count(), 1)
+        self.assertEqual(connect('mem://other').test_db.test_collection.count(), 0)
+        self.c = connect(host='mem://test_memory')
+        self.assertTrue(isinstance(self.c, memory.Connection))
+
+    def test_queries(self):
+        self.col.insert([
+            {'n': 1, 'name': 'foo', 'tags': ['a', 'b'], 'sub': {'x': 1}},
+            {'n': 2, 'name': 'bar', 'tags': ['b'], 'sub': {'x': 2}, 'flag': True},
+            {'n': 3, 'name': 'Baz', 'tags': [], 'items': [{'k': 1}, {'k': 5}]},
+        ])
+        self.assertEqual(self.find({}), [1, 2, 3])
+        self.assertEqual(self.find({'name': 'foo'}), [1])
+        self.assertEqual(self.find({'tags': 'b'}), [1, 2])
+        self.assertEqual(self.find({'sub.x': {'$gte': 2}}), [2])
+        self.assertEqual(self.find({'n': {'$gt': 1, '$lt': 3}}), [2])
+        self.assertEqual(self.find({'n': {'$ne': 2}}), [1, 3])
+        self.assertEqual(self.find({'n': {'$in': [1, 3]}}), [1, 3])
+        self.assertEqual(self.find({'n': {'$nin': [1, 3]}}), [2])
+        self.assertEqual(self.find({'flag': {'$exists': True}}), [2])
+        self.assertEqual(self.find({'flag': None}), [1, 3])
+        self.assertEqual(self.find({'flag': 1}), [])
+        self.assertEqual(self.find({'tags': {'$all': ['a', 'b']}}), [1])
+        self.assertEqual(self.find({'tags': {'$size': 0}}), [3])
+        self.assertEqual(self.find({'items': {'$elemMatch': {'k': {'$gt': 3}}}}), [3])
+        self.assertEqual(self.find({'items.k': 5}), [3])
+        self.assertEqual(self.find({'name': re.compile('^b', re.I)}), [2, 3])
+        self.assertEqual(self.find({'name': {'$regex': '^b', '$options': 'i'}}), [2, 3])
+        self.assertEqual(self.find({'name': {'$not': re.compile('^b')}}), [1, 3])
+        self.assertEqual(self.find({'n': {'$mod': [2, 1]}}), [1, 3])
+        self.assertEqual(self.find({'$or': [{'n': 1}, {'name': 'bar'}]}), [1, 2])
+        self.assertEqual(self.find({'$nor': [{'n': 1}, {'name': 'bar'}]}), [3])
+        self.assertEqual(self.find({'$and': [{'n': {'$gt': 1}}, {'tags': 'b'}]}), [2])
+        # values of different types are not compared
+        self.assertEqual(self.find({'name': {'$gt': 1}}), [])
+        self.assertRaises(OperationFailure, self.find, {'n': {'$where': 1}})
+
+    def test_cursor(self):
+        self.col.insert([{'n': i, 'odd': i % 2} for i in range(10)])
+        cursor = self.col.find().sort('n', -1).skip(2).limit(3)
+        self.assertEqual([d['n'] for d in cursor], [7, 6, 5])
+        # cursors cache their results, and can't change once started
+        self.assertEqual([d['n'] for d in cursor], [7, 6, 5])
+        self.assertRaises(InvalidOperation, cursor.limit, 5)
+        self.assertEqual(cursor.count(), 10)
+        self.assertEqual(cursor.count(True), 3)
+        self.assertEqual(self.col.find()[3]['n'], 3)
+        self.assertEqual([d['n'] for d in self.col.find()[3:5]], [3, 4])
+        self.assertEqual(list(self.col.find()[2:2]), [])
+        self.assertEqual(list(self.col.find()[5:3]), [])
+        self.assertEqual(self.col.find()[2:2].count(True), 0)
+        self.assertEqual(len(list(self.col.find()[2:2].limit(3))), 3)
+        self.assertEqual([d['n'] for d in self.col.find().order_by('odd', '-n')][:3], [8, 6, 4])
+        self.assertEqual(self.col.find({}, ['n']).next().keys(), ['_id', 'n'])
+        self.assertEqual(self.col.find({}, {'_id': 0, 'odd': 0}).next(), {'n': 0})
+
+        cursor = self.col.find(cache=2)
+        self.assertEqual(len(list(cursor)), 10)
+        self.assertRaises(InvalidOperation, iter, cursor)
+        self.assertEqual(len(list(cursor.rewind())), 10)
+
+        # results are copies of the stored documents
+        doc = self.col.find_one({'n': 1})
+        doc['n'] = 100
+        self.assertEqual(self.col.find_one({'n': 1})['odd'], 1)
+
+    def test_updates(self):
+        _id = self.col.insert({'n': 1, 'tags': ['a']})
+        self.col.update({'_id': _id}, {'$inc': {'n': 2}, '$set': {'sub.x': 1},
+            '$push': {'tags': 'b'}, '$addToSet': {'set': {'$each': [1, 1, 2]}}})
+        doc = self.col.find_one(_id)
+        self.assertEqual(doc['n'], 3)
+        self.assertEqual(doc['sub'], {'x': 1})
+        self.assertEqual(doc['tags'], ['a', 'b'])
+        self.assertEqual(doc['set'], [1, 2])
+
+        self.col.update({'_id': _id}, {'$pull': {'tags': 'a'}, '$unset': {'sub': 1},
+            '$pop': {'set': 1}, '$rename': {'n': 'm'}})
+        doc = self.col.find_one(_id)
+        self.assertEqual((doc['tags'], doc['set'], doc['m']), (['b'], [1], 3))
+        self.assertFalse('sub' in doc or 'n' in doc)
+        self.assertRaises(OperationFailure, self.col.update, {'_id': _id}, {'$inc': {'tags': 1}})
+        self.assertRaises(OperationFailure, self.col.update, {'_id': _id}, {'$set': {'_id': 1}})
+
+        # whole document replacement keeps the _id
+        self.col.update({'_id': _id}, {'replaced': True})
+        self.assertEqual(self.col.find_one(), {'_id': _id, 'replaced': True})
+
+        self.col.insert([{'n': 5}, {'n': 5}])
+        self.assertEqual(self.col.update({'n': 5}, {'$set': {'x': 1}})['n'], 1)
+        self.assertEqual(self.col.update({'n': 5}, {'$set': {'x': 2}}, multi=True)['n'], 2)
+        result = self.col.update({'n': 6}, {'$set': {'x': 3}}, upsert=True)
+        self.assertEqual(self.col.find_one(result['upserted']), {'_id': result['upserted'], 'n': 6, 'x': 3})
+        self.assertEqual(self.col.remove({'n': 5})['n'], 2)
+        self.assertEqual(self.col.count(), 2)
+        # collection objects outlive drops
+        self.col.drop()
+        self.col.insert({'n': 1})
+        self.assertEqual(self.c.test_db.test_collection.count(), 1)
+
+    def test_indexes(self):
+        self.col.insert([{'n': i, 'tags': ['t%d' % i, 'all']} for i in range(5)])
+        name = self.col.ensure_index('tags')
+        self.col.ensure_index([('n', 1)], unique=True)
+        self.assertEqual(sorted(self.col.index_information()), ['_id_', 'n_1', name])
+        self.assertEqual(self.find({'tags': 't2'}), [2])
+        self.assertEqual(self.find({'tags': {'$in': ['t1', 't3']}}), [1, 3])
+        self.assertEqual(self.find({'tags': 'all', 'n': {'$lt': 2}}), [0, 1])
+        self.assertRaises(DuplicateKeyError, self.col.insert, {'n': 1})
+        self.col.update({'n': 1}, {'$set': {'tags': ['moved']}})
+        self.assertEqual(self.find({'tags': 't1'}), [])
+        self.assertEqual(self.find({'tags': 'moved'}), [1])
+        self.col.remove({'n': 1})
+        self.col.insert({'n': 1})
+        self.col.drop_index(name)
+        self.assertEqual(sorted(self.col.index_information()), ['_id_', 'n_1'])
+        self.assertRaises(DuplicateKeyError, self.col.ensure_index, 'x', unique=True)
+        _id = self.col.find_one({'n': 0})['_id']
+        self.assertRaises(DuplicateKeyError, self.col.insert, {'_id': _id})
+
+    def test_models(self):
+        class Foo(Model):
+            collection = 'test_db.test_collection'
+            spec = {'n': Field(type=int, required=True)}
+
+        Foo.new(n=1, sub={'x': 1}).save()
+        foo = Foo.find_one({'n': 1})
+        self.assertTrue(isinstance(foo, Foo))
+        foo.sub.x = 2
+        foo.save()
+        self.assertEqual(Foo.find_one(foo._id).sub.x, 2)
+        self.assertEqual([f.n for f in Foo.find()], [1])
+        # clean connections return plain dicts
+        doc = clean_connection().test_db.test_collection.find_one()
+        self.assertEqual(type(doc), dict)
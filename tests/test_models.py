@@ -73,6 +73,153 @@ class ModelTest(TestCase):
         d2 = col.find_one({'docid': 18})
         self.assertEqual(d2.subdoc.test, 3)
 
+    def test_save_many(self):
+        """Test batched saving of models."""
+        c = connect(*from_env())
+        col = c.test_db.test_collection
+
+        class Foo(Model):
+            collection = col.full_name
+            spec = {'docid': Field(type=int, required=True)}
+            def post_save(self):
+                self.saved = True
+
+        foos = [Foo.new(docid=i) for i in range(10)]
+        bad = Foo.new(docid='bad')
+        failed = Foo.save_many(foos + [bad], batch_size=4)
+        self.assertEqual(len(failed), 1)
+        self.assertTrue(failed[0][0] is bad)
+        self.assertTrue(isinstance(failed[0][1], ValueError))
+        self.assertEqual(Foo.find().count(), 10)
+        self.assertTrue(all('_id' in f for f in foos))
+        self.assertTrue(all(f.saved for f in foos))
+
+        # documents with _ids are upserted
+        for f in foos:
+            del f['saved']
+            f.docid += 100
+        self.assertEqual(Foo.save_many(foos), [])
+        self.assertEqual(Foo.find().count(), 10)
+        self.assertEqual(Foo.find({'docid': {'$gte': 100}}).count(), 10)
+
+    def test_identity_map(self):
+        """Test that _id lookups are served from the identity map."""
+        c = connect(*from_env(), identity_map=True)
+        col = c.test_db.test_collection
+
+        class Foo(Model):
+            collection = col.full_name
+
+        f = Foo.new(docid=1)
+        f.save()
+        self.assertTrue(Foo.get(f._id) is f)
+        self.assertTrue(Foo.find_one({'_id': f._id}) is f)
+        self.assertTrue(Foo.find_one(f._id) is f)
+        # other lookups still go to the server
+        self.assertFalse(Foo.find_one({'docid': 1}) is f)
+        self.assertEqual(c.identity_map.stats()['hits'], 3)
+
+        with c.identity_map.scope():
+            g = Foo.get(f._id)
+            self.assertFalse(g is f)
+            self.assertTrue(Foo.get(f._id) is g)
+
+    def test_default_projection(self):
+        """Test that ``fields`` is applied to finds and saves."""
+        c = connect(*from_env())
+        col = c.test_db.test_collection
+        col.save({'docid': 1, 'name': 'foo', 'big': range(100)})
+
+        class Foo(Model):
+            collection = col.full_name
+            fields = ['docid', 'name']
+
+        f = Foo.find_one({'docid': 1})
+        self.assertEqual(sorted(f.keys()), ['_id', 'docid', 'name'])
+        self.assertEqual(len(Foo.find_one({'docid': 1}, fields=None).big), 100)
+        self.assertEqual(list(Foo.find())[0].keys(), f.keys())
+
+        # saving the partial document does not drop the other fields
+        f.name = 'bar'
+        f.save()
+        d = col.find_one({'docid': 1}, fields=None)
+        self.assertEqual(d['name'], 'bar')
+        self.assertEqual(len(d['big']), 100)
+
+    def test_pool_stats(self):
+        """Test socket pool limits and counters with many threads."""
+        import threading
+        from micromongo.backend import count_sockets
+        from micromongo.memory import is_memory_uri
+        c = connect(*from_env(), max_pool_size=4, waitQueueTimeoutMS=5000)
+        col = c.test_db.test_collection
+
+        class Foo(Model):
+            collection = col.full_name
+
+        Foo.new(docid=1).save()
+        errors = []
+        def work():
+            try:
+                with request():
+                    for i in range(10):
+                        f = Foo.find_one({'docid': 1})
+                        f.save()
+            except Exception, e:
+                errors.append(e)
+        threads = [threading.Thread(target=work) for i in range(32)]
+        for t in threads: t.start()
+        for t in threads: t.join()
+        self.assertEqual(errors, [])
+
+        stats = c.pool_stats()
+        self.assertEqual(stats['max_size'], 4)
+        if count_sockets and not is_memory_uri(from_env()[0]):
+            self.assertTrue(stats['checkouts'] >= 32 * 20)
+            self.assertEqual(stats['in_use'], 0)
+            self.assertTrue(stats['opened'] <= 4)
+
+    def test_connection_aliases(self):
+        """Test models using a named connection."""
+        from micromongo.models import current
+        c = connect(*from_env())
+        other = connect(*from_env(), alias='other')
+        self.assertTrue(current() is c)
+        self.assertTrue(current('other') is other)
+        col = c.test_db.test_collection
+
+        class Foo(Model):
+            collection = col.full_name
+            connection = 'other'
+
+        Foo.new(docid=1).save()
+        self.assertEqual(Foo.find().count(), 1)
+        self.assertEqual(Foo.find_one({'docid': 1}).docid, 1)
+        self.assertEqual(type(other.test_db.test_collection.find_one()), Foo)
+        # the alias is resolved when it is reconnected
+        again = connect(*from_env(), alias='other')
+        self.assertTrue(Foo._connection_slot.connection is again)
+        # along with the routing table of collection handles
+        handle = Foo._collection()
+        self.assertTrue(handle.database.connection is again)
+        self.assertTrue(Foo._collection() is handle)
+        self.assertTrue(col.full_name in Foo._connection_slot.collections)
+        self.assertEqual(Foo.find().count(), 1)
+
+    def test_read_preference(self):
+        """Test reads with read preferences."""
+        c = connect(*from_env())
+        col = c.test_db.test_collection
+
+        class Foo(Model):
+            collection = col.full_name
+            read_preference = 'secondary_preferred'
+
+        Foo.new(docid=1).save()
+        self.assertEqual(Foo.find_one({'docid': 1}).docid, 1)
+        self.assertEqual(Foo.find(read='primary').count(), 1)
+        self.assertEqual(type(list(Foo.find(read='nearest'))[0]), Foo)
+
 class SONManipulatorTest(TestCase):
     def tearDown(self):
         from micromongo.models import AccountingMeta
@@ -135,6 +282,402 @@ class SONManipulatorTest(TestCase):
         self.assertEqual(len(list(foos)), 2)
         self.assertEqual(len(list(foos)), 2)
 
+    def test_cursor_cache_modes(self):
+        """Test streaming and bounded cursor caches."""
+        from pymongo.errors import InvalidOperation
+        c = connect(*from_env())
+        col = c.test_db.test_collection
+
+        class Foo(Model):
+            collection = col.full_name
+
+        for i in range(5):
+            col.save({'docid': i})
+
+        foos = Foo.find().stream()
+        self.assertEqual(len(list(foos)), 5)
+        self.assertRaises(InvalidOperation, iter, foos)
+        self.assertEqual(len(list(foos.rewind())), 5)
+
+        foos = Foo.find(cache=10)
+        self.assertEqual(len(list(foos)), 5)
+        self.assertEqual(len(list(foos)), 5)
+
+        foos = Foo.find(cache=3).order_by('docid')
+        self.assertEqual([f.docid for f in foos], range(5))
+        self.assertRaises(InvalidOperation, iter, foos)
+
+        c = connect(*from_env(), cursor_cache=False)
+        foos = Foo.find()
+        self.assertEqual(len(list(foos)), 5)
+        self.assertRaises(InvalidOperation, iter, foos)
+        self.assertEqual(len(list(Foo.find(cache=True))), 5)
+
+class LazyModelTest(TestCase):
+    def tearDown(self):
+        from micromongo.models import AccountingMeta
+        AccountingMeta.collection_map = {}
+
+    def test_lazy_decoding(self):
+        """Test that lazy models decode fields on access."""
+        from bson import BSON
+        from micromongo.models import LazyModel
+
+        class Wide(LazyModel):
+            collection = 'test_db.wide'
+
+        doc = {'_id': 1, 'name': 'wide', 'big': [{'i': i} for i in range(100)]}
+        w = Wide.from_bson(BSON.encode(doc))
+        self.assertEqual(sorted(w.keys()), ['_id', 'big', 'name'])
+        self.assertEqual(w.__dict__, {})
+        self.assertEqual(w.name, 'wide')
+        self.assertEqual(w.__dict__, {'name': 'wide'})
+        self.assertTrue('big' in w)
+        self.assertEqual(w.get('missing', 1), 1)
+        w.big = None
+        w['_id'] = 2
+        self.assertEqual(dict(w), {'_id': 2, 'name': 'wide', 'big': None})
+
+        w = Wide.from_bson(BSON.encode(doc))
+        self.assertEqual(dict(w.items()), doc)
+        self.assertEqual(Wide.get.im_self, Wide)
+
+class CompactModelTest(TestCase):
+    def tearDown(self):
+        from micromongo.models import AccountingMeta
+        AccountingMeta.collection_map = {}
+
+    def test_closed_model(self):
+        """Test the dict interface of closed models."""
+        import gc
+
+        class Point(Model):
+            collection = 'test_db.point'
+            closed = True
+            spec = {
+                'x': Field(type=int, default=0),
+                'y': Field(type=int, required=True),
+                'items': Field(),
+            }
+
+        p = Point.new(y=2)
+        self.assertTrue(isinstance(p, Point))
+        self.assertEqual(p.__class__._slots, ('_id', 'x', 'y'))
+        self.assertEqual(dict(p), {'x': 0, 'y': 2})
+        # no instance dict is allocated for documents that fit the spec
+        self.assertFalse(any(isinstance(r, dict) for r in gc.get_referents(p)))
+
+        p._id = 1
+        p.z = 3
+        p['items'] = []
+        self.assertEqual(dict(p), {'_id': 1, 'x': 0, 'y': 2, 'z': 3, 'items': []})
+        self.assertEqual(sorted(p.keys()), ['_id', 'items', 'x', 'y', 'z'])
+        self.assertEqual(p.z, 3)
+        self.assertEqual(p.get('w', 4), 4)
+        self.assertTrue('z' in p)
+        self.assertTrue(p.validate())
+
+        del p.z
+        del p['x']
+        self.assertFalse('x' in p)
+        self.assertRaises(AttributeError, getattr, p, 'x')
+        self.assertRaises(ValueError, Point(x=1).validate)
+        p.clear()
+        self.assertEqual(dict(p), {})
+
+        # keys named like model attributes are found as on open models
+        class Counter(Model):
+            collection = 'test_db.counter'
+            closed = True
+            spec = {'count': Field(type=int), 'fields': Field(), 'update': Field()}
+
+        Counter.new(_id=1, count=5, fields=['a'], update='daily').save()
+        c = Counter.find_one({'_id': 1})
+        self.assertEqual((c.count, c.fields, c.update), (5, ['a'], 'daily'))
+        self.assertEqual(type(c).count(), 1)
+        self.assertEqual(Counter.find_one().count, 5)
+        del c.update
+        self.assertEqual(c.update.__name__, '_update')
+
+class DirtyTrackingTest(TestCase):
+    def setUp(self):
+        self.c = connect('mem://test_models')
+        self.col = self.c.test_db.test_collection
+
+    def tearDown(self):
+        from micromongo.models import AccountingMeta
+        AccountingMeta.collection_map = {}
+        self.c.drop_database('test_db')
+
+    def test_partial_saves(self):
+        """Test that saves of loaded documents only send their changes."""
+        class Profile(Model):
+            collection = self.col.full_name
+            spec = {'visits': Field(type=int), 'name': Field(type=basestring)}
+
+        p = Profile.new(name='foo', visits=0, bio='x', tags=['a'])
+        self.assertEqual(p.changes(), None)
+        p.save()
+        p = Profile.find_one({'name': 'foo'})
+        self.assertEqual(p.changes(), {'$set': {'tags': ['a']}})
+        p.visits += 1
+        del p.bio
+        p['extra'] = 1
+        self.assertEqual(p.changes(), {'$set': {'visits': 1, 'extra': 1, 'tags': ['a']},
+                                       '$unset': {'bio': 1}})
+
+        # a concurrent change to a key this document didn't touch is kept
+        self.col.update({'_id': p._id}, {'$set': {'name': 'bar'}})
+        p.save()
+        self.assertEqual(dict(self.col.find_one(p._id)),
+            {'_id': p._id, 'name': 'bar', 'visits': 1, 'extra': 1, 'tags': ['a']})
+        self.assertEqual(p.changes(), {'$set': {'tags': ['a']}})
+        self.assertEqual(p._originals, None)
+
+        # with diff_in_place, values changed in place are compared to those
+        # that were loaded
+        class DiffedProfile(Profile):
+            collection = self.col.full_name
+            diff_in_place = True
+        p = DiffedProfile.find_one(p._id)
+        self.assertEqual(p.changes(), {})
+        p.tags.append('b')
+        p.profile = {'city': 'x'}
+        p.save()
+        p.profile['city'] = 'y'
+        self.assertEqual(p.changes(), {'$set': {'profile': {'city': 'y'}}})
+        p.save()
+        self.assertEqual(self.col.find_one(p._id)['tags'], ['a', 'b'])
+        self.assertEqual(p.changes(), {})
+
+        # a document removed since it was loaded is saved whole
+        self.col.remove(p._id)
+        p.visits = 2
+        p.save()
+        saved = self.col.find_one(p._id)
+        self.assertEqual((saved.name, saved.visits, saved.tags), ('bar', 2, ['a', 'b']))
+
+        # only changed keys are validated
+        self.col.update({'_id': p._id}, {'$set': {'name': 1}})
+        p = Profile.find_one(p._id)
+        p.visits = 2
+        p.save()
+        p.visits = 'bad'
+        self.assertRaises(ValueError, p.save)
+        p.visits = 3
+        self.assertRaises(ValueError, p.save, full=True)
+        p.name = 'foo'
+        p.save(full=True)
+        self.assertEqual(self.col.find_one(p._id)['visits'], 3)
+
+        # values changed in place are validated along with those that are set
+        class Tagged(Model):
+            collection = self.col.full_name
+            spec = {'tags': Field(type=lambda v: len(v) <= 2)}
+        p = Tagged.find_one(p._id)
+        p.tags.extend(['b', 'c', 'd'])
+        self.assertRaises(ValueError, p.save)
+        self.assertEqual(self.col.find_one(p._id)['tags'], ['a', 'b'])
+
+    def test_properties(self):
+        """Test that properties are set rather than stored as keys."""
+        class User(Model):
+            collection = self.col.full_name
+            def _get_name(self):
+                return '%s %s' % (self.first, self.last)
+            def _set_name(self, name):
+                self.first, self.last = name.split()
+            name = property(_get_name, _set_name)
+
+        u = User(first='a', last='b')
+        u.save()
+        u.name = 'c d'
+        self.assertEqual(u.changes(), {'$set': {'first': 'c', 'last': 'd'}})
+        u.save()
+        self.assertEqual(sorted(self.col.find_one(u._id).keys()), ['_id', 'first', 'last'])
+        self.assertEqual(User.find_one(u._id).name, 'c d')
+
+    def test_tracked_models(self):
+        """Test tracking of lazy and closed models."""
+        class Lazy(LazyModel):
+            collection = 'test_db.lazy'
+            diff_in_place = True
+        class Closed(Model):
+            collection = 'test_db.closed'
+            closed = True
+            diff_in_place = True
+            spec = {'x': Field(type=int)}
+
+        from bson import BSON
+        l = Lazy.from_bson(BSON.encode({'_id': 1, 'a': 1, 'b': 2}))
+        l.a = 3
+        del l['b']
+        self.assertEqual(l.changes(), {'$set': {'a': 3}, '$unset': {'b': 1}})
+        self.assertEqual(dict(l), {'_id': 1, 'a': 3})
+        l = Lazy.from_bson(BSON.encode({'_id': 1, 'tags': ['a'], 'geo': {'x': 1}}))
+        self.assertEqual((l.geo, l.changes()), ({'x': 1}, {}))
+        l.tags.append('b')
+        self.assertEqual(l.changes(), {'$set': {'tags': ['a', 'b']}})
+
+        c = Closed(x=1, y=2, z=[1])
+        c.save()
+        c.x = 2
+        del c.y
+        self.assertEqual(c.changes(), {'$set': {'x': 2}, '$unset': {'y': 1}})
+        c.z.append(2)
+        self.assertEqual(c.changes()['$set'], {'x': 2, 'z': [1, 2]})
+
+class AtomicUpdateTest(TestCase):
+    def setUp(self):
+        self.c = connect('mem://test_models', identity_map=True)
+        self.col = self.c.test_db.test_collection
+
+    def tearDown(self):
+        from micromongo.models import AccountingMeta
+        AccountingMeta.collection_map = {}
+        self.c.drop_database('test_db')
+
+    def test_atomic_updates(self):
+        """Test the atomic update helpers."""
+        class Post(Model):
+            collection = self.col.full_name
+            spec = {'title': Field(type=basestring, required=True),
+                    'views': Field(type=int, default=0)}
+
+        post = Post.new(title='hello')
+        post.save()
+        self.assertEqual(post.inc('views'), 1)
+        self.assertEqual(post.inc('views', 2), 3)
+        self.assertEqual(post.views, 3)
+        self.assertEqual(post.changes(), {})
+        self.assertEqual(post.push('tags', 'a'), ['a'])
+        post.add_to_set('tags', 'a')
+        post.add_to_set('tags', 'b')
+        self.assertEqual(post.pull('tags', 'a'), ['b'])
+        self.assertEqual(self.col.find_one(post._id)['tags'], ['b'])
+
+        result = Post.update({'_id': post._id}, inc={'views': 1}, set={'title': 'hi'})
+        self.assertEqual(result['n'], 1)
+        # the identity map doesn't serve the stale document
+        self.assertEqual(Post.get(post._id).views, 4)
+        self.assertRaises(ValueError, Post.update, {}, set={'title': 1})
+        self.assertRaises(ValueError, Post.update, {}, unset={'title': 1})
+        self.assertRaises(ValueError, Post.update, {}, inc={'views': 'a'})
+        self.assertRaises(ValueError, post.inc, 'views', '1')
+        self.assertRaises(TypeError, Post.update, {}, rename={'a': 'b'})
+        self.assertEqual(self.col.find_one(post._id)['views'], 4)
+
+        # the instance side of update is still dict.update
+        post.update({'title': 'yo'})
+        self.assertEqual(post.title, 'yo')
+
+        Post.new(title='second', views=10).save()
+        old = Post.find_and_modify({}, sort=[('views', -1)], inc={'views': 1})
+        self.assertTrue(isinstance(old, Post))
+        self.assertEqual((old.title, old.views), ('second', 10))
+        new = Post.find_and_modify({'title': 'second'}, inc={'views': 1}, new=True)
+        self.assertEqual(new.views, 12)
+        self.assertEqual(new.changes(), {})
+        self.assertEqual(Post.find_and_modify({'title': 'none'}, set={'views': 1}), None)
+        removed = Post.find_and_modify({'title': 'second'}, remove=True)
+        self.assertEqual(removed.title, 'second')
+        self.assertEqual(self.col.count(), 1)
+
+    def test_array_updates(self):
+        """Test that array modifiers are checked against the spec."""
+        strings = lambda l: isinstance(l, list) and all(isinstance(s, basestring) for s in l)
+        class Post(Model):
+            collection = self.col.full_name
+            spec = {'title': Field(type=basestring), 'tags': Field(type=strings, default=[])}
+        class Author(Model):
+            collection = 'test_db.author'
+
+        post = Post.new(title='hello')
+        post.save()
+        self.assertEqual(post.push('tags', 'a'), ['a'])
+        self.assertRaises(ValueError, post.push, 'tags', 1)
+        self.assertRaises(ValueError, post.add_to_set, 'tags', {'$each': ['b', 2]})
+        self.assertRaises(ValueError, post.push, 'title', 'a')
+        self.assertRaises(ValueError, post.pull, 'tags', 1)
+        Post.update({'_id': post._id}, {'$addToSet': {'tags': {'$each': ['b', 'c']}},
+                                        '$pop': {'other': 1}})
+        Post.update({'_id': post._id}, {'$pull': {'tags': {'$in': ['a', 'c']}}})
+        self.assertEqual(self.col.find_one(post._id)['tags'], ['b'])
+        self.assertRaises(ValueError, Post.update, {}, {'$rename': {'tags': 'labels'}})
+        Post.update({}, {'$rename': {'other': 'another'}})
+
+        # updates on other keys only forget documents of their own collection
+        imap = self.c.identity_map
+        Author(_id=1).save()
+        self.assertTrue(Post.get(post._id) is Post.get(post._id))
+        Post.update({'title': 'hello'}, set={'title': 'hi'})
+        self.assertEqual(imap.get(Post._collection_key, post._id), None)
+        self.assertTrue(imap.get(Author._collection_key, 1) is not None)
+
+class ReadPreferenceTest(TestCase):
+    def tearDown(self):
+        from micromongo.models import AccountingMeta
+        AccountingMeta.collection_map = {}
+
+    def test_read_preference(self):
+        """Test that read preferences are applied to finds."""
+        from pymongo import ReadPreference
+        from micromongo.models import read_preference_args
+
+        class Report(Model):
+            collection = 'test_db.report'
+            read_preference = 'secondary_preferred'
+
+        self.assertEqual(read_preference_args('nearest'),
+            {'read_preference': ReadPreference.NEAREST})
+        self.assertRaises(ValueError, read_preference_args, 'tertiary')
+        self.assertEqual(Report._find_kwargs((), {}),
+            {'read_preference': ReadPreference.SECONDARY_PREFERRED})
+        self.assertEqual(Report._find_kwargs(({},), {'read': 'primary'}),
+            {'read_preference': ReadPreference.PRIMARY})
+        self.assertEqual(Model._find_kwargs((), {}), {})
+
+    def test_routing(self):
+        """Test which server serves reads with read preferences."""
+        from micromongo import backend, memory
+        from micromongo.models import connection_class
+
+        primary = connect('mem://rp_primary', secondary='mem://rp_secondary')
+        secondary = connect('mem://rp_secondary', alias='rp_secondary')
+        try:
+            class Report(Model):
+                collection = 'test_db.report'
+                read_preference = 'secondary'
+
+            # nothing is replicated, so each server has its own document
+            primary.test_db.report.insert({'_id': 1, 'server': 'primary'})
+            secondary.test_db.report.insert({'_id': 1, 'server': 'secondary'})
+            self.assertEqual(Report.find_one().server, 'secondary')
+            self.assertEqual(Report.find_one(read='primary').server, 'primary')
+            self.assertEqual(Report.find_one(read='primary_preferred').server, 'primary')
+            self.assertEqual(Report.find_one(read='nearest').server, 'secondary')
+            cursor = Report.find(read='secondary_preferred')
+            self.assertEqual([r.server for r in cursor.clone()], ['secondary'])
+            self.assertEqual(cursor.count(), 1)
+
+            # writes go to the primary
+            Report.new(_id=2, server='primary').save()
+            self.assertEqual(Report.find().count(), 1)
+            self.assertEqual(Report.find(read='primary').count(), 2)
+        finally:
+            primary.drop_database('test_db')
+            secondary.drop_database('test_db')
+            connect(*from_env())
+
+        # servers are connected to as a replica set when one is named
+        self.assertTrue(connection_class(('mongodb://a,b/?replicaSet=rs0',), {})
+                        is backend.ReplicaSetConnection)
+        self.assertTrue(connection_class(('a',), {'replicaset': 'rs0'})
+                        is backend.ReplicaSetConnection)
+        self.assertTrue(connection_class(('a',), {}) is backend.Connection)
+        self.assertTrue(connection_class(('mem://',), {'replicaset': 'rs0'})
+                        is memory.Connection)
+
 class MiscTest(TestCase):
     def test_version(self):
         """Test micromongo.VERSION."""
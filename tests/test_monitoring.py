@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""test the instrumentation in micromongo.monitoring"""
+
+import logging
+from unittest import TestCase
+
+from micromongo import *
+from micromongo import monitoring
+from micromongo.monitoring import QueryEvent, SlowQueryLogger, PrometheusExporter
+
+class MonitoringTest(TestCase):
+    def setUp(self):
+        self.c = connect('mem://test_monitoring')
+        self.events = []
+        monitoring.register(self.events.append)
+
+    def tearDown(self):
+        from micromongo.models import AccountingMeta
+        AccountingMeta.collection_map = {}
+        monitoring.unregister(self.events.append)
+        self.c.drop_database('test_db')
+
+    def test_events(self):
+        class Foo(Model):
+            collection = 'test_db.test_collection'
+            spec = {'n': Field(type=int, required=True)}
+
+        for i in range(3):
+            Foo.new(n=i).save()
+        self.assertEqual([e.operation for e in self.events], ['save'] * 3)
+        self.assertTrue(self.events[0].validate_time > 0)
+        del self.events[:]
+
+        cursor = Foo.find({'n': {'$gt': 0}}).order_by('-n')
+        self.assertEqual(len(list(cursor)), 2)
+        list(cursor)
+        event, = self.events
+        self.assertEqual((event.collection, event.operation, event.returned),
+                         ('test_db.test_collection', 'find', 2))
+        self.assertEqual(event.spec, {'n': {'$gt': 0}})
+        self.assertEqual(event.sort, [('n', -1)])
+        self.assertTrue(event.server_time > 0 and event.decode_time > 0)
+
+        Foo.find_one({'n': 1})
+        self.assertEqual((self.events[-1].operation, self.events[-1].returned), ('find_one', 1))
+        Foo.save_many([Foo.new(n=5), Foo.new(n='bad')])
+        self.assertEqual((self.events[-1].operation, self.events[-1].returned), ('save_many', 1))
+
+        # cursors closed before they are exhausted are reported when closed
+        cursor = Foo.find()
+        cursor.next()
+        cursor.close()
+        self.assertEqual((self.events[-1].operation, self.events[-1].returned), ('find', 1))
+
+    def test_failing_listener(self):
+        def fail(event):
+            raise RuntimeError
+        monitoring.register(fail)
+        logging.getLogger('micromongo').disabled = True
+        try:
+            self.c.test_db.test_collection.insert({'n': 1})
+            self.assertEqual(len(list(self.c.test_db.test_collection.find())), 1)
+            self.assertEqual(len(self.events), 1)
+        finally:
+            logging.getLogger('micromongo').disabled = False
+            monitoring.unregister(fail)
+
+class ListenerTest(TestCase):
+    def test_slow_query_logger(self):
+        messages = []
+        class Logger(object):
+            def warning(self, *args):
+                messages.append(args[0] % args[1:])
+        logger = SlowQueryLogger(threshold=0.5, logger=Logger())
+        logger(QueryEvent('db.col', 'find', {'a': 1}, server_time=0.1))
+        logger(QueryEvent('db.col', 'find', {'a': 2}, server_time=0.4, decode_time=0.2))
+        self.assertEqual(len(messages), 1)
+        self.assertTrue(messages[0].startswith('slow find on db.col: 0.600s'))
+
+    def test_prometheus_exporter(self):
+        exporter = PrometheusExporter(buckets=(0.1, 1.0))
+        exporter(QueryEvent('db.col', 'find', returned=5, server_time=0.05))
+        exporter(QueryEvent('db.col', 'find', returned=1, server_time=0.5))
+        exporter(QueryEvent('db.col', 'save', returned=1, validate_time=2.0))
+        lines = exporter.render().splitlines()
+        labels = 'collection="db.col",operation="find"'
+        self.assertTrue('micromongo_operations_total{%s} 2' % labels in lines)
+        self.assertTrue('micromongo_documents_total{%s} 6' % labels in lines)
+        self.assertTrue('micromongo_operation_seconds_bucket{%s,le="0.1"} 1' % labels in lines)
+        self.assertTrue('micromongo_operation_seconds_bucket{%s,le="1.0"} 2' % labels in lines)
+        self.assertTrue('micromongo_operation_seconds_bucket{%s,le="+Inf"} 2' % labels in lines)
+        self.assertTrue('micromongo_operation_seconds_bucket{collection="db.col",'
+                        'operation="save",le="1.0"} 0' in lines)
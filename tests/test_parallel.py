@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""test parallel scans in micromongo.parallel"""
+
+from unittest import TestCase
+
+from pymongo.errors import AutoReconnect
+
+from micromongo import *
+from micromongo import parallel
+from micromongo.models import AccountingMeta
+
+class Item(Model):
+    collection = 'test_db.items'
+
+class AliasedItem(Model):
+    collection = 'test_db.items'
+    connection = 'test_parallel_alias'
+
+def double(item):
+    return item.n * 2
+
+class ParallelScanTest(TestCase):
+    def setUp(self):
+        self.c = connect('mem://test_parallel')
+        self.c.test_db.items.insert([{'_id': i, 'n': i, 'even': i % 2 == 0}
+                                     for i in range(200)])
+        AccountingMeta.collection_map['test_db.items'] = Item
+
+    def tearDown(self):
+        self.c.drop_database('test_db')
+
+    def test_split_points(self):
+        points = parallel.split_points(self.c.test_db.items, {}, '_id', 4)
+        self.assertEqual(points, [50, 100, 150])
+        self.assertEqual(parallel.split_points(self.c.test_db.items, {'n': 1}, '_id', 4), [])
+
+    def test_threads(self):
+        items = list(Item.parallel_scan(workers=3, max_queued=20))
+        self.assertEqual(len(items), 200)
+        self.assertTrue(all(type(i) is Item for i in items))
+        self.assertEqual(sorted(i.n for i in items), range(200))
+
+        items = list(Item.parallel_scan({'even': True}, workers=3, ordered=True,
+                                        max_queued=10, fields=['n']))
+        self.assertEqual([i.n for i in items], range(0, 200, 2))
+        self.assertFalse('even' in items[0])
+
+        doubled = Item.parallel_scan(workers=2, map=double, ordered=True, splits=3)
+        self.assertEqual(list(doubled), range(0, 400, 2))
+
+    def test_retries(self):
+        failures = []
+        scan_chunk = parallel.scan_chunk
+        def flaky(model, query, *args):
+            if len(failures) < 3:
+                failures.append(query)
+                raise AutoReconnect("connection reset")
+            return scan_chunk(model, query, *args)
+        parallel.scan_chunk, parallel.retry_delay = flaky, 0
+        try:
+            items = list(Item.parallel_scan(workers=2, ordered=True, retries=3))
+            self.assertEqual([i.n for i in items], range(200))
+            self.assertEqual(len(failures), 3)
+            del failures[:]
+            scan = Item.parallel_scan(workers=1, splits=1, retries=1)
+            self.assertRaises(AutoReconnect, list, scan)
+        finally:
+            parallel.scan_chunk, parallel.retry_delay = scan_chunk, 0.1
+
+    def test_processes(self):
+        results = Item.parallel_scan(workers=2, mode='process', map=double, ordered=True)
+        self.assertEqual(list(results), range(0, 400, 2))
+        items = list(Item.parallel_scan({'n': {'$lt': 10}}, workers=2, mode='process'))
+        self.assertEqual(sorted(i.n for i in items), range(10))
+        self.assertTrue(all(type(i) is Item for i in items))
+        self.assertEqual(items[0].changes(), {})
+
+    def test_process_alias(self):
+        # a worker connects the model's alias, not the default connection
+        aliased = connect('mem://test_parallel', alias='test_parallel_alias')
+        setattr(parallel, '__process_pid', None)
+        try:
+            documents, last, count = parallel.scan_chunk_process(AliasedItem,
+                AliasedItem._connection_slot.args, {}, '_id', 5, ((), {}), None, 0)
+        finally:
+            setattr(parallel, '__process_pid', None)
+        self.assertEqual(count, 5)
+        self.assertTrue(current() is self.c)
+        self.assertFalse(current('test_parallel_alias') is aliased)
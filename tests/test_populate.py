@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""test Ref fields and populating references"""
+
+from unittest import TestCase
+
+from micromongo import *
+from micromongo import monitoring
+from micromongo.models import AccountingMeta
+
+class Author(Model):
+    collection = 'test_db.authors'
+
+class Tag(Model):
+    collection = 'test_db.tags'
+
+class Post(Model):
+    collection = 'test_db.posts'
+    spec = {
+        'title': Field(type=basestring, required=True),
+        'author': Ref('test_db.authors', type=int),
+        'tags': Ref('test_db.tags', many=True, default=[]),
+    }
+
+class PopulateTest(TestCase):
+    def setUp(self):
+        self.c = connect('mem://test_populate')
+        for model in (Author, Tag, Post):
+            AccountingMeta.collection_map[model._collection_key] = model
+        self.c.test_db.authors.insert([{'_id': i, 'name': 'author %d' % i} for i in range(5)])
+        self.c.test_db.tags.insert([{'_id': 'tag%d' % i} for i in range(3)])
+        # post 60 refers to an author that doesn't exist
+        self.c.test_db.posts.insert([{'_id': i, 'title': 'post %d' % i, 'author': i % 5,
+            'tags': ['tag%d' % (i % 3), 'tag9']} for i in range(60)] +
+            [{'_id': 60, 'title': 'orphan', 'author': 99}])
+        self.events = []
+        monitoring.register(self.events.append)
+
+    def tearDown(self):
+        monitoring.unregister(self.events.append)
+        self.c.drop_database('test_db')
+
+    def test_populate(self):
+        posts = list(Post.find().sort('_id', 1).populate('author', 'tags'))
+        self.assertEqual(len(posts), 61)
+        # the posts, then one query per collection for each batch of 100
+        self.assertEqual(sorted(e.collection for e in self.events),
+                         ['test_db.authors', 'test_db.posts', 'test_db.tags'])
+
+        self.assertTrue(type(posts[7].author) is Author)
+        self.assertEqual(posts[7].author.name, 'author 2')
+        self.assertTrue(posts[2].author is posts[7].author)
+        self.assertEqual(posts[4].tags[0]._id, 'tag1')
+        self.assertEqual(posts[4].tags[1], 'tag9')
+        self.assertEqual(posts[60].author, 99)
+
+        # populating isn't a change, and saves store the ids
+        post = posts[7]
+        self.assertEqual(post.changes(), {'$set': {'tags': ['tag1', 'tag9']}})
+        post.author = Author.find_one({'_id': 4})
+        post.save()
+        self.assertEqual(self.c.test_db.posts.find_one({'_id': 7}, as_class=dict)['author'], 4)
+        post.save(full=True)
+        saved = self.c.test_db.posts.find_one({'_id': 7}, as_class=dict)
+        self.assertEqual((saved['author'], saved['tags']), (4, ['tag1', 'tag9']))
+        self.assertEqual(post.author.name, 'author 4')
+
+    def test_batches(self):
+        cursor = Post.find().populate('author')
+        cursor.populate_batch_size = 25
+        self.assertEqual(len([p for p in cursor if isinstance(p.author, Author)]), 60)
+        self.assertEqual(len([e for e in self.events if e.collection == 'test_db.authors']), 3)
+        # results are cached as usual
+        self.assertEqual(len(list(cursor)), 61)
+
+        posts = Post.populate([Post.find_one({'_id': 3}), Post.new(title='new', author=1)],
+                              'author')
+        self.assertEqual([p.author.name for p in posts], ['author 3', 'author 1'])
+
+    def test_errors(self):
+        self.assertRaises(ValueError, Post.find().populate, 'title')
+        self.assertRaises(ValueError, self.c.test_db.authors.find().populate, 'name')
+        self.assertRaises(ValueError, Post(title='x', author='not an int').validate)
+        self.assertTrue(Post(title='x', author=Author(_id=1), tags=[Tag(_id='a'), 'b']).validate())
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""test on-disk snapshots in micromongo.snapshot"""
+
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from micromongo import *
+from micromongo.models import AccountingMeta
+from micromongo.snapshot import Snapshot
+
+class Country(Model):
+    collection = 'test_db.countries'
+
+class LazyCountry(LazyModel):
+    collection = 'test_db.lazy_countries'
+
+class SnapshotTest(TestCase):
+    def setUp(self):
+        self.c = connect('mem://test_snapshot')
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'countries.snap')
+        AccountingMeta.collection_map['test_db.countries'] = Country
+        AccountingMeta.collection_map['test_db.lazy_countries'] = LazyCountry
+        self.documents = [
+            {'_id': 3, 'name': 'France', 'region': 'eu', 'geo': {'zone': 2}},
+            {'_id': 1, 'name': 'Canada', 'region': 'na', 'geo': {'zone': 1}},
+            {'_id': 2, 'name': 'Germany', 'region': 'eu', 'geo': {'zone': 2}},
+            {'_id': 4, 'name': 'Japan', 'region': 'as'},
+            {'_id': 'xx', 'name': 'Unknown'},
+        ]
+        self.c.test_db.countries.insert(self.documents)
+        self.c.test_db.lazy_countries.insert(self.documents)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+        self.c.drop_database('test_db')
+
+    def test_snapshot(self):
+        self.assertEqual(Country.snapshot(self.path, keys=['region', 'geo.zone']), 5)
+        with Country.open_snapshot(self.path) as countries:
+            self.assertEqual(len(countries), 5)
+            self.assertEqual(countries.collection, 'test_db.countries')
+            france = countries.get(3)
+            self.assertTrue(type(france) is Country)
+            self.assertEqual(france.name, 'France')
+            self.assertEqual(countries.get(4).changes(), {})
+            self.assertEqual(countries.get('xx').name, 'Unknown')
+            self.assertEqual(countries.get(5), None)
+            self.assertTrue(2 in countries and 5 not in countries)
+
+            # iteration is in _id order, numbers before strings
+            self.assertEqual([c._id for c in countries], [1, 2, 3, 4, 'xx'])
+            self.assertEqual([c._id for c in countries.range('_id', 2, 4)], [2, 3])
+            self.assertEqual([c._id for c in countries.range('_id', high=2)], [1])
+
+            self.assertEqual(sorted(c.name for c in countries.find('region', 'eu')),
+                             ['France', 'Germany'])
+            self.assertEqual([c.name for c in countries.find('region', None)], ['Unknown'])
+            self.assertEqual([c._id for c in countries.find('geo.zone', 2)], [2, 3])
+            self.assertEqual(list(countries.find('region', 'oc')), [])
+            self.assertRaises(KeyError, countries.find, 'name', 'Japan')
+
+        # a snapshot of part of a collection
+        Country.snapshot(self.path, {'region': 'eu'}, fields=['name'])
+        countries = Country.open_snapshot(self.path)
+        self.assertEqual([c.keys() for c in countries], [['_id', 'name']] * 2)
+        countries.close()
+
+    def test_lazy_documents(self):
+        LazyCountry.snapshot(self.path)
+        countries = LazyCountry.open_snapshot(self.path)
+        japan = countries.get(4)
+        self.assertTrue(type(japan) is LazyCountry)
+        self.assertEqual(japan.__dict__, {})
+        self.assertEqual(japan.name, 'Japan')
+        self.assertEqual(dict(japan), self.documents[3])
+        countries.close()
+
+    def test_not_a_snapshot(self):
+        with open(self.path, 'wb') as f:
+            f.write('not a snapshot, just some text')
+        self.assertRaises(ValueError, Snapshot, self.path)
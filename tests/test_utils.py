@@ -14,3 +14,65 @@ class UncamelTest(TestCase):
         self.assertEquals(uncamel('already_un'), 'already_un')
         self.assertEquals(uncamel('Capitalized'), 'capitalized')
         self.assertEquals(uncamel('getHTTPResponseCode'), 'get_http_response_code')
+
+class MemoizeTest(TestCase):
+    def test_memoize(self):
+        from micromongo.utils import memoize
+        calls = []
+        @memoize(maxsize=2)
+        def double(x, factor=2):
+            calls.append(x)
+            return x * factor
+        self.assertEquals([double(1), double(1), double(1, factor=3)], [2, 2, 3])
+        self.assertEquals(calls, [1, 1])
+        # the oldest result is dropped once there are more than maxsize
+        double(2)
+        double(1, factor=3)
+        double(1)
+        self.assertEquals(calls, [1, 1, 2, 1])
+        # unhashable arguments are passed through uncached
+        self.assertEquals(double([1]), [1, 1])
+        self.assertEquals(double([1]), [1, 1])
+        self.assertEquals(calls[-2:], [[1], [1]])
+        self.assertEquals(double(2, factor=[1]), [1, 1])
+        self.assertEquals(double(2, factor=[1]), [1, 1])
+        self.assertEquals(calls[-2:], [2, 2])
+
+        @memoize
+        def unbounded(x):
+            calls.append(x)
+            return x
+        for i in range(3):
+            unbounded('a')
+        self.assertEquals(calls.count('a'), 1)
+
+        # equal arguments of different types are cached separately
+        self.assertEquals([unbounded(1), unbounded(True), unbounded(1.0)], [1, True, 1.0])
+        self.assertEquals([type(unbounded(v)) for v in (1, True, 1.0)], [int, bool, float])
+        self.assertEquals(calls[-3:], [1, True, 1.0])
+        self.assertEquals([double(1, factor=2), double(1, factor=True)], [2, 1])
+
+class DocumentTest(TestCase):
+    def test_hashable(self):
+        from micromongo.utils import hashable
+        self.assertEqual(hashable({'a': 1, 'b': [1, {'c': 2}]}),
+                         hashable({'b': [1, {'c': 2}], 'a': 1}))
+        self.assertNotEqual(hashable([('a', 1), ('b', 1)]), hashable([('b', 1), ('a', 1)]))
+
+    def test_copy_document(self):
+        from micromongo.utils import copy_document, OpenStruct
+        document = {'a': OpenStruct(b=[1, (2, 3)]), 'c': 'd'}
+        copy = copy_document(document)
+        self.assertEqual(copy, {'a': {'b': [1, [2, 3]]}, 'c': 'd'})
+        self.assertTrue(type(copy['a']) is dict)
+        copy['a']['b'].append(4)
+        self.assertEqual(document['a'].b, [1, (2, 3)])
+
+    def test_get_path(self):
+        from micromongo.utils import get_path, OpenStruct
+        document = {'a': OpenStruct(b={'c': 1}), 'l': [{'m': 2}]}
+        self.assertEqual(get_path(document, 'a.b.c'), 1)
+        self.assertEqual(get_path(document, 'l.0.m'), 2)
+        self.assertEqual(get_path(document, 'l.m'), None)
+        self.assertEqual(get_path(document, 'a.x', 'default'), 'default')
+
@@ -92,3 +92,53 @@ class ValidationTest(TestCase):
         f.any = 123.4
         f.save()
 
+
+class CompiledSpecTest(TestCase):
+    def test_compiled_validation(self):
+        class IntField(Field):
+            def pre_validate(self, value):
+                try: return int(value)
+                except (TypeError, ValueError): return value
+
+        spec = {
+            'docid': IntField(type=int, default=0),
+            'req': Field(required=True),
+            'enum': Field(type=['foo', 'bar'], default='foo'),
+            'baz': Field(type=float),
+        }
+        compiled = compile_spec(spec)
+        self.assertTrue(compile_spec(compiled) is compiled)
+        self.assertEqual(compiled.required, ('req',))
+
+        doc = {'docid': '12', 'req': None, 'enum': 'bar'}
+        self.assertTrue(compiled.validate(doc))
+        self.assertEqual(doc['docid'], 12)
+
+        doc['enum'] = ['unhashable']
+        self.assertRaises(ValueError, compiled.validate, doc)
+        doc['enum'] = 'foo'
+        del doc['req']
+        try:
+            validate(doc, spec)
+        except ValueError, e:
+            self.assertEqual(str(e), "Required fields missing: ['req']")
+        else:
+            self.fail("validate should have raised ValueError")
+        doc['req'] = 1
+        doc['baz'] = 'nope'
+        try:
+            validate(doc, compiled)
+        except ValueError, e:
+            self.assertEqual(str(e), "Keys did not match spec: ['baz']")
+        else:
+            self.fail("validate should have raised ValueError")
+
+    def test_model_validator(self):
+        from micromongo.models import AccountingMeta
+        class Foo(Model):
+            collection = 'test_db.compiled_spec'
+            spec = {'docid': Field(type=int, required=True)}
+        self.assertEqual(Foo._validator.spec, Foo.spec)
+        self.assertRaises(ValueError, Foo.new().validate)
+        self.assertTrue(Foo.new(docid=1).validate())
+        AccountingMeta.collection_map.pop('test_db.compiled_spec', None)
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""test change feeds in micromongo.watch"""
+
+import threading
+from unittest import TestCase
+
+from pymongo.errors import OperationFailure, CollectionInvalid
+
+from micromongo import *
+from micromongo.models import AccountingMeta
+
+class Event(Model):
+    collection = 'test_db.events'
+
+class Entry(Model):
+    collection = 'test_db.entries'
+
+class WatchTest(TestCase):
+    def setUp(self):
+        self.c = connect('mem://test_watch')
+        AccountingMeta.collection_map['test_db.events'] = Event
+        AccountingMeta.collection_map['test_db.entries'] = Entry
+        self.events = self.c.test_db.create_collection('events', capped=True, size=4096, max=50)
+        self.events.insert([{'_id': i, 'kind': 'price' if i % 2 else 'stock'} for i in range(4)])
+
+    def tearDown(self):
+        self.c.drop_database('test_db')
+
+    def test_capped_collections(self):
+        self.assertRaises(CollectionInvalid, self.c.test_db.create_collection, 'events')
+        self.assertEqual(self.events.options()['max'], 50)
+        self.events.insert([{'_id': i} for i in range(4, 60)])
+        self.assertEqual([d['_id'] for d in self.events.find()], range(10, 60))
+
+        cursor = self.events.find({'_id': {'$gte': 58}}, tailable=True)
+        self.assertEqual([d['_id'] for d in cursor], [58, 59])
+        self.assertTrue(cursor.alive)
+        self.events.insert([{'_id': 60}, {'_id': 61}])
+        self.assertEqual([d['_id'] for d in cursor], [60, 61])
+        cursor.close()
+        self.assertFalse(cursor.alive)
+        self.assertRaises(OperationFailure, list, self.c.test_db.other.find(tailable=True))
+
+    def test_tail(self):
+        feed = Event.watch({'kind': 'price'}, min_wait=0.01, timeout=2)
+        self.assertEqual([feed.next()._id, feed.next()._id], [1, 3])
+        self.assertEqual(feed.checkpoint, 3)
+
+        def insert():
+            self.events.insert([{'_id': i, 'kind': 'price'} for i in range(4, 7)])
+        threading.Timer(0.05, insert).start()
+        event = feed.next()
+        self.assertTrue(type(event) is Event)
+        self.assertEqual([event._id, feed.next()._id, feed.next()._id], [4, 5, 6])
+        feed.close()
+        self.assertRaises(StopIteration, feed.next)
+
+        # resuming from a checkpoint, in batches
+        feed = Event.watch(resume_from=4, batch_size=10, timeout=0.05, min_wait=0.01)
+        self.assertEqual([[e._id for e in batch] for batch in feed], [[5, 6]])
+        self.assertEqual(feed.checkpoint, 6)
+
+    def test_poll(self):
+        entries = self.c.test_db.entries
+        entries.insert([{'_id': i, 'version': i} for i in range(3)])
+        feed = Entry.watch(key='version', min_wait=0.01, max_wait=0.04, timeout=1)
+        self.assertFalse(feed.tail)
+        self.assertEqual([feed.next()._id for i in range(3)], [0, 1, 2])
+        # a write that bumps the key shows up as a change
+        threading.Timer(0.05, lambda: entries.update({'_id': 0}, {'$set': {'version': 3}})).start()
+        self.assertEqual((feed.next()._id, feed.checkpoint), (0, 3))
+        feed.close()
+
+    def test_backoff(self):
+        waits = []
+        feed = Event.watch(resume_from=3, min_wait=0.01, max_wait=0.04, timeout=0.1)
+        wait = feed._closed.wait
+        def record(timeout):
+            waits.append(timeout)
+            wait(timeout)
+        feed._closed.wait = record
+        self.assertEqual(list(feed), [])
+        self.assertEqual(waits[:4], [0.01, 0.02, 0.04, 0.04])